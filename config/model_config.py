@@ -4,16 +4,95 @@
 EMBEDDING_CONFIG = {
     # 模型名称
     "MODEL_NAME": "BAAI/bge-m3",
-    # 模型类型
+    # 模型类型："sentence-transformer"（PyTorch）、"onnx"（ONNX Runtime CPU后端）
+    # 或 "bge-m3"（FlagEmbedding，一次推理同时输出稠密向量和稀疏词权重，稀疏索引替代BM25）
     "MODEL_TYPE": "sentence-transformer",
-    # 嵌入维度
+    # 嵌入维度（备用嵌入器的维度；集合按模型实际输出的维度创建和校验，不以此值为准）
     "EMBEDDING_DIM": 1024,
     # 批处理大小
     "BATCH_SIZE": 32,
+    # 动态批处理：每批填充后的token总数上限（批内最大长度 × 批大小）
+    "MAX_BATCH_TOKENS": 16384,
+    # 动态批处理：每批最多文本数（短文本可以组成更大的批次）
+    "MAX_BATCH_SIZE": 256,
     # 设备
     "DEVICE": "cpu",
     # 文本长度限制
     "MAX_LENGTH": 512,
+    # 分块配置
+    "CHUNKING": {
+        # 分块长度计量方式："token" 按嵌入模型分词器的token数（相邻的短语义单元合并到TARGET_TOKENS以内），"char" 按字符数
+        "MODE": "token",
+        # 每块的目标token数（MAX_LENGTH减去[CLS]/[SEP]两个特殊token）
+        "TARGET_TOKENS": 510,
+        # 相邻块的重叠token数
+        "OVERLAP_TOKENS": 64,
+        # token模式无法加载分词器时是否退回按字符分块（块ID会改变，退回时记录在集合schema中）；默认直接报错
+        "ALLOW_CHAR_FALLBACK": False
+    },
+    # 多进程嵌入池（知识库构建时使用，NUM_WORKERS为0表示单进程）
+    "POOL": {
+        # 工作进程数
+        "NUM_WORKERS": 0,
+        # 每个进程的推理线程数
+        "THREADS_PER_WORKER": 4,
+        # 文本数少于该值时不启用进程池
+        "MIN_TEXTS": 256
+    },
+    # 模型版本（用于嵌入缓存指纹，升级模型时修改）
+    "MODEL_REVISION": "main",
+    # 持久化嵌入缓存（按规范化文本哈希和模型指纹缓存到磁盘）
+    "CACHE": {
+        "ENABLED": True,
+        "DIRECTORY": "./embedding_cache",
+        # 最大缓存条目数（超出后按最久未访问淘汰）
+        "MAX_ENTRIES": 200000
+    },
+    # 查询嵌入缓存（内存LRU + TTL，键为规范化后的查询文本）
+    "QUERY_CACHE": {
+        "ENABLED": True,
+        "MAX_ENTRIES": 10000,
+        # 内存上限（字节）
+        "MAX_BYTES": 64 * 1024 * 1024,
+        # 过期时间（秒）
+        "TTL_SECONDS": 3600
+    },
+    # ONNX Runtime 后端配置（MODEL_TYPE 为 "onnx" 时使用）
+    # 导出：python -m knowledge_base.onnx_backend export
+    # 校验：python -m knowledge_base.onnx_backend parity
+    "ONNX": {
+        # 导出的ONNX模型目录（包含分词器文件）
+        "MODEL_DIR": "./models/bge-m3-onnx",
+        # 是否使用int8动态量化模型
+        "QUANTIZED": True,
+        # 算子内线程数（0表示由onnxruntime决定）
+        "INTRA_OP_THREADS": 0,
+        # 池化方式（bge系列使用CLS池化）
+        "POOLING": "cls"
+    },
+    # bge-m3 稀疏词权重配置（MODEL_TYPE 为 "bge-m3" 时使用）
+    "SPARSE": {
+        # 是否使用半精度推理（仅GPU）
+        "USE_FP16": False,
+        # 低于该值的词权重不进入倒排索引
+        "MIN_WEIGHT": 0.0
+    },
+    # 在线查询微批处理（合并并发请求为一个批次推理）
+    "MICRO_BATCH": {
+        "ENABLED": True,
+        # 每批最多请求数
+        "MAX_BATCH_SIZE": 16,
+        # 收集请求的最长等待时间（毫秒）
+        "MAX_WAIT_MS": 5,
+        # 等待队列长度上限
+        "MAX_QUEUE_SIZE": 1024
+    },
+    # 离线备用嵌入器（模型无法加载时使用特征哈希 + TF-IDF）
+    "FALLBACK": {
+        # 字符n-gram范围
+        "NGRAM_RANGE": [2, 3]
+        # IDF统计在构建时对整个语料拟合一次，保存在知识库版本目录中（hashing_idf.npz）
+    },
     # 中文医疗领域微调模型（可选）
     "MEDICAL_MODEL": {
         "ENABLED": False,
@@ -21,19 +100,143 @@ EMBEDDING_CONFIG = {
     }
 }
 
+# 文本块去重配置
+DEDUP_CONFIG = {
+    # 是否启用去重
+    "ENABLED": True,
+    # 字符shingle长度
+    "SHINGLE_SIZE": 5,
+    # MinHash排列数
+    "NUM_PERM": 128,
+    # LSH分带数（每带 NUM_PERM / BANDS 行）
+    "BANDS": 16,
+    # 判定为近似重复的Jaccard相似度阈值
+    "THRESHOLD": 0.85,
+    # 随机种子（保证构建结果可复现）
+    "SEED": 42
+}
+
 # 向量数据库配置
 VECTOR_DB_CONFIG = {
-    # 数据库类型
+    # 数据库类型："chromadb"、"faiss" 或 "numpy"（精确检索，仅依赖numpy）
     "DB_TYPE": "chromadb",
-    # 存储路径
+    # 存储路径（build_kb 在其下的 versions/ 中写入版本快照，CURRENT 指向当前版本）
     "PERSIST_DIRECTORY": "./vector_db",
+    # 版本快照配置
+    "SNAPSHOTS": {
+        # 保留最近发布的版本数（用于回滚）
+        "KEEP_VERSIONS": 3,
+        # Web服务检查新版本的间隔（秒），0表示不检查
+        "WATCH_INTERVAL": 30,
+        # 切换前用于验证新版本的探测查询（无结果时放弃切换）
+        "PROBE_QUERY": "高血压的症状"
+    },
     # 集合名称
     "COLLECTION_NAME": "medical_knowledge",
-    # 相似度阈值
+    # 默认打开模式："open"（只读打开已有集合）、"append"（打开或创建，可写入）、"rebuild"（删除并重建）
+    # 未指定目录时可写模式不修改已发布的版本：在当前版本的草稿副本中写入，VectorDatabase.publish 发布为新版本
+    "OPEN_MODE": "open",
+    # FAISS后端配置（DB_TYPE 为 "faiss" 时使用）
+    "FAISS": {
+        # 索引类型："flat"（精确检索）、"hnsw"（图索引）或 "ivfpq"（倒排 + 乘积量化，适合数百万级语料）
+        "INDEX_TYPE": "hnsw",
+        # HNSW每个节点的邻居数、构建和查询时的候选数
+        "HNSW_M": 32,
+        "HNSW_EF_CONSTRUCTION": 200,
+        "HNSW_EF_SEARCH": 64,
+        # IVF聚类数和查询时探查的聚类数
+        "IVF_NLIST": 4096,
+        "IVF_NPROBE": 32,
+        # PQ子向量数（需整除嵌入维度）和每个子向量的编码位数
+        "PQ_M": 64,
+        "PQ_NBITS": 8,
+        # IVF-PQ训练样本数（积累到该数量且不少于 39×IVF_NLIST 后训练，剩余部分在入库结束时训练；
+        # 不足 39×2^PQ_NBITS 时改用Flat，不足 39×IVF_NLIST 时按样本数减少聚类数）
+        "TRAIN_SIZE": 100000,
+        # 元数据索引无法精确表达过滤条件时，候选数为TOP_K的倍数
+        "OVERFETCH": 10,
+        # 过滤后的候选行不超过该数量时直接精确打分（Flat/HNSW）
+        "EXACT_FILTER_ROWS": 4096
+    },
+    # NumPy后端配置（DB_TYPE 为 "numpy" 时使用）
+    "NUMPY": {
+        # 查询时每块转换为float32的行数（控制临时内存）
+        "BLOCK_ROWS": 16384,
+        # 元数据索引无法精确表达过滤条件时，候选数为TOP_K的倍数
+        "OVERFETCH": 10,
+        # 向量量化：None（只扫描float16矩阵）或 "int8"（按维度量化的int8矩阵初筛，再用float16精确重排）
+        # 召回率对比：python -m knowledge_base.benchmark quantization --rows 200000 --dim 1024
+        "QUANTIZATION": None,
+        # int8初筛的候选数为TOP_K的倍数（越大召回率越接近精确检索，重排读取的float16行越多）
+        "RESCORE_FACTOR": 4
+    },
+    # 分片配置：文本块分布到多个分片进程，各分片使用 DB_TYPE 后端
+    "SHARDING": {
+        "ENABLED": False,
+        # 分片数（ADDRESSES 为空时在本机启动的分片子进程数）
+        "NUM_SHARDS": 4,
+        # 分区方式："hash"（按文本块ID哈希）或 "source"（按来源机构，按机构过滤的查询只访问一个分片）
+        "PARTITION": "hash",
+        # 其他节点上已启动的分片地址，如 ["10.0.0.2:7000", "10.0.0.3:7000"]；为空时在本机启动分片子进程
+        # 启动分片：KB_SHARD_AUTHKEY=<密钥> python -m knowledge_base.sharding serve --shard 0 --directory ./vector_db/shard-0 --host 10.0.0.2 --port 7000
+        "ADDRESSES": [],
+        # 分片连接认证密钥：从环境变量 KB_SHARD_AUTHKEY 读取（不要写在配置文件中），协调端与分片一致
+        # 配置了 ADDRESSES 或分片监听非本机地址时必须设置；只在本机启动子进程分片时未设置则使用随机密钥
+        "AUTHKEY": None,
+        # 查询截止时间（毫秒），超时或失败的分片被跳过，返回其余分片的合并结果
+        "QUERY_DEADLINE_MS": 500,
+        # 等待本机分片子进程启动的时间（秒）
+        "STARTUP_TIMEOUT": 120
+    },
+    # 批量入库配置
+    "INGEST": {
+        # 初始写入批大小（行）
+        "BATCH_SIZE": 1000,
+        # 写入批大小上限（同时受chromadb的最大批大小限制）
+        "MAX_BATCH_SIZE": 5000,
+        # 每批写入的目标耗时（秒），据此自适应调整批大小
+        "TARGET_BATCH_SECONDS": 2.0,
+        # 流水线入库时每个嵌入窗口的文本块数
+        "EMBED_WINDOW": 2048,
+        # 已嵌入、等待写入的窗口数上限
+        "QUEUE_SIZE": 2
+    },
+    # 增量变更配置（update_chunk / delete_chunk / upsert_chunks，可写模式下生效）
+    "MUTATION_LOG": {
+        # 是否先写变更日志再由后台线程批量应用（关闭时每次变更直接写入并落盘）
+        "ENABLED": True,
+        # 成组提交的额外等待时间（毫秒）；为0时前一次fsync期间到达的变更共用下一次fsync
+        "GROUP_COMMIT_MS": 0,
+        # 应用前收集变更的等待时间（毫秒），同一时段内的变更合并后只落盘一次
+        "APPLY_DELAY_MS": 100,
+        # 每组最多的变更数
+        "MAX_BATCH": 1000,
+        # 写入或应用失败后的重试间隔（秒）
+        "RETRY_SECONDS": 5,
+        # 同一组变更连续应用失败该次数后移入隔离文件（<变更日志>.quarantine），不再阻塞后续变更
+        "MAX_ATTEMPTS": 5,
+        # 墓碑行超过该比例时在应用变更后清理（FAISS / NumPy 后端）
+        "COMPACT_RATIO": 0.2
+    },
+    # 距离度量："cosine"、"ip"（内积）或 "l2"（平方欧氏距离），新建集合时声明，已有集合沿用构建时的度量
+    # 嵌入向量在入库和查询时各L2归一化一次，三种度量的排序相同，检索为纯内积
+    "METRIC": "cosine",
+    # 相似度阈值（余弦相似度尺度：各度量的距离先换算为余弦相似度再比较）
+    # 嵌入模型构建的集合使用该值（更换模型时应在该模型上重新校准）
     "SIMILARITY_THRESHOLD": 0.7,
+    # 按集合schema记录的模型覆盖相似度阈值（不同嵌入器的余弦相似度分布差别很大）
+    # hashing-fallback：在15个慢性病问答样例（5种疾病 × 症状/治疗/饮食）上校准，
+    # 相关文本块的余弦相似度最低0.056、中位数0.125，0.05保留全部相关块并过滤约82%的无关块
+    "SIMILARITY_THRESHOLDS": {
+        "hashing-fallback": 0.05
+    },
     # 检索数量
     "TOP_K": 5,
-    # 元数据过滤
+    # 批量查询时每次调用存储后端的查询数
+    "QUERY_BATCH_SIZE": 256,
+    # 默认元数据过滤条件（chromadb的where语法），例如只检索2020年以后中国CDC的资料：
+    # {"$and": [{"source_organization": "中国CDC"}, {"publication_date": {"$gt": "2020"}}]}
+    # 日期字段可以按区间比较，疾病标签写作 {"disease": "高血压"}
     "METADATA_FILTERS": None
 }
 
@@ -90,6 +293,17 @@ RAG_CONFIG = {
         "ENABLED": True,
         "THRESHOLD": 0.8,
         "INTENT_TYPES": ["medical_consultation", "chat", "greeting"]
+    },
+    # 批量召回配置（离线评估、缓存预热）
+    "BATCH_RETRIEVAL": {
+        "BATCH_SIZE": 256,  # 每批嵌入和检索的查询数
+        "QUEUE_SIZE": 2     # 已嵌入、等待检索的批数上限
+    },
+    # 启动预热配置：服务启动后在后台加载检索器（嵌入模型、BM25索引），端口立即可用
+    "WARMUP": {
+        "ENABLED": True,
+        "WAIT_SECONDS": 10,  # 医疗咨询请求到达时检索器尚未就绪，最多等待的秒数
+        "RETRY_SECONDS": 30  # 检索器加载失败后，距上次失败超过该秒数的请求触发后台重新加载
     }
 }
 
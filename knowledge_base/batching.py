@@ -0,0 +1,44 @@
+# 按长度分桶的动态批处理规划
+
+def plan_batches(lengths, max_tokens, max_batch_size):
+    """按token长度排序，在token预算内组批，返回原始索引的批次列表
+
+    每个批次的填充后大小（批内最大长度 × 批大小）不超过max_tokens，
+    批大小不超过max_batch_size。
+    """
+    # 从长到短排列，最耗内存的批次最先执行，问题可以尽早暴露
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    batches = []
+    current = []
+    current_max = 0
+    for idx in order:
+        length = max(lengths[idx], 1)
+        batch_max = max(current_max, length)
+        if current and (batch_max * (len(current) + 1) > max_tokens or len(current) >= max_batch_size):
+            batches.append(current)
+            current = []
+            batch_max = length
+        current.append(idx)
+        current_max = batch_max
+
+    if current:
+        batches.append(current)
+
+    return batches
+
+def fixed_batches(count, batch_size):
+    """按原始顺序、固定批大小组批（用于对比）"""
+    return [list(range(i, min(i + batch_size, count))) for i in range(0, count, batch_size)]
+
+def padding_efficiency(lengths, batches):
+    """有效token数占填充后token总数的比例"""
+    real_tokens = 0
+    padded_tokens = 0
+    for batch in batches:
+        if not batch:
+            continue
+        batch_lengths = [max(lengths[i], 1) for i in batch]
+        real_tokens += sum(batch_lengths)
+        padded_tokens += max(batch_lengths) * len(batch_lengths)
+    return real_tokens / padded_tokens if padded_tokens else 1.0
@@ -0,0 +1,302 @@
+# 知识库性能基准测试
+
+import time
+import random
+import argparse
+from knowledge_base.chunker import MedicalChunker
+
+# 用于合成长篇指南章节的句子素材
+GUIDELINE_SENTENCES = [
+    "高血压患者应定期监测血压，并记录每日的测量结果。",
+    "糖尿病患者需要控制碳水化合物的摄入量，避免血糖剧烈波动。",
+    "用药期间如出现头晕、乏力等不适，应及时就医。",
+    "老年患者的降压目标应根据个体情况适当放宽。",
+    "规律运动有助于改善胰岛素敏感性，建议每周至少运动150分钟。",
+    "Patients should monitor their blood pressure regularly.",
+    "Metformin is recommended as the first-line therapy for type 2 diabetes.",
+    "低盐饮食是高血压非药物治疗的重要措施！",
+    "是否需要调整剂量？应由医生根据检查结果决定。"
+]
+
+GUIDELINE_HEADINGS = ["一、", "二、", "症状：", "治疗：", "用药：", "注意事项：", "【饮食建议】"]
+
+def generate_section(length, seed=0):
+    """生成指定长度（字符数）的合成指南章节"""
+    rng = random.Random(seed)
+    paragraphs = []
+    total = 0
+    while total < length:
+        paragraph = "".join(rng.choice(GUIDELINE_SENTENCES) for _ in range(rng.randint(3, 12)))
+        if rng.random() < 0.3:
+            paragraph = rng.choice(GUIDELINE_HEADINGS) + paragraph
+        paragraphs.append(paragraph)
+        total += len(paragraph) + 2
+    return "\n\n".join(paragraphs)[:length]
+
+def generate_document(num_sections, section_length, seed=0):
+    """生成包含多个长章节的合成文档"""
+    return {
+        "source": "benchmark",
+        "filename": f"guideline_{seed}.pdf",
+        "metadata": {
+            "title": "合成指南",
+            "authors": ["Benchmark"],
+            "publication_date": "2024",
+            "source_organization": "benchmark"
+        },
+        "content": [
+            {"section": f"章节{i}", "content": generate_section(section_length, seed=seed * 1000 + i)}
+            for i in range(num_sections)
+        ],
+        "tables": []
+    }
+
+def benchmark_chunker(num_sections=20, section_length=200000, repeat=3, mode="char"):
+    """测试分块器在长章节上的吞吐量（块/秒）；token模式需要能加载嵌入模型的分词器"""
+    chunker = MedicalChunker(mode=mode)
+    document = generate_document(num_sections, section_length)
+    total_chars = sum(len(section["content"]) for section in document["content"])
+
+    best_elapsed = None
+    chunks = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = chunker.chunk_document(document)
+        elapsed = time.perf_counter() - start
+        if best_elapsed is None or elapsed < best_elapsed:
+            best_elapsed = elapsed
+
+    # 检查每个章节的结尾是否被保留
+    endings_kept = all(
+        any(chunk["content"].endswith(section["content"].strip()[-20:]) for chunk in chunks)
+        for section in document["content"]
+    )
+
+    result = {
+        "sections": num_sections,
+        "total_chars": total_chars,
+        "chunks": len(chunks),
+        "seconds": best_elapsed,
+        "chunks_per_sec": len(chunks) / best_elapsed if best_elapsed else 0.0,
+        "chars_per_sec": total_chars / best_elapsed if best_elapsed else 0.0,
+        "endings_kept": endings_kept
+    }
+
+    print(f"分块基准（{mode}模式）: {num_sections} 个章节, 共 {total_chars} 字符")
+    print(f"生成 {result['chunks']} 个块, 耗时 {best_elapsed:.3f} 秒")
+    print(f"吞吐量: {result['chunks_per_sec']:.0f} 块/秒, {result['chars_per_sec'] / 1e6:.2f} M字符/秒")
+    print(f"章节结尾完整保留: {endings_kept}")
+    return result
+
+def generate_mixed_texts(count, seed=0):
+    """生成长度混合的文本（短表格行 + 长正文块），模拟真实语料"""
+    rng = random.Random(seed)
+    texts = []
+    for i in range(count):
+        if rng.random() < 0.5:
+            texts.append("剂量：" + rng.choice(GUIDELINE_SENTENCES)[:rng.randint(8, 30)])
+        else:
+            texts.append(generate_section(rng.randint(100, 500), seed=seed * 100000 + i))
+    return texts
+
+def benchmark_batching(count=2000, embed=False):
+    """比较固定顺序批处理与按长度分桶批处理的填充效率（可选实际嵌入吞吐量）"""
+    from config.model_config import EMBEDDING_CONFIG
+    from knowledge_base.batching import plan_batches, fixed_batches, padding_efficiency
+
+    texts = generate_mixed_texts(count)
+    lengths = [min(len(text), EMBEDDING_CONFIG["MAX_LENGTH"]) for text in texts]
+
+    fixed = fixed_batches(len(texts), EMBEDDING_CONFIG["BATCH_SIZE"])
+    planned = plan_batches(lengths, EMBEDDING_CONFIG["MAX_BATCH_TOKENS"], EMBEDDING_CONFIG["MAX_BATCH_SIZE"])
+    result = {
+        "texts": len(texts),
+        "fixed_batches": len(fixed),
+        "fixed_padding_efficiency": padding_efficiency(lengths, fixed),
+        "planned_batches": len(planned),
+        "planned_padding_efficiency": padding_efficiency(lengths, planned)
+    }
+    print(f"批处理基准: {len(texts)} 个混合长度文本（按字符数估计长度）")
+    print(f"固定批次: {result['fixed_batches']} 批, 填充效率 {result['fixed_padding_efficiency']:.1%}")
+    print(f"分桶批次: {result['planned_batches']} 批, 填充效率 {result['planned_padding_efficiency']:.1%}")
+
+    if embed:
+        from knowledge_base.embedder import MedicalEmbedder
+        embedder = MedicalEmbedder()
+        if embedder.model is None:
+            print("模型加载失败，跳过实际嵌入测试")
+            return result
+
+        start = time.perf_counter()
+        embedder.model.encode(texts, batch_size=EMBEDDING_CONFIG["BATCH_SIZE"], show_progress_bar=False)
+        result["fixed_texts_per_sec"] = len(texts) / (time.perf_counter() - start)
+
+        embedder.encode_batched(texts)
+        result["planned_texts_per_sec"] = embedder.last_batch_stats["texts_per_sec"]
+        print(f"吞吐量: 固定批次 {result['fixed_texts_per_sec']:.1f} 文本/秒, "
+              f"分桶批次 {result['planned_texts_per_sec']:.1f} 文本/秒")
+
+    return result
+
+def benchmark_pool(count=4000, workers_list=(1, 2, 4, 8), threads_list=(1, 2, 4)):
+    """扫描 进程数 × 线程数 组合，测量多进程嵌入吞吐量"""
+    from knowledge_base.embedding_pool import EmbeddingPool
+
+    texts = generate_mixed_texts(count)
+    lengths = [len(text) for text in texts]
+    results = []
+
+    print(f"进程池基准: {len(texts)} 个混合长度文本")
+    print(f"{'进程数':>6} {'线程数':>6} {'文本/秒':>10}")
+    for num_workers in workers_list:
+        for threads in threads_list:
+            pool = EmbeddingPool(num_workers, threads)
+            try:
+                pool.start()
+                start = time.perf_counter()
+                pool.encode(texts, lengths)
+                elapsed = time.perf_counter() - start
+            except Exception as e:
+                print(f"{num_workers:>6} {threads:>6} 失败: {e}")
+                continue
+            finally:
+                pool.close()
+
+            result = {"workers": num_workers, "threads": threads, "texts_per_sec": len(texts) / elapsed}
+            results.append(result)
+            print(f"{num_workers:>6} {threads:>6} {result['texts_per_sec']:>10.1f}")
+
+    if results:
+        best = max(results, key=lambda item: item["texts_per_sec"])
+        print(f"最佳组合: {best['workers']} 进程 × {best['threads']} 线程, {best['texts_per_sec']:.1f} 文本/秒")
+    return results
+
+def build_synthetic_store(num_rows, dim, seed=0, backend="numpy"):
+    """在临时目录中创建随机向量的存储后端（NumPy或FAISS），返回 (存储, 向量矩阵, 临时目录)"""
+    import tempfile
+    import numpy as np
+    from knowledge_base.metrics import normalize_embeddings
+
+    rng = np.random.default_rng(seed)
+    # 存储后端要求入库前已归一化（与 VectorDatabase 一致）
+    vectors = normalize_embeddings(rng.standard_normal((num_rows, dim)))
+    directory = tempfile.mkdtemp(prefix="kb_benchmark_")
+    if backend == "faiss":
+        from knowledge_base.faiss_store import FaissStore
+        store = FaissStore(directory, "benchmark", dim, config={"INDEX_TYPE": "flat"})
+    else:
+        from knowledge_base.numpy_store import NumpyStore
+        store = NumpyStore(directory, "benchmark", dim)
+    store.create()
+    ids = [f"row_{i}" for i in range(num_rows)]
+    for start in range(0, num_rows, 50000):
+        end = min(start + 50000, num_rows)
+        store.write(ids[start:end], vectors[start:end], None, [{"chunk_type": "text"}] * (end - start))
+    store.flush()
+    return store, vectors, directory
+
+def benchmark_query_many(num_rows=100000, num_queries=1000, dim=512, top_k=5, batch_size=256, backend="numpy"):
+    """比较逐条查询与批量查询（query_many）的吞吐量"""
+    import shutil
+    import numpy as np
+    from knowledge_base.metrics import normalize_embeddings
+
+    store, vectors, directory = build_synthetic_store(num_rows, dim, backend=backend)
+    try:
+        rng = np.random.default_rng(1)
+        noise = 0.1 * rng.standard_normal((num_queries, dim)) / np.sqrt(dim)
+        queries = normalize_embeddings(vectors[rng.choice(num_rows, num_queries)] + noise)
+        print(f"批量查询基准: {backend}, {num_rows} 行 × {dim} 维, {num_queries} 个查询, top_k={top_k}")
+
+        start = time.perf_counter()
+        single = [store.query(query, top_k) for query in queries]
+        single_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched = []
+        for batch_start in range(0, num_queries, batch_size):
+            batched.extend(store.query_many(queries[batch_start:batch_start + batch_size], top_k))
+        batched_elapsed = time.perf_counter() - start
+
+        same = sum([hit[0] for hit in a] == [hit[0] for hit in b] for a, b in zip(single, batched))
+        print(f"逐条查询: {num_queries / single_elapsed:.1f} 查询/秒")
+        print(f"批量查询: {num_queries / batched_elapsed:.1f} 查询/秒（批大小 {batch_size}），"
+              f"加速 {single_elapsed / batched_elapsed:.1f} 倍，结果一致 {same}/{num_queries}")
+        return {"single_qps": num_queries / single_elapsed, "batched_qps": num_queries / batched_elapsed}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def benchmark_quantization(num_rows=200000, num_queries=500, dim=1024, top_k=5, rescore_factors=(1, 2, 4, 10),
+                           batch_size=256):
+    """int8量化 + 精确重排与float16精确检索的 recall@k、延迟和向量内存对比"""
+    import shutil
+    import numpy as np
+    from knowledge_base.metrics import normalize_embeddings
+
+    store, vectors, directory = build_synthetic_store(num_rows, dim)
+    try:
+        rng = np.random.default_rng(1)
+        noise = 0.5 * rng.standard_normal((num_queries, dim)) / np.sqrt(dim)
+        queries = normalize_embeddings(vectors[rng.choice(num_rows, num_queries)] + noise)
+        print(f"量化召回率基准: {num_rows} 行 × {dim} 维, {num_queries} 个查询, top_k={top_k}")
+        print(f"向量内存: float32 {num_rows * dim * 4 / 2**20:.0f} MB, float16 {store.matrix.nbytes / 2**20:.0f} MB")
+
+        def run():
+            start = time.perf_counter()
+            results = []
+            for batch_start in range(0, num_queries, batch_size):
+                results.extend(store.query_many(queries[batch_start:batch_start + batch_size], top_k))
+            return [[hit[0] for hit in hits] for hits in results], time.perf_counter() - start
+
+        exact, exact_elapsed = run()
+        print(f"float16精确检索: {num_queries / exact_elapsed:.1f} 查询/秒")
+
+        store.quantization = "int8"
+        store.write_codes()
+        print(f"int8矩阵: {store.codes.nbytes / 2**20:.0f} MB（float32的 {store.codes.nbytes / (num_rows * dim * 4):.0%}）")
+        report = {}
+        for factor in rescore_factors:
+            store.rescore_factor = factor
+            approx, elapsed = run()
+            recall = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(exact, approx) if a])
+            report[factor] = {"recall": recall, "qps": num_queries / elapsed}
+            print(f"int8 + 重排 {factor}×: recall@{top_k} = {recall:.4f}, {num_queries / elapsed:.1f} 查询/秒")
+        return report
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="知识库性能基准测试")
+    parser.add_argument('target', nargs='?', default='chunker', choices=['chunker', 'batching', 'pool', 'query', 'quantization'], help='测试项目')
+    parser.add_argument('--sections', type=int, default=20, help='章节数量')
+    parser.add_argument('--section-length', type=int, default=200000, help='每个章节的字符数')
+    parser.add_argument('--repeat', type=int, default=3, help='重复次数（取最快一次）')
+    parser.add_argument('--chunk-mode', default='char', choices=['char', 'token'], help='分块长度计量方式')
+    parser.add_argument('--count', type=int, default=2000, help='文本数量')
+    parser.add_argument('--embed', action='store_true', help='加载模型测量实际嵌入吞吐量')
+    parser.add_argument('--workers', default='1,2,4,8', help='进程数列表（逗号分隔）')
+    parser.add_argument('--threads', default='1,2,4', help='每进程线程数列表（逗号分隔）')
+    parser.add_argument('--rows', type=int, default=100000, help='向量库行数')
+    parser.add_argument('--dim', type=int, default=512, help='向量维度')
+    parser.add_argument('--batch-size', type=int, default=256, help='批量查询的批大小')
+    parser.add_argument('--backend', default='numpy', choices=['numpy', 'faiss'], help='存储后端')
+    args = parser.parse_args()
+
+    if args.target == 'chunker':
+        benchmark_chunker(args.sections, args.section_length, args.repeat, mode=args.chunk_mode)
+    elif args.target == 'batching':
+        benchmark_batching(args.count, args.embed)
+    elif args.target == 'pool':
+        benchmark_pool(
+            args.count,
+            [int(value) for value in args.workers.split(',')],
+            [int(value) for value in args.threads.split(',')]
+        )
+    elif args.target == 'query':
+        benchmark_query_many(args.rows, args.count, args.dim, batch_size=args.batch_size, backend=args.backend)
+    elif args.target == 'quantization':
+        benchmark_quantization(args.rows, args.count, args.dim, batch_size=args.batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# bge-m3 稠密 + 稀疏词权重联合推理后端（FlagEmbedding）
+
+import numpy as np
+
+class BGEM3Model:
+    """一次前向推理同时输出稠密向量和稀疏词权重，encode() 与 SentenceTransformer.encode 接口兼容"""
+
+    def __init__(self, model_path, device="cpu", use_fp16=False, max_length=512, min_weight=0.0):
+        from FlagEmbedding import BGEM3FlagModel
+
+        try:
+            self.model = BGEM3FlagModel(model_path, use_fp16=use_fp16, device=device)
+        except TypeError:
+            # 新版FlagEmbedding使用devices参数
+            self.model = BGEM3FlagModel(model_path, use_fp16=use_fp16, devices=device)
+        self.tokenizer = self.model.tokenizer
+        self.max_seq_length = max_length
+        self.min_weight = min_weight
+
+    def to_sparse(self, lexical_weights):
+        """将 {token_id字符串: 权重} 转换为 {token_id: 权重}，丢弃过小的权重"""
+        return {
+            int(token_id): float(weight)
+            for token_id, weight in lexical_weights.items()
+            if weight > self.min_weight
+        }
+
+    def encode_hybrid(self, sentences, batch_size=32):
+        """编码文本，返回 (L2归一化的稠密向量矩阵, 稀疏词权重列表)"""
+        if not sentences:
+            return np.zeros((0, 0), dtype=np.float32), []
+        output = self.model.encode(
+            sentences,
+            batch_size=batch_size,
+            max_length=self.max_seq_length,
+            return_dense=True,
+            return_sparse=True,
+            return_colbert_vecs=False
+        )
+        dense = np.asarray(output["dense_vecs"], dtype=np.float32)
+        sparse = [self.to_sparse(weights) for weights in output["lexical_weights"]]
+        return dense, sparse
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, convert_to_tensor=False, **kwargs):
+        """只返回稠密向量（兼容现有调用方）"""
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        dense, _ = self.encode_hybrid(sentences, batch_size=batch_size)
+        return dense[0] if single else dense
@@ -0,0 +1,125 @@
+# ChromaDB 存储后端
+
+import os
+import chromadb
+from knowledge_base.metrics import check_metric
+
+class ChromaStore:
+    """VectorDatabase 的 ChromaDB 后端
+
+    所有存储后端提供相同的接口：exists/create/open/drop/count/existing_ids/max_batch_size/
+    write/query/query_many/get/update/delete/tombstone_ratio/compact/flush。query 返回 [(ID, 距离, 正文, 元数据)]，距离越小越相似，
+    query_many 对每个查询返回一个这样的列表。
+
+    集合创建时显式声明距离度量（hnsw:space），不再使用chromadb默认的l2；向量由 VectorDatabase 在入库和查询时L2归一化。
+    """
+
+    def __init__(self, persist_directory, collection_name, dim, read_only=False, metric="cosine"):
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name
+        self.dim = dim
+        self.read_only = read_only
+        self.declared_metric = check_metric(metric)
+        self.collection = None
+
+        # 创建持久化目录，初始化ChromaDB客户端（使用新的PersistentClient）
+        os.makedirs(self.persist_directory, exist_ok=True)
+        self.client = chromadb.PersistentClient(path=self.persist_directory)
+
+    @property
+    def metric(self):
+        """集合使用的距离度量（以集合元数据为准；未声明度量的旧集合为chromadb默认的l2）"""
+        if self.collection is None:
+            return self.declared_metric
+        return (self.collection.metadata or {}).get("hnsw:space", "l2")
+
+    def exists(self):
+        """集合是否存在"""
+        # 新版chromadb的list_collections直接返回名称
+        collection_names = [getattr(col, "name", col) for col in self.client.list_collections()]
+        return self.collection_name in collection_names
+
+    def create(self):
+        """创建新集合"""
+        # 嵌入向量由MedicalEmbedder计算，显式禁用chromadb默认的ONNX嵌入函数
+        self.collection = self.client.create_collection(
+            name=self.collection_name,
+            metadata={"description": "Medical knowledge base", "hnsw:space": self.declared_metric},
+            embedding_function=None
+        )
+
+    def open(self):
+        """打开已有集合"""
+        self.collection = self.client.get_collection(self.collection_name, embedding_function=None)
+
+    def drop(self):
+        """删除集合"""
+        if self.exists():
+            self.client.delete_collection(self.collection_name)
+        self.collection = None
+
+    def count(self):
+        """文本块数量"""
+        return self.collection.count()
+
+    def existing_ids(self, ids, batch_size=1000):
+        """返回已存在的ID集合"""
+        existing_ids = set()
+        for i in range(0, len(ids), batch_size):
+            result = self.collection.get(ids=ids[i:i+batch_size], include=[])
+            existing_ids.update(result["ids"])
+        return existing_ids
+
+    def max_batch_size(self):
+        """单次写入的行数上限"""
+        if hasattr(self.client, "get_max_batch_size"):
+            return self.client.get_max_batch_size()
+        return getattr(self.client, "max_batch_size", None)
+
+    def write(self, ids, embeddings, documents, metadatas, upsert=False):
+        """写入一批向量"""
+        write = self.collection.upsert if upsert else self.collection.add
+        write(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def query(self, embedding, top_k, where=None):
+        """向量检索"""
+        return self.query_many([embedding], top_k, where)[0]
+
+    def query_many(self, embeddings, top_k, where=None):
+        """批量向量检索（一次调用），返回每个查询的结果列表"""
+        results = self.collection.query(query_embeddings=list(embeddings), n_results=top_k, where=where)
+        return [list(zip(*columns)) for columns in zip(results["ids"], results["distances"],
+                                                       results["documents"], results["metadatas"])]
+
+    def get(self, ids):
+        """按ID取回正文和元数据，返回 {ID: (正文, 元数据)}"""
+        stored = self.collection.get(ids=ids, include=["documents", "metadatas"])
+        return {doc_id: (content, metadata) for doc_id, content, metadata
+                in zip(stored["ids"], stored["documents"], stored["metadatas"])}
+
+    def update(self, doc_id, document=None, metadata=None, embedding=None):
+        """更新单个文本块"""
+        update_data = {}
+        if document is not None:
+            update_data["documents"] = [document]
+        if metadata is not None:
+            update_data["metadatas"] = [metadata]
+        if embedding is not None:
+            update_data["embeddings"] = [embedding]
+        self.collection.update(ids=[doc_id], **update_data)
+
+    def delete(self, ids):
+        """删除文本块"""
+        self.collection.delete(ids=ids)
+
+    def tombstone_ratio(self):
+        """chromadb自行回收删除的空间"""
+        return 0.0
+
+    def compact(self):
+        """chromadb自行回收删除的空间，无需额外操作"""
+        return 0
+
+    def flush(self):
+        """PersistentClient自动持久化，无需额外操作"""
+        pass
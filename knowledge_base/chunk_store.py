@@ -0,0 +1,235 @@
+# 紧凑的文本块表示：文档元数据只存储一次
+
+import os
+import sys
+import json
+
+# 文档级元数据字段（由同一文档的所有块共享）
+DOCUMENT_FIELDS = ("document_title", "source", "source_organization", "publication_date", "authors")
+
+# 块级元数据字段（存储在块自身的槽位中）
+CHUNK_FIELDS = ("section_title", "chunk_type", "chunk_index")
+
+class DocumentTable:
+    """共享文档元数据表，按整数ID引用"""
+
+    def __init__(self):
+        self.documents = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.documents)
+
+    def document_key(self, document):
+        """文档的唯一标识"""
+        return f"{document.get('source', '')}/{document.get('filename', '')}"
+
+    def add(self, document):
+        """登记原始文档，返回文档ID（同一文档只登记一次）"""
+        metadata = document.get('metadata', {})
+        return self.add_metadata(self.document_key(document), {
+            "document_title": metadata.get('title', ''),
+            "source": document.get('source', ''),
+            "source_organization": metadata.get('source_organization', ''),
+            "publication_date": metadata.get('publication_date', ''),
+            "authors": list(metadata.get('authors', []))
+        })
+
+    def add_metadata(self, key, metadata):
+        """按文档键登记文档级元数据，返回文档ID"""
+        doc_id = self.index.get(key)
+        if doc_id is None:
+            doc_id = len(self.documents)
+            entry = {field: metadata.get(field, '') for field in DOCUMENT_FIELDS}
+            entry["key"] = key
+            # 驻留常用字符串，多个文档共享同一份
+            for field in ("source", "source_organization", "publication_date"):
+                if isinstance(entry[field], str):
+                    entry[field] = sys.intern(entry[field])
+            self.documents.append(entry)
+            self.index[key] = doc_id
+        return doc_id
+
+    def get(self, doc_id):
+        """获取文档级元数据（不含内部键）"""
+        entry = self.documents[doc_id]
+        return {field: entry[field] for field in DOCUMENT_FIELDS}
+
+    def merge(self, other):
+        """合并另一张文档表，返回 {对方文档ID: 本表文档ID} 的映射"""
+        mapping = {}
+        for other_id, entry in enumerate(other.documents):
+            mapping[other_id] = self.add_metadata(entry["key"], entry)
+        return mapping
+
+    def save(self, path):
+        """保存文档表"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.documents, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """加载文档表，文件不存在时返回空表"""
+        table = cls()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for entry in json.load(f):
+                    table.add_metadata(entry["key"], entry)
+        return table
+
+class ChunkMetadata(dict):
+    """chunk['metadata'] 返回的元数据视图：修改会写回文本块（兼容字典块的 chunk['metadata'][key] = value 写法）
+
+    文档级和块级字段不能删除，删除后写回时恢复原值。嵌套值（如作者列表）的原地修改不会写回。
+    """
+
+    def __init__(self, chunk):
+        super().__init__(chunk.metadata)
+        self.chunk = chunk
+
+    def write_back(self):
+        """把视图内容写回文本块，再按文本块的实际元数据刷新视图"""
+        self.chunk.set_metadata(dict(self))
+        super().clear()
+        super().update(self.chunk.metadata)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.write_back()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.write_back()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.write_back()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        value = super().pop(key, *default)
+        self.write_back()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self.write_back()
+        return item
+
+    def clear(self):
+        super().clear()
+        self.write_back()
+
+class Chunk:
+    """文本块，通过文档ID引用共享文档表，元数据在访问时才拼接"""
+
+    __slots__ = ("id", "content", "doc_id", "section_title", "chunk_type", "chunk_index",
+                 "extra", "embedding", "sparse", "table")
+
+    def __init__(self, id, content, doc_id, table, section_title='', chunk_type='text',
+                 chunk_index=None, extra=None, embedding=None, sparse=None):
+        self.id = id
+        self.content = content
+        self.doc_id = doc_id
+        self.table = table
+        self.section_title = sys.intern(section_title)
+        self.chunk_type = chunk_type
+        self.chunk_index = chunk_index
+        self.extra = extra
+        self.embedding = embedding
+        # bge-m3稀疏词权重 {token_id: weight}，只在入库前存在
+        self.sparse = sparse
+
+    @property
+    def metadata(self):
+        """拼接完整元数据（文档级 + 块级 + 附加字段），返回新的字典，修改不会写回（写回使用 chunk['metadata'] 或 set_metadata）"""
+        metadata = self.table.get(self.doc_id)
+        metadata.update(self.chunk_metadata())
+        if self.extra:
+            metadata.update(self.extra)
+        return metadata
+
+    def chunk_metadata(self):
+        """块级元数据"""
+        metadata = {"section_title": self.section_title, "chunk_type": self.chunk_type}
+        if self.chunk_index is not None:
+            metadata["chunk_index"] = self.chunk_index
+        return metadata
+
+    def compact_metadata(self):
+        """入库用的紧凑元数据：只保留文档ID、来源、机构和块级字段"""
+        document = self.table.documents[self.doc_id]
+        metadata = {"doc_id": self.doc_id, "source": document["source"],
+                    "source_organization": document["source_organization"]}
+        metadata.update(self.chunk_metadata())
+        if self.extra:
+            metadata.update(self.extra)
+        return metadata
+
+    def set_metadata(self, metadata):
+        """用完整元数据更新块，与文档表相同的字段不重复存储"""
+        document = self.table.get(self.doc_id)
+        extra = {}
+        for key, value in metadata.items():
+            if key in CHUNK_FIELDS:
+                setattr(self, key, value)
+            elif key in DOCUMENT_FIELDS and document.get(key) == value:
+                continue
+            else:
+                extra[key] = value
+        self.extra = extra or None
+
+    # 兼容字典式访问，现有代码可以继续使用 chunk['content'] 等写法
+    def __getitem__(self, key):
+        if key == "metadata":
+            return ChunkMetadata(self)
+        if key in ("id", "content") or (key in ("embedding", "sparse") and getattr(self, key) is not None):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == "metadata":
+            self.set_metadata(value)
+        elif key in ("id", "content", "embedding", "sparse"):
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in ("id", "content", "metadata") or (key in ("embedding", "sparse") and getattr(self, key) is not None)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = ["id", "content", "metadata"]
+        if self.embedding is not None:
+            keys.append("embedding")
+        if self.sparse is not None:
+            keys.append("sparse")
+        return keys
+
+    def copy(self):
+        """浅拷贝（共享文档表）"""
+        return Chunk(self.id, self.content, self.doc_id, self.table, self.section_title,
+                     self.chunk_type, self.chunk_index, dict(self.extra) if self.extra else None,
+                     self.embedding, self.sparse)
+
+    def to_dict(self):
+        """转换为完整的字典表示"""
+        chunk = {"id": self.id, "content": self.content, "metadata": self.metadata}
+        if self.embedding is not None:
+            chunk["embedding"] = self.embedding
+        if self.sparse is not None:
+            chunk["sparse"] = self.sparse
+        return chunk
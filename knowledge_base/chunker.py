@@ -1,13 +1,52 @@
 # 文本分块器
 
 import re
-import uuid
+import hashlib
+from bisect import bisect_right
 from config.model_config import EMBEDDING_CONFIG
+from knowledge_base.chunk_store import Chunk, DocumentTable
+
+# 医疗文档语义单元标识（合并为一个预编译的交替模式，每个段落只需匹配一次）
+SEMANTIC_MARKERS = [
+    r'[一二三四五六七八九十]+[、.]',  # 中文数字序号
+    r'\d+[、.]',  # 阿拉伯数字序号
+    r'[A-Za-z]+[、.]',  # 字母序号
+    r'【[^】]+】',  # 中文括号标题
+    r'\([^)]+\)',  # 英文括号标题
+    r'(?:症状|病因|诊断|治疗|用药|剂量|禁忌|注意事项|副作用|预防|饮食|运动|预后)[:：]'
+]
+SEMANTIC_MARKER_PATTERN = re.compile(r'\s*(?:' + '|'.join(SEMANTIC_MARKERS) + ')')
+
+# 段落分隔与句子边界
+PARAGRAPH_SPLIT_PATTERN = re.compile(r'[\n\r]+\s*[\n\r]+')
+SENTENCE_END_PATTERN = re.compile(r'[。！？.!?]\s*')
 
 class MedicalChunker:
-    def __init__(self):
+    def __init__(self, token_counter=None, mode=None):
         self.max_chunk_size = EMBEDDING_CONFIG.get("MAX_LENGTH", 512)
         self.overlap_size = 100
+        
+        # 共享文档元数据表，块通过文档ID引用
+        self.documents = DocumentTable()
+        
+        # 分块长度计量方式：按字符或按嵌入模型的token数（mode显式指定时覆盖配置）
+        chunking_config = EMBEDDING_CONFIG.get("CHUNKING", {})
+        self.mode = mode or chunking_config.get("MODE", "char")
+        self.target_tokens = chunking_config.get("TARGET_TOKENS", self.max_chunk_size)
+        self.overlap_tokens = chunking_config.get("OVERLAP_TOKENS", 64)
+        self.token_counter = token_counter
+        
+        if self.mode == "token" and self.token_counter is None:
+            try:
+                from knowledge_base.token_counter import TokenCounter
+                self.token_counter = TokenCounter()
+            except Exception as e:
+                # 按字符分块得到的块和块ID都不同，默认不静默降级；允许降级时由构建流程记录到集合schema中
+                if not chunking_config.get("ALLOW_CHAR_FALLBACK", False):
+                    raise RuntimeError(f"token分块模式无法加载分词器: {e}"
+                                       f"（安装分词器或将 CHUNKING.MODE 设为 \"char\"）") from e
+                print(f"警告: 分词器加载失败（{e}），按字符数分块，块ID与token模式不同")
+                self.mode = "char"
     
     def chunk_document(self, document):
         """对整个文档进行分块"""
@@ -15,19 +54,30 @@ class MedicalChunker:
         
         # 处理文档内容
         if document.get('content'):
+            # 同名章节按出现次序区分，保证章节路径在文档内唯一
+            title_counts = {}
             for section in document['content']:
-                section_chunks = self.chunk_section(section, document)
+                section_title = section.get('section', '')
+                title_counts[section_title] = title_counts.get(section_title, 0) + 1
+                section_path = f"{section_title}#{title_counts[section_title]}"
+                section_chunks = self.chunk_section(section, document, section_path)
                 chunks.extend(section_chunks)
         
         # 处理表格
         if document.get('tables'):
-            for table in document['tables']:
-                table_chunks = self.chunk_table(table, document)
+            for table_index, table in enumerate(document['tables']):
+                table_chunks = self.chunk_table(table, document, f"table#{table_index}")
                 chunks.extend(table_chunks)
         
         return chunks
     
-    def chunk_section(self, section, document):
+    def make_chunk_id(self, document, section_path, offset, content):
+        """根据文档标识、章节路径、偏移和内容哈希生成确定性ID，相同文本重复分块得到相同ID"""
+        key = "\x1f".join([document['source'], document['filename'], section_path, str(offset), content])
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return f"{document['source']}_{document['filename']}_{digest}"
+    
+    def chunk_section(self, section, document, section_path=None):
         """对章节进行分块"""
         chunks = []
         content = section.get('content', '')
@@ -36,54 +86,43 @@ class MedicalChunker:
         if not content:
             return chunks
         
+        if section_path is None:
+            section_path = section_title
+        
+        doc_id = self.documents.add(document)
+        
         # 按医疗文档语义结构切分
         semantic_chunks = self.semantic_split(content)
         
+        # token模式下一次性批量计算整个章节所有句子的token数，并把相邻的短语义单元打包到token预算内
+        packed = [False] * len(semantic_chunks)
+        if self.mode == "token":
+            self.token_counter.count_many([
+                sentence
+                for semantic_chunk in semantic_chunks
+                for sentence in self.sentences(semantic_chunk)
+            ])
+            semantic_chunks, packed = self.pack_units(semantic_chunks)
+        
         for i, semantic_chunk in enumerate(semantic_chunks):
-                # 检查大小
-                if len(semantic_chunk) > self.max_chunk_size:
-                    # 进一步切分
-                    sub_chunks = self.size_split(semantic_chunk)
-                    for j, sub_chunk in enumerate(sub_chunks):
-                        # 使用UUID生成唯一ID
-                        unique_id = str(uuid.uuid4())[:8]
-                        chunk = {
-                            "id": f"{document['source']}_{document['filename']}_{unique_id}",
-                            "content": sub_chunk,
-                            "metadata": {
-                                "document_title": document['metadata'].get('title', ''),
-                                "section_title": section_title,
-                                "source": document['source'],
-                                "source_organization": document['metadata'].get('source_organization', ''),
-                                "publication_date": document['metadata'].get('publication_date', ''),
-                                "authors": document['metadata'].get('authors', []),
-                                "chunk_type": "text",
-                                "chunk_index": i * 100 + j
-                            }
-                        }
-                        chunks.append(chunk)
-                else:
-                    # 使用UUID生成唯一ID
-                    unique_id = str(uuid.uuid4())[:8]
-                    chunk = {
-                        "id": f"{document['source']}_{document['filename']}_{unique_id}",
-                        "content": semantic_chunk,
-                        "metadata": {
-                            "document_title": document['metadata'].get('title', ''),
-                            "section_title": section_title,
-                            "source": document['source'],
-                            "source_organization": document['metadata'].get('source_organization', ''),
-                            "publication_date": document['metadata'].get('publication_date', ''),
-                            "authors": document['metadata'].get('authors', []),
-                            "chunk_type": "text",
-                            "chunk_index": i
-                        }
-                    }
-                    chunks.append(chunk)
+            # 打包后的块已在token预算内，不再切分
+            spans = [(0, len(semantic_chunk))] if packed[i] else self.split_spans(semantic_chunk)
+            for j, (start, end) in enumerate(spans):
+                chunk_content = semantic_chunk[start:end]
+                chunk = Chunk(
+                    id=self.make_chunk_id(document, section_path, f"{i}:{start}", chunk_content),
+                    content=chunk_content,
+                    doc_id=doc_id,
+                    table=self.documents,
+                    section_title=section_title,
+                    chunk_type="text",
+                    chunk_index=i * 100 + j if len(spans) > 1 else i
+                )
+                chunks.append(chunk)
         
         return chunks
     
-    def chunk_table(self, table, document):
+    def chunk_table(self, table, document, table_path=None):
         """对表格进行分块"""
         chunks = []
         content = table.get('content', '')
@@ -92,20 +131,18 @@ class MedicalChunker:
         if not content:
             return chunks
         
+        if table_path is None:
+            table_path = f"table#{section_title}"
+        
         # 表格内容通常较短，直接作为一个块
-        chunk = {
-            "id": f"{document['source']}_{document['filename']}_table",
-            "content": content,
-            "metadata": {
-                "document_title": document['metadata'].get('title', ''),
-                "section_title": section_title,
-                "source": document['source'],
-                "source_organization": document['metadata'].get('source_organization', ''),
-                "publication_date": document['metadata'].get('publication_date', ''),
-                "authors": document['metadata'].get('authors', []),
-                "chunk_type": "table"
-            }
-        }
+        chunk = Chunk(
+            id=self.make_chunk_id(document, table_path, 0, content),
+            content=content,
+            doc_id=self.documents.add(document),
+            table=self.documents,
+            section_title=section_title,
+            chunk_type="table"
+        )
         chunks.append(chunk)
         
         return chunks
@@ -114,7 +151,7 @@ class MedicalChunker:
         """按语义切分文本"""
         # 医疗文档语义切分规则
         # 1. 按段落切分
-        paragraphs = re.split(r'[\n\r]+\s*[\n\r]+', text)
+        paragraphs = PARAGRAPH_SPLIT_PATTERN.split(text)
         
         # 2. 按医疗文档结构切分
         semantic_chunks = []
@@ -140,67 +177,133 @@ class MedicalChunker:
         
         return semantic_chunks
     
+    def pack_units(self, units):
+        """把相邻的语义单元贪心合并为不超过target_tokens的块
+        
+        返回 (块文本列表, 是否由多个单元合并)；超过预算的单元单独成块，由split_spans按句子切分。
+        """
+        counts = self.token_counter.count_many(units)
+        texts = []
+        packed = []
+        group = []
+        total = 0
+        for unit, count in zip(units, counts):
+            if group and total + count > self.target_tokens:
+                texts.append("\n".join(group))
+                packed.append(len(group) > 1)
+                group = []
+                total = 0
+            group.append(unit)
+            total += count
+        if group:
+            texts.append("\n".join(group))
+            packed.append(len(group) > 1)
+        return texts, packed
+    
     def is_new_semantic_unit(self, paragraph):
         """判断是否为新的语义单元"""
-        # 医疗文档语义单元标识
-        semantic_markers = [
-            r'^\s*[一二三四五六七八九十]+[、.]',  # 中文数字序号
-            r'^\s*\d+[、.]',  # 阿拉伯数字序号
-            r'^\s*[A-Za-z]+[、.]',  # 字母序号
-            r'^\s*【[^】]+】',  # 中文括号标题
-            r'^\s*\([^)]+\)',  # 英文括号标题
-            r'^\s*症状[:：]',
-            r'^\s*病因[:：]',
-            r'^\s*诊断[:：]',
-            r'^\s*治疗[:：]',
-            r'^\s*用药[:：]',
-            r'^\s*剂量[:：]',
-            r'^\s*禁忌[:：]',
-            r'^\s*注意事项[:：]',
-            r'^\s*副作用[:：]',
-            r'^\s*预防[:：]',
-            r'^\s*饮食[:：]',
-            r'^\s*运动[:：]',
-            r'^\s*预后[:：]'
-        ]
-        
-        for marker in semantic_markers:
-            if re.match(marker, paragraph):
-                return True
-        
-        return False
+        return SEMANTIC_MARKER_PATTERN.match(paragraph) is not None
+    
+    def sentence_boundaries(self, text):
+        """一次正向扫描获取所有句子边界（句末标点及其后空白之后的位置）"""
+        return [match.end() for match in SENTENCE_END_PATTERN.finditer(text)]
+    
+    def sentences(self, text):
+        """按句子边界切分文本"""
+        return [text[start:end] for start, end in self.sentence_spans(text)]
+    
+    def sentence_spans(self, text):
+        """返回每个句子的 (起始, 结束) 位置"""
+        spans = []
+        start = 0
+        for end in self.sentence_boundaries(text):
+            spans.append((start, end))
+            start = end
+        if start < len(text):
+            spans.append((start, len(text)))
+        return spans
+    
+    def split_spans(self, text):
+        """按当前分块模式切分语义块，返回每个块的 (起始, 结束) 位置"""
+        if self.mode == "token":
+            return self.token_split_spans(text)
+        if len(text) > self.max_chunk_size:
+            return self.size_split_spans(text)
+        return [(0, len(text))]
     
     def size_split(self, text):
         """按大小切分文本"""
-        chunks = []
-        current_pos = 0
+        return [text[start:end] for start, end in self.size_split_spans(text)]
+    
+    def size_split_spans(self, text):
+        """按大小切分文本，返回每个块的 (起始, 结束) 位置"""
+        spans = []
         text_length = len(text)
-        max_iterations = 100  # 防止无限循环
-        iteration_count = 0
+        boundaries = self.sentence_boundaries(text)
+        current_pos = 0
         
-        while current_pos < text_length and iteration_count < max_iterations:
-            iteration_count += 1
+        while current_pos < text_length:
             end_pos = min(current_pos + self.max_chunk_size, text_length)
             
-            # 尝试在句子边界切分
+            # 尝试在窗口内最后一个句子边界处切分
             if end_pos < text_length:
-                # 寻找最近的句子结束符
-                sentence_end = re.search(r'[。！？.!?]\s*', text[current_pos:end_pos][::-1])
-                if sentence_end:
-                    end_pos = end_pos - sentence_end.start()
+                index = bisect_right(boundaries, end_pos) - 1
+                if index >= 0 and boundaries[index] > current_pos:
+                    end_pos = boundaries[index]
             
-            # 确保有重叠
-            chunk = text[current_pos:end_pos]
-            chunks.append(chunk)
+            spans.append((current_pos, end_pos))
+            if end_pos >= text_length:
+                break
             
-            # 计算下一个位置，确保前进
+            # 计算下一个位置，确保有重叠且前进
             next_pos = end_pos - self.overlap_size
             if next_pos <= current_pos:
-                # 如果没有前进，强制前进
                 next_pos = end_pos
             current_pos = next_pos
         
-        return chunks
+        return spans
+    
+    def token_split_spans(self, text):
+        """按token预算打包句子，相邻块之间保留基于token数的重叠"""
+        # 以句子为基本单元，超长句子再按token切分
+        units = []
+        counts = []
+        for start, end in self.sentence_spans(text):
+            count = self.token_counter.count(text[start:end])
+            if count > self.target_tokens:
+                for sub_start, sub_end in self.token_counter.token_spans(text[start:end], self.target_tokens):
+                    units.append((start + sub_start, start + sub_end))
+                    counts.append(self.token_counter.count(text[start + sub_start:start + sub_end]))
+            else:
+                units.append((start, end))
+                counts.append(count)
+        
+        if not units:
+            return []
+        
+        spans = []
+        i = 0
+        while i < len(units):
+            # 贪心地装入句子，直到达到token预算
+            j = i
+            total = 0
+            while j < len(units) and (j == i or total + counts[j] <= self.target_tokens):
+                total += counts[j]
+                j += 1
+            
+            spans.append((units[i][0], units[j - 1][1]))
+            if j >= len(units):
+                break
+            
+            # 从块尾部回退若干句子作为下一块的开头，重叠不超过overlap_tokens
+            k = j
+            overlap = 0
+            while k - 1 > i and overlap + counts[k - 1] <= self.overlap_tokens:
+                overlap += counts[k - 1]
+                k -= 1
+            i = k
+        
+        return spans
     
     def chunk_multiple_documents(self, documents):
         """对多个文档进行分块"""
@@ -240,6 +343,7 @@ if __name__ == "__main__":
     chunks = chunker.chunk_document(sample_document)
     print(f"生成了 {len(chunks)} 个块")
     for i, chunk in enumerate(chunks):
-        print(f"块 {i+1}: {len(chunk['content'])} 字符")
-        print(f"内容: {chunk['content'][:100]}...")
+        print(f"块 {i+1}: {len(chunk.content)} 字符")
+        print(f"内容: {chunk.content[:100]}...")
+        print(f"元数据: {chunk.metadata}")
         print()
@@ -0,0 +1,152 @@
+# 文本块去重（精确哈希 + MinHash LSH）
+
+import re
+import zlib
+import hashlib
+import numpy as np
+from config.model_config import DEDUP_CONFIG
+
+# MinHash使用的梅森素数，保证 a*x+b 在uint64内不溢出
+MERSENNE_PRIME = (1 << 31) - 1
+
+class ChunkDeduplicator:
+    def __init__(self):
+        self.enabled = DEDUP_CONFIG["ENABLED"]
+        self.shingle_size = DEDUP_CONFIG["SHINGLE_SIZE"]
+        self.num_perm = DEDUP_CONFIG["NUM_PERM"]
+        self.bands = DEDUP_CONFIG["BANDS"]
+        self.threshold = DEDUP_CONFIG["THRESHOLD"]
+        self.rows = self.num_perm // self.bands
+
+        # 固定随机种子，保证多次构建结果一致
+        rng = np.random.RandomState(DEDUP_CONFIG["SEED"])
+        self.perm_a = rng.randint(1, MERSENNE_PRIME, size=self.num_perm).astype(np.uint64)
+        self.perm_b = rng.randint(0, MERSENNE_PRIME, size=self.num_perm).astype(np.uint64)
+
+        self.stats = {}
+
+    def normalize(self, text):
+        """规范化文本：去除空白并统一大小写"""
+        return re.sub(r'\s+', '', text).lower()
+
+    def shingles(self, text):
+        """将文本切分为字符shingle并哈希为整数数组"""
+        k = self.shingle_size
+        if len(text) < k:
+            return None
+        hashes = {zlib.crc32(text[i:i + k].encode('utf-8')) for i in range(len(text) - k + 1)}
+        return np.fromiter(hashes, dtype=np.uint64, count=len(hashes)) % MERSENNE_PRIME
+
+    def minhash(self, shingle_hashes):
+        """计算MinHash签名"""
+        values = (self.perm_a[:, None] * shingle_hashes[None, :] + self.perm_b[:, None]) % MERSENNE_PRIME
+        return values.min(axis=1)
+
+    def deduplicate(self, chunks):
+        """合并精确重复和近似重复的文本块，返回规范块列表"""
+        if not self.enabled or not chunks:
+            return chunks
+
+        parent = list(range(len(chunks)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        def union(i, j):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                # 以先出现的块作为规范块
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+        # 1. 精确去重
+        normalized_texts = [self.normalize(chunk.get('content', '')) for chunk in chunks]
+        exact_index = {}
+        exact_duplicates = 0
+        for i, text in enumerate(normalized_texts):
+            digest = hashlib.sha1(text.encode('utf-8')).digest()
+            if digest in exact_index:
+                union(i, exact_index[digest])
+                exact_duplicates += 1
+            else:
+                exact_index[digest] = i
+
+        # 2. 近似去重：MinHash签名 + LSH分桶
+        representatives = sorted(exact_index.values())
+        signatures = {}
+        for i in representatives:
+            shingle_hashes = self.shingles(normalized_texts[i])
+            if shingle_hashes is not None:
+                signatures[i] = self.minhash(shingle_hashes)
+
+        buckets = {}
+        for i, signature in signatures.items():
+            for band in range(self.bands):
+                band_key = (band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                buckets.setdefault(band_key, []).append(i)
+
+        # 桶内所有成员两两比较（不只与第一个成员比较），已在同一组中的成员跳过
+        near_duplicates = 0
+        checked_pairs = set()
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            for position, other in enumerate(members[1:], start=1):
+                for first in members[:position]:
+                    pair = (first, other)
+                    if pair in checked_pairs or find(first) == find(other):
+                        continue
+                    checked_pairs.add(pair)
+                    # 用签名估计Jaccard相似度，过滤LSH误报
+                    similarity = float(np.mean(signatures[first] == signatures[other]))
+                    if similarity >= self.threshold:
+                        union(first, other)
+                        near_duplicates += 1
+
+        # 3. 合并为规范块，并记录所有来源
+        groups = {}
+        for i in range(len(chunks)):
+            groups.setdefault(find(i), []).append(i)
+
+        deduplicated = []
+        for root in sorted(groups):
+            members = groups[root]
+            chunk = chunks[root]
+            if len(members) > 1:
+                chunk = chunk.copy()
+                metadata = dict(chunk.get('metadata', {}))
+                sources = []
+                for member in members:
+                    source = chunks[member].get('metadata', {}).get('source', '')
+                    if source and source not in sources:
+                        sources.append(source)
+                metadata['sources'] = sources
+                metadata['duplicate_ids'] = [chunks[member]['id'] for member in members[1:]]
+                chunk['metadata'] = metadata
+            deduplicated.append(chunk)
+
+        self.stats = {
+            "input_chunks": len(chunks),
+            "output_chunks": len(deduplicated),
+            "exact_duplicates": exact_duplicates,
+            "near_duplicates": near_duplicates
+        }
+        print(f"去重完成: {len(chunks)} -> {len(deduplicated)} 个文本块 "
+              f"(精确重复 {exact_duplicates}, 近似重复 {near_duplicates})")
+
+        return deduplicated
+
+if __name__ == "__main__":
+    # 示例使用
+    deduplicator = ChunkDeduplicator()
+    sample_chunks = [
+        {"id": "1", "content": "高血压患者应定期监测血压，并记录每日的测量结果。", "metadata": {"source": "WHO"}},
+        {"id": "2", "content": "高血压患者应定期监测血压，并记录每日的测量结果。", "metadata": {"source": "中国CDC"}},
+        {"id": "3", "content": "高血压患者应定期监测血压，并记录每天的测量结果。", "metadata": {"source": "丁香医生"}},
+        {"id": "4", "content": "糖尿病患者需要控制碳水化合物的摄入量。", "metadata": {"source": "WHO"}}
+    ]
+
+    for chunk in deduplicator.deduplicate(sample_chunks):
+        print(chunk["id"], chunk["metadata"])
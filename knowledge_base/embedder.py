@@ -1,45 +1,333 @@
 # 向量化器
 
 import os
-from sentence_transformers import SentenceTransformer
+import time
 from config.model_config import EMBEDDING_CONFIG
 
+def model_dimension(model):
+    """嵌入模型的输出维度：优先使用模型声明的维度，未声明时嵌入一个示例文本"""
+    get_dimension = getattr(model, "get_sentence_embedding_dimension", None)
+    dim = get_dimension() if get_dimension is not None else None
+    if not dim:
+        dim = len(model.encode("示例文本", show_progress_bar=False, convert_to_tensor=False))
+    return int(dim)
+
 class MedicalEmbedder:
-    def __init__(self):
+    def __init__(self, use_cache=True):
         self.model_name = EMBEDDING_CONFIG["MODEL_NAME"]
         self.model_type = EMBEDDING_CONFIG["MODEL_TYPE"]
         self.batch_size = EMBEDDING_CONFIG["BATCH_SIZE"]
         self.device = EMBEDDING_CONFIG["DEVICE"]
         self.max_length = EMBEDDING_CONFIG["MAX_LENGTH"]
+        self.max_batch_tokens = EMBEDDING_CONFIG.get("MAX_BATCH_TOKENS", self.batch_size * self.max_length)
+        self.max_batch_size = EMBEDDING_CONFIG.get("MAX_BATCH_SIZE", self.batch_size)
+        self.token_counter = None
+        self.last_batch_stats = {}
         self.medical_model_enabled = EMBEDDING_CONFIG["MEDICAL_MODEL"]["ENABLED"]
         self.medical_model_path = EMBEDDING_CONFIG["MEDICAL_MODEL"]["MODEL_PATH"]
+        # bge-m3模式：一次推理同时输出稠密向量和稀疏词权重
+        self.sparse_enabled = self.model_type == "bge-m3"
+        
+        # 多进程嵌入池（大批量构建时按需启动）
+        pool_config = EMBEDDING_CONFIG.get("POOL", {})
+        self.pool_workers = pool_config.get("NUM_WORKERS", 0)
+        self.pool_threads = pool_config.get("THREADS_PER_WORKER", 1)
+        self.pool_min_texts = pool_config.get("MIN_TEXTS", 0)
+        self.pool = None
+        
+        # 加载模型：使用进程池时模型只在工作进程中加载，主进程在用到模型时（小批量、查询）才加载
+        self.loaded_model = None
+        self.model_loaded = False
+        if not self.pool_enabled():
+            self.loaded_model = self.load_model()
+            self.model_loaded = True
+        self.fallback = None
+        self.use_cache = use_cache
+        self.cache = None
+        self.cache_enabled = False
+        self.batcher = None
+        # 使用进程池时未加载模型，按模型可用处理（工作进程加载失败时进程池启动报错）
+        if self.pool_enabled() or self.model is not None:
+            self.init_model_services()
+        
+        # 查询嵌入缓存（内存LRU，用户反复询问的相同问题不再重复推理）
+        query_cache_config = EMBEDDING_CONFIG.get("QUERY_CACHE", {})
+        self.query_cache = None
+        if use_cache and query_cache_config.get("ENABLED", False):
+            from knowledge_base.query_cache import QueryEmbeddingCache
+            self.query_cache = QueryEmbeddingCache(
+                max_entries=query_cache_config["MAX_ENTRIES"],
+                max_bytes=query_cache_config["MAX_BYTES"],
+                ttl_seconds=query_cache_config["TTL_SECONDS"]
+            )
+    
+    @property
+    def model(self):
+        """嵌入模型（首次访问时加载；加载失败为None，使用离线特征哈希嵌入器）
+        
+        加载失败后，注册表中的失败条目被清除（reset_failed）时下次访问重新加载，
+        共享的嵌入器实例不需要重建即可恢复。
+        """
+        if not self.model_loaded or (self.loaded_model is None and self.model_reset()):
+            recovering = self.model_loaded
+            self.loaded_model = self.load_model()
+            self.model_loaded = True
+            if recovering and self.loaded_model is not None:
+                print("嵌入模型重新加载成功")
+                self.init_model_services()
+        return self.loaded_model
+    
+    def model_key(self):
+        """嵌入模型在进程级注册表中的名称"""
+        return f"embedding_model:{self.model_fingerprint()}"
+    
+    def model_reset(self):
+        """加载失败的模型条目是否已从注册表中清除（可以重新加载）"""
+        from knowledge_base.model_registry import registry, STATE_PENDING
+        return registry.state(self.model_key()) == STATE_PENDING
+    
+    def init_model_services(self):
+        """模型可用时启用持久化嵌入缓存和在线查询微批处理"""
+        # 持久化嵌入缓存（只缓存真实模型的输出；稀疏模式每次都需要推理，不使用缓存）
+        # 缓存矩阵按模型实际的嵌入维度创建，首次编码文本块时再初始化
+        self.cache_enabled = self.use_cache and self.cache is None and not self.sparse_enabled
+        
+        # 在线查询的跨请求微批处理
+        micro_batch_config = EMBEDDING_CONFIG.get("MICRO_BATCH", {})
+        if micro_batch_config.get("ENABLED", False) and self.batcher is None:
+            from knowledge_base.embedding_service import EmbeddingBatcher
+            self.batcher = EmbeddingBatcher(
+                self.encode_query_batch,
+                max_batch_size=micro_batch_config["MAX_BATCH_SIZE"],
+                max_wait_ms=micro_batch_config["MAX_WAIT_MS"],
+                max_queue_size=micro_batch_config["MAX_QUEUE_SIZE"]
+            )
+    
+    def pool_enabled(self):
+        """构建时是否使用多进程嵌入池（bge-m3稀疏模式在主进程中推理）"""
+        return self.pool_workers > 0 and not self.sparse_enabled
+    
+    def model_fingerprint(self):
+        """模型指纹：模型路径、类型和最大长度，任一变化都会使缓存失效"""
+        if self.medical_model_enabled and os.path.exists(self.medical_model_path):
+            model_path = os.path.abspath(self.medical_model_path)
+            version = str(os.path.getmtime(model_path))
+        else:
+            model_path = self.model_name
+            version = EMBEDDING_CONFIG.get("MODEL_REVISION", "")
+        if self.model_type == "onnx":
+            onnx_config = EMBEDDING_CONFIG["ONNX"]
+            version += f"|onnx|quantized={onnx_config['QUANTIZED']}"
+        return f"{model_path}|{version}|{self.model_type}|{self.max_length}"
+    
+    def init_cache(self):
+        """初始化持久化嵌入缓存"""
+        cache_config = EMBEDDING_CONFIG.get("CACHE", {})
+        if not cache_config.get("ENABLED", False):
+            return None
+        try:
+            from knowledge_base.embedding_cache import EmbeddingCache
+            return EmbeddingCache(
+                directory=cache_config["DIRECTORY"],
+                fingerprint=self.model_fingerprint(),
+                dim=self.embedding_dimension(),
+                max_entries=cache_config["MAX_ENTRIES"]
+            )
+        except Exception as e:
+            print(f"Error initializing embedding cache: {e}")
+            return None
+    
+    def encode_texts(self, texts):
+        """批量编码文本，命中缓存的文本不再重复编码"""
+        if self.cache is None and self.cache_enabled:
+            # 只尝试初始化一次
+            self.cache_enabled = False
+            self.cache = self.init_cache()
+        if self.cache is None:
+            return self.encode_batched(texts)
+        
+        embeddings = self.cache.get_many(texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
         
-        # 加载模型
-        self.model = self.load_model()
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            encoded = self.encode_batched(missing_texts)
+            self.cache.put_many(missing_texts, encoded)
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+        
+        print(f"嵌入缓存命中 {len(texts) - len(missing)}/{len(texts)}，新编码 {len(missing)} 个文本")
+        return embeddings
     
     def load_model(self):
-        """加载嵌入模型"""
+        """加载嵌入模型（通过进程级注册表，同一模型在进程内只加载一次）"""
+        from knowledge_base.model_registry import registry
         try:
-            if self.medical_model_enabled and os.path.exists(self.medical_model_path):
-                # 使用医疗领域微调模型
-                print(f"加载医疗领域微调模型: {self.medical_model_path}")
-                model = SentenceTransformer(self.medical_model_path, device=self.device)
-            else:
-                # 使用通用模型
-                print(f"加载通用嵌入模型: {self.model_name}")
-                model = SentenceTransformer(self.model_name, device=self.device)
-            
-            # 设置最大长度
-            if hasattr(model, 'max_seq_length'):
-                model.max_seq_length = self.max_length
-            
-            return model
+            return registry.get(self.model_key(), self.create_model)
         except Exception as e:
             print(f"Error loading model: {e}")
+            if self.sparse_enabled:
+                # 备用嵌入器没有稀疏词权重，不能替代bge-m3模式（检索链路不会构建BM25）
+                raise RuntimeError(f"MODEL_TYPE 为 bge-m3，但无法加载bge-m3模型（需要安装FlagEmbedding）: {e}") from e
             print("模型加载失败，将使用简单的替代方案")
             # 返回一个简单的替代方案
             return None
     
+    def create_model(self):
+        """实际创建嵌入模型实例"""
+        if self.model_type == "onnx":
+            # ONNX Runtime CPU后端，不需要加载PyTorch
+            from knowledge_base.onnx_backend import OnnxEmbeddingModel
+            onnx_config = EMBEDDING_CONFIG["ONNX"]
+            print(f"加载ONNX嵌入模型: {onnx_config['MODEL_DIR']}")
+            return OnnxEmbeddingModel(
+                onnx_config["MODEL_DIR"],
+                quantized=onnx_config["QUANTIZED"],
+                intra_op_threads=onnx_config["INTRA_OP_THREADS"],
+                max_length=self.max_length,
+                pooling=onnx_config["POOLING"]
+            )
+        
+        if self.sparse_enabled:
+            from knowledge_base.bge_m3_backend import BGEM3Model
+            sparse_config = EMBEDDING_CONFIG["SPARSE"]
+            model_path = self.medical_model_path if self.medical_model_enabled and os.path.exists(self.medical_model_path) \
+                else self.model_name
+            print(f"加载bge-m3稠密+稀疏模型: {model_path}")
+            return BGEM3Model(
+                model_path,
+                device=self.device,
+                use_fp16=sparse_config["USE_FP16"],
+                max_length=self.max_length,
+                min_weight=sparse_config["MIN_WEIGHT"]
+            )
+        
+        from sentence_transformers import SentenceTransformer
+        if self.medical_model_enabled and os.path.exists(self.medical_model_path):
+            # 使用医疗领域微调模型
+            print(f"加载医疗领域微调模型: {self.medical_model_path}")
+            model = SentenceTransformer(self.medical_model_path, device=self.device)
+        else:
+            # 使用通用模型
+            print(f"加载通用嵌入模型: {self.model_name}")
+            model = SentenceTransformer(self.model_name, device=self.device)
+        
+        # 设置最大长度
+        if hasattr(model, 'max_seq_length'):
+            model.max_seq_length = self.max_length
+        
+        return model
+    
+    def embedding_dimension(self):
+        """模型实际输出的嵌入维度（不是配置中的EMBEDDING_DIM）
+
+        主进程已加载模型时取自模型；进程池模式下主进程未加载模型时取自工作进程；
+        模型无法加载时为备用嵌入器的维度（配置的EMBEDDING_DIM）。
+        """
+        if self.pool_enabled() and not self.model_loaded:
+            try:
+                return self.get_pool().dim
+            except Exception as e:
+                print(f"嵌入进程池启动失败，改为在主进程中嵌入: {e}")
+                self.pool_workers = 0
+        if self.model is None:
+            return EMBEDDING_CONFIG["EMBEDDING_DIM"]
+        return model_dimension(self.model)
+    
+    def token_lengths(self, texts):
+        """计算文本的token长度（截断到max_length），没有分词器时按字符数估计"""
+        if self.token_counter is None:
+            from knowledge_base.token_counter import TokenCounter
+            if self.model_loaded:
+                tokenizer = getattr(self.model, "tokenizer", None)
+                if tokenizer is None:
+                    return [min(len(text), self.max_length) for text in texts]
+                self.token_counter = TokenCounter(tokenizer=tokenizer)
+            else:
+                # 进程池模式下主进程没有加载模型，只加载分词器
+                try:
+                    self.token_counter = TokenCounter()
+                except Exception as e:
+                    print(f"分词器加载失败，按字符数估计token长度: {e}")
+                    return [min(len(text), self.max_length) for text in texts]
+        # 加上[CLS]/[SEP]两个特殊token
+        return [min(count + 2, self.max_length) for count in self.token_counter.count_many(texts)]
+    
+    def get_pool(self):
+        """获取（必要时启动）多进程嵌入池"""
+        if self.pool is None:
+            from knowledge_base.embedding_pool import EmbeddingPool
+            self.pool = EmbeddingPool(
+                self.pool_workers,
+                self.pool_threads,
+                max_batch_tokens=self.max_batch_tokens,
+                max_batch_size=self.max_batch_size
+            )
+            self.pool.start()
+        return self.pool
+    
+    def close(self):
+        """释放多进程嵌入池、微批处理线程等资源"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if self.batcher is not None:
+            self.batcher.close()
+            self.batcher = None
+    
+    def encode_batched(self, texts, return_sparse=False):
+        """按token长度分桶、在token预算内组批编码，结果恢复原始顺序
+
+        return_sparse为True时（bge-m3模式）返回 (稠密向量列表, 稀疏词权重列表)。
+        """
+        from knowledge_base.batching import plan_batches, padding_efficiency
+        
+        lengths = self.token_lengths(texts)
+        batches = plan_batches(lengths, self.max_batch_tokens, self.max_batch_size)
+        
+        start = time.perf_counter()
+        sparse = None
+        if return_sparse:
+            # 稠密向量和稀疏词权重来自同一次前向推理
+            embeddings = [None] * len(texts)
+            sparse = [None] * len(texts)
+            for batch in batches:
+                dense, weights = self.model.encode_hybrid([texts[i] for i in batch], batch_size=len(batch))
+                for i, embedding, lexical_weights in zip(batch, dense, weights):
+                    embeddings[i] = embedding
+                    sparse[i] = lexical_weights
+        elif self.pool_enabled() and len(texts) >= self.pool_min_texts:
+            # 多进程模式：工作进程各自组批编码，结果按原始顺序返回
+            embeddings = list(self.get_pool().encode(texts, lengths))
+        else:
+            embeddings = [None] * len(texts)
+            for batch in batches:
+                encoded = self.model.encode(
+                    [texts[i] for i in batch],
+                    batch_size=len(batch),
+                    show_progress_bar=False,
+                    convert_to_tensor=False
+                )
+                for i, embedding in zip(batch, encoded):
+                    embeddings[i] = embedding
+        elapsed = time.perf_counter() - start
+        
+        self.last_batch_stats = {
+            "texts": len(texts),
+            "batches": len(batches),
+            "tokens": sum(lengths),
+            "padding_efficiency": padding_efficiency(lengths, batches),
+            "seconds": elapsed,
+            "texts_per_sec": len(texts) / elapsed if elapsed else 0.0,
+            "tokens_per_sec": sum(lengths) / elapsed if elapsed else 0.0
+        }
+        print(f"批量嵌入: {len(texts)} 个文本, {len(batches)} 个批次, "
+              f"填充效率 {self.last_batch_stats['padding_efficiency']:.1%}, "
+              f"{self.last_batch_stats['texts_per_sec']:.1f} 文本/秒")
+        if return_sparse:
+            return embeddings, sparse
+        return embeddings
+    
     def embed_text(self, text):
         """将单个文本嵌入为向量"""
         try:
@@ -53,16 +341,8 @@ class MedicalEmbedder:
             
             # 检查模型是否加载成功
             if self.model is None:
-                # 使用简单的替代方案：基于文本长度和字符分布的向量
-                import hashlib
-                # 生成一个基于文本的哈希值
-                hash_obj = hashlib.md5(text.encode())
-                hash_hex = hash_obj.hexdigest()
-                # 将哈希值转换为1024维向量
-                embedding = []
-                for i in range(1024):
-                    embedding.append(float(int(hash_hex[i % len(hash_hex)], 16)) / 15.0)
-                return embedding
+                # 使用离线特征哈希嵌入器
+                return self.get_fallback().embed([text])[0].tolist()
             
             # 嵌入
             embedding = self.model.encode(
@@ -74,31 +354,91 @@ class MedicalEmbedder:
             
             return embedding.tolist()
         except Exception as e:
+            # 模型已加载时不能混入备用向量（向量空间不同），直接放弃该文本
             print(f"Error embedding text: {e}")
-            # 使用简单的替代方案
-            import hashlib
-            hash_obj = hashlib.md5(str(text).encode())
-            hash_hex = hash_obj.hexdigest()
-            embedding = []
-            for i in range(1024):
-                embedding.append(float(int(hash_hex[i % len(hash_hex)], 16)) / 15.0)
-            return embedding
+            return None
+    
+    def get_fallback(self):
+        """获取离线特征哈希嵌入器（模型加载失败时使用）"""
+        if self.fallback is None:
+            self.fallback = self.new_fallback()
+        return self.fallback
+    
+    def new_fallback(self, idf_path=None):
+        """创建离线特征哈希嵌入器，idf_path存在时加载其中的IDF统计"""
+        from knowledge_base.hashing_embedder import HashingEmbedder
+        fallback_config = EMBEDDING_CONFIG.get("FALLBACK", {})
+        return HashingEmbedder(
+            dim=EMBEDDING_CONFIG["EMBEDDING_DIM"],
+            ngram_range=fallback_config.get("NGRAM_RANGE", (2, 3)),
+            idf_path=idf_path
+        )
+    
+    def uses_fallback(self):
+        """构建前确认是否需要离线特征哈希嵌入器（进程池模式下启动进程池确认工作进程能加载模型）"""
+        if self.pool_enabled() and not self.model_loaded:
+            try:
+                self.get_pool()
+                return False
+            except Exception as e:
+                print(f"嵌入进程池启动失败，改为在主进程中嵌入: {e}")
+                self.pool_workers = 0
+        return self.model is None
+    
+    def fit_fallback(self, texts, directory):
+        """对整个语料拟合一次备用嵌入器的IDF，保存到知识库版本目录"""
+        from knowledge_base.hashing_embedder import HASHING_IDF_FILE
+        fallback = self.get_fallback()
+        fallback.idf_path = os.path.join(directory, HASHING_IDF_FILE)
+        fallback.fit(texts)
+        print(f"备用嵌入器IDF已拟合: {len(texts)} 个文本块")
+    
+    def collection_fallback(self, schema, directory):
+        """确认查询嵌入与集合的向量空间一致（不修改嵌入器），返回集合使用的备用嵌入器
+        
+        集合由嵌入模型构建而当前模型无法加载时拒绝使用备用嵌入器（反之亦然）；
+        备用嵌入器构建的集合返回加载了该版本目录中IDF统计的备用嵌入器，模型构建的集合返回None。
+        """
+        from knowledge_base.hashing_embedder import HASHING_FALLBACK_MODEL, HASHING_IDF_FILE
+        if schema is None:
+            # 旧版本构建的集合没有schema记录，无法确认向量空间
+            print("警告: 集合没有schema记录，无法确认查询嵌入与集合一致")
+            return None
+        built_with_fallback = schema.get("model") == HASHING_FALLBACK_MODEL
+        if self.model is None and not built_with_fallback:
+            raise RuntimeError(f"集合由 {schema.get('model')} 构建，但嵌入模型无法加载，"
+                               f"拒绝使用离线备用嵌入器检索")
+        if self.model is not None and built_with_fallback:
+            raise RuntimeError("集合由离线备用嵌入器构建，与当前嵌入模型的向量空间不同，请重建知识库")
+        if not built_with_fallback:
+            return None
+        idf_path = os.path.join(directory, HASHING_IDF_FILE)
+        if not os.path.exists(idf_path):
+            raise RuntimeError(f"备用嵌入器的IDF统计不存在: {idf_path}")
+        return self.new_fallback(idf_path)
+    
+    def bind_collection(self, schema, directory):
+        """检索前确认查询嵌入与集合的向量空间一致，备用嵌入器构建的集合切换到该版本的IDF统计
+        
+        整体替换备用嵌入器（不在原对象上修改），进行中的查询不会用到一半新一半旧的统计。
+        """
+        fallback = self.collection_fallback(schema, directory)
+        if fallback is not None:
+            self.fallback = fallback
     
     def embed_chunks(self, chunks):
         """将多个文本块嵌入为向量"""
         embedded_chunks = []
         
-        # 检查模型是否加载成功
-        if self.model is None:
-            # 模型加载失败，使用单个处理的方式
-            for chunk in chunks:
-                text = chunk.get('content', '')
-                if text:
-                    embedding = self.embed_text(text)
-                    if embedding:
-                        chunk_copy = chunk.copy()
-                        chunk_copy['embedding'] = embedding
-                        embedded_chunks.append(chunk_copy)
+        # 检查模型是否加载成功（进程池模式下由工作进程加载）
+        if not self.pool_enabled() and self.model is None:
+            # 模型加载失败，使用离线特征哈希嵌入器批量处理（IDF在构建开始时已对整个语料拟合）
+            valid_chunks = [chunk for chunk in chunks if chunk.get('content', '').strip()]
+            embeddings = self.get_fallback().embed([chunk.get('content', '') for chunk in valid_chunks])
+            for chunk, embedding in zip(valid_chunks, embeddings):
+                chunk_copy = chunk.copy()
+                chunk_copy['embedding'] = embedding.tolist()
+                embedded_chunks.append(chunk_copy)
             return embedded_chunks
         
         # 批量处理
@@ -113,18 +453,20 @@ class MedicalEmbedder:
         
         if texts:
             try:
-                # 批量嵌入
-                embeddings = self.model.encode(
-                    texts,
-                    batch_size=self.batch_size,
-                    show_progress_bar=False,
-                    convert_to_tensor=False
-                )
+                if self.sparse_enabled:
+                    # bge-m3：一次推理同时得到稠密向量和稀疏词权重
+                    embeddings, sparse = self.encode_batched(texts, return_sparse=True)
+                else:
+                    # 批量嵌入（只编码缓存未命中的文本）
+                    embeddings = self.encode_texts(texts)
+                    sparse = None
                 
                 # 将嵌入向量添加到块中
                 for i, idx in enumerate(chunk_indices):
                     chunk = chunks[idx].copy()
                     chunk['embedding'] = embeddings[i].tolist()
+                    if sparse is not None:
+                        chunk['sparse'] = sparse[i]
                     embedded_chunks.append(chunk)
             except Exception as e:
                 print(f"Error embedding chunks: {e}")
@@ -140,18 +482,132 @@ class MedicalEmbedder:
         
         return embedded_chunks
     
-    def embed_query(self, query):
-        """将查询文本嵌入为向量"""
-        return self.embed_text(query)
+    def embed_query(self, query, return_sparse=False):
+        """将查询文本嵌入为向量
+
+        return_sparse为True且处于bge-m3模式时返回 {"dense": 向量, "sparse": 词权重}，
+        两者来自同一次推理（不经过查询缓存）。
+        """
+        if return_sparse:
+            return self.embed_query_hybrid(query)
+        if self.query_cache is None or self.model is None:
+            return self.embed_query_uncached(query)
+        
+        embedding = self.query_cache.get(query)
+        if embedding is not None:
+            return embedding
+        
+        embedding = self.embed_query_uncached(query)
+        if embedding:
+            self.query_cache.put(query, embedding)
+        return embedding
+    
+    def embed_query_uncached(self, query):
+        """嵌入查询（不经过缓存），启用微批处理时与其他并发请求合并推理"""
+        if self.batcher is None or not isinstance(query, str) or not query.strip():
+            return self.embed_text(query)
+        from knowledge_base.embedding_service import EmbeddingOverloadError
+        try:
+            embedding = self.batcher.embed(query)
+            # bge-m3模式下微批处理返回稠密+稀疏结果
+            return embedding["dense"] if isinstance(embedding, dict) else embedding
+        except EmbeddingOverloadError as e:
+            # 过载时不在请求线程中直接推理（会进一步加重负载），本次查询放弃向量召回
+            print(f"Embedding overloaded: {e}")
+            return None
+        except Exception as e:
+            print(f"Error in micro-batch embedding: {e}")
+            return self.embed_text(query)
+    
+    def embed_query_hybrid(self, query):
+        """bge-m3模式：返回查询的稠密向量和稀疏词权重；非稀疏模式时sparse为None"""
+        if not self.sparse_enabled or self.model is None:
+            return {"dense": self.embed_query(query), "sparse": None}
+        if not isinstance(query, str) or not query.strip():
+            return None
+        try:
+            if self.batcher is not None:
+                return self.batcher.embed(query)
+            return self.encode_query_batch([query])[0]
+        except Exception as e:
+            print(f"Error embedding hybrid query: {e}")
+            return None
+    
+    def embed_queries(self, queries, return_sparse=False):
+        """批量嵌入查询（离线评估、缓存预热），结果与输入顺序一致，无效查询对应None
+
+        未命中查询缓存的查询按token长度分桶后一次性编码；return_sparse为True时
+        每个结果为 {"dense": 向量, "sparse": 词权重}（与 embed_query 相同）。
+        """
+        results = [None] * len(queries)
+        valid = [i for i, query in enumerate(queries) if isinstance(query, str) and query.strip()]
+        hybrid = return_sparse and self.sparse_enabled and self.model is not None
+
+        if self.model is None:
+            # 离线特征哈希嵌入器
+            if valid:
+                embeddings = self.get_fallback().embed([queries[i] for i in valid])
+                for i, embedding in zip(valid, embeddings):
+                    results[i] = {"dense": embedding.tolist(), "sparse": None} if return_sparse else embedding.tolist()
+            return results
+
+        # 查询缓存只保存稠密向量
+        missing = valid
+        if self.query_cache is not None and not hybrid:
+            missing = []
+            for i in valid:
+                results[i] = self.query_cache.get(queries[i])
+                if results[i] is None:
+                    missing.append(i)
+        if not missing:
+            return results
+
+        # 同一批中的重复查询只编码一次
+        positions = {}
+        for i in missing:
+            positions.setdefault(queries[i], []).append(i)
+        texts = list(positions)
+        try:
+            if hybrid:
+                dense, sparse = self.encode_batched(texts, return_sparse=True)
+            else:
+                dense, sparse = self.encode_batched(texts), [None] * len(texts)
+        except Exception as e:
+            print(f"Error embedding queries: {e}")
+            return results
+
+        for text, embedding, weights in zip(texts, dense, sparse):
+            embedding = embedding.tolist()
+            if self.query_cache is not None and not return_sparse:
+                self.query_cache.put(text, embedding)
+            for i in positions[text]:
+                results[i] = {"dense": embedding, "sparse": weights} if return_sparse else embedding
+        return results
+
+    def encode_query_batch(self, queries):
+        """微批处理回调：一次前向推理编码多个查询"""
+        if self.sparse_enabled:
+            dense, sparse = self.model.encode_hybrid(queries, batch_size=len(queries))
+            return [{"dense": embedding.tolist(), "sparse": weights} for embedding, weights in zip(dense, sparse)]
+        embeddings = self.model.encode(
+            queries,
+            batch_size=len(queries),
+            show_progress_bar=False,
+            convert_to_tensor=False
+        )
+        return [embedding.tolist() for embedding in embeddings]
+    
+    def get_stats(self):
+        """获取嵌入缓存与微批处理统计"""
+        return {
+            "query_cache": self.query_cache.stats() if self.query_cache else None,
+            "embedding_cache": self.cache.stats() if self.cache else None,
+            "micro_batch": self.batcher.stats() if self.batcher else None
+        }
     
     def get_embedding_dimension(self):
         """获取嵌入维度"""
-        # 嵌入一个示例文本以获取维度
-        sample_embedding = self.embed_text("示例文本")
-        if sample_embedding:
-            return len(sample_embedding)
-        else:
-            return EMBEDDING_CONFIG["EMBEDDING_DIM"]
+        return self.embedding_dimension()
 
 if __name__ == "__main__":
     # 示例使用
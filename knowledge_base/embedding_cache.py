@@ -0,0 +1,169 @@
+# 持久化嵌入缓存（SQLite索引 + 内存映射向量矩阵）
+
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+
+class EmbeddingCache:
+    def __init__(self, directory, fingerprint, dim, max_entries):
+        self.fingerprint = fingerprint
+        self.dim = dim
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # 每个模型指纹使用独立的子目录，切换模型不会污染已有缓存
+        fingerprint_hash = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:12]
+        self.directory = os.path.join(directory, fingerprint_hash)
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.conn = sqlite3.connect(os.path.join(self.directory, "index.sqlite"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, slot INTEGER UNIQUE NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON entries(last_access)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+        self.conn.commit()
+
+        self.matrix = self.open_matrix()
+
+    def open_matrix(self):
+        """打开（必要时创建或扩容）内存映射向量矩阵"""
+        matrix_path = os.path.join(self.directory, "vectors.f32")
+        size = self.max_entries * self.dim * 4
+        with open(matrix_path, 'ab') as f:
+            if f.tell() < size:
+                f.truncate(size)
+
+        # 缩小容量时丢弃超出范围的条目
+        self.conn.execute("DELETE FROM entries WHERE slot >= ?", (self.max_entries,))
+        self.conn.commit()
+
+        return np.memmap(matrix_path, dtype=np.float32, mode='r+', shape=(self.max_entries, self.dim))
+
+    def make_key(self, text):
+        """规范化文本后计算哈希键"""
+        normalized = re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text)).strip()
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def get_many(self, texts):
+        """批量查询缓存，未命中的位置返回None"""
+        keys = [self.make_key(text) for text in texts]
+        slots = {}
+
+        with self.lock:
+            unique_keys = list(set(keys))
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i+500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                slots.update(rows)
+
+            if slots:
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE entries SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in slots]
+                )
+                self.conn.commit()
+
+            embeddings = [np.array(self.matrix[slots[key]]) if key in slots else None for key in keys]
+
+        hit_count = sum(1 for embedding in embeddings if embedding is not None)
+        self.hits += hit_count
+        self.misses += len(keys) - hit_count
+        return embeddings
+
+    def put_many(self, texts, embeddings):
+        """批量写入缓存，容量不足时淘汰最久未访问的条目"""
+        entries = {}
+        for text, embedding in zip(texts, embeddings):
+            entries[self.make_key(text)] = embedding
+        if not entries:
+            return
+
+        with self.lock:
+            existing = {}
+            keys = list(entries)
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i+500]
+                placeholders = ",".join("?" * len(batch))
+                existing.update(self.conn.execute(
+                    f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", batch
+                ).fetchall())
+
+            new_keys = [key for key in keys if key not in existing][:self.max_entries]
+            # 本批要覆盖写入的已有条目不能被淘汰，否则它的槽位会同时分配给新条目
+            free_slots = self.allocate_slots(len(new_keys), keep=existing)
+
+            now = time.time()
+            rows = []
+            for key in keys:
+                slot = existing.get(key)
+                if slot is None:
+                    if not free_slots:
+                        continue
+                    slot = free_slots.pop()
+                self.matrix[slot] = np.asarray(entries[key], dtype=np.float32)
+                rows.append((key, slot, now))
+
+            self.matrix.flush()
+            self.conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", rows)
+            self.conn.commit()
+
+    def allocate_slots(self, count, keep=()):
+        """分配空闲槽位，必要时按LRU淘汰（不淘汰keep中的键）；可淘汰的条目不足时返回的槽位少于count"""
+        if count <= 0:
+            return []
+
+        # 槽位按顺序分配，淘汰的槽位会被立即复用
+        max_slot = self.conn.execute("SELECT MAX(slot) FROM entries").fetchone()[0]
+        next_slot = 0 if max_slot is None else max_slot + 1
+        free_slots = list(range(next_slot, min(next_slot + count, self.max_entries)))
+
+        shortage = count - len(free_slots)
+        if shortage > 0:
+            evicted = []
+            for key, slot in self.conn.execute("SELECT key, slot FROM entries ORDER BY last_access"):
+                if key in keep:
+                    continue
+                evicted.append((key, slot))
+                if len(evicted) == shortage:
+                    break
+            self.conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+            free_slots.extend(slot for _, slot in evicted)
+
+        return free_slots
+
+    def size(self):
+        """缓存条目数"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def stats(self):
+        """缓存统计"""
+        total = self.hits + self.misses
+        return {
+            "entries": self.size(),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    def close(self):
+        """关闭缓存"""
+        with self.lock:
+            self.matrix.flush()
+            self.conn.close()
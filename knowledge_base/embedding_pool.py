@@ -0,0 +1,205 @@
+# 多进程嵌入池（用于知识库构建）
+
+import os
+import time
+import queue
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from config.model_config import EMBEDDING_CONFIG
+from knowledge_base.batching import plan_batches
+
+def pool_worker(worker_id, num_threads, task_queue, result_queue):
+    """工作进程：固定线程数，只加载一次模型，将结果写入共享内存"""
+    # 在导入推理库之前固定线程数
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(num_threads)
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+        torch.set_num_interop_threads(1)
+    except Exception:
+        pass
+    EMBEDDING_CONFIG["ONNX"]["INTRA_OP_THREADS"] = num_threads
+
+    from knowledge_base.embedder import MedicalEmbedder
+    embedder = MedicalEmbedder(use_cache=False)
+    if embedder.model is None:
+        result_queue.put(("error", worker_id, None, "模型加载失败"))
+        return
+    # 报告模型实际的嵌入维度，主进程按该维度分配共享内存
+    result_queue.put(("ready", worker_id, None, embedder.embedding_dimension()))
+
+    attached = {}
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        window_id, batch_id, shm_name, shape, rows, texts = task
+        try:
+            if shm_name not in attached:
+                # 上一个窗口的共享内存已经用完，释放映射
+                for shm, _ in attached.values():
+                    shm.close()
+                shm = shared_memory.SharedMemory(name=shm_name)
+                attached = {shm_name: (shm, np.ndarray(shape, dtype=np.float32, buffer=shm.buf))}
+            matrix = attached[shm_name][1]
+
+            encoded = embedder.model.encode(
+                texts,
+                batch_size=len(texts),
+                show_progress_bar=False,
+                convert_to_tensor=False
+            )
+            matrix[rows] = np.asarray(encoded, dtype=np.float32)
+            result_queue.put(("done", window_id, batch_id, None))
+        except Exception as e:
+            result_queue.put(("error", window_id, batch_id, str(e)))
+
+    for shm, _ in attached.values():
+        shm.close()
+
+class EmbeddingPool:
+    def __init__(self, num_workers, threads_per_worker, max_batch_tokens=None, max_batch_size=None,
+                 window_size=4096):
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.max_batch_tokens = max_batch_tokens or EMBEDDING_CONFIG["MAX_BATCH_TOKENS"]
+        self.max_batch_size = max_batch_size or EMBEDDING_CONFIG["MAX_BATCH_SIZE"]
+        self.window_size = window_size
+        # 嵌入维度：工作进程加载模型后报告
+        self.dim = EMBEDDING_CONFIG["EMBEDDING_DIM"]
+
+        # 等待结果时检查工作进程是否存活的间隔（秒）
+        self.poll_seconds = 5
+
+        self.context = mp.get_context("spawn")
+        self.task_queue = None
+        self.result_queue = None
+        self.processes = []
+
+    def start(self, timeout=600):
+        """启动工作进程，等待所有进程加载完模型"""
+        if self.processes:
+            return
+        self.task_queue = self.context.Queue()
+        self.result_queue = self.context.Queue()
+        for worker_id in range(self.num_workers):
+            process = self.context.Process(
+                target=pool_worker,
+                args=(worker_id, self.threads_per_worker, self.task_queue, self.result_queue),
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+
+        ready = 0
+        try:
+            while ready < self.num_workers:
+                status, worker_id, _, message = self.next_result(timeout)
+                if status == "error":
+                    raise RuntimeError(f"嵌入工作进程 {worker_id} 启动失败: {message}")
+                self.dim = message
+                ready += 1
+        except Exception:
+            self.close()
+            raise
+        print(f"嵌入进程池已启动: {self.num_workers} 个进程 × {self.threads_per_worker} 线程")
+
+    def next_result(self, timeout=None):
+        """等待下一个结果；每隔 poll_seconds 检查工作进程，有进程异常退出（OOM、段错误）或超时时抛出RuntimeError"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait_seconds = self.poll_seconds
+            if deadline is not None:
+                wait_seconds = min(wait_seconds, max(deadline - time.monotonic(), 0))
+            try:
+                return self.result_queue.get(timeout=wait_seconds)
+            except queue.Empty:
+                pass
+            dead = [(worker_id, process.exitcode) for worker_id, process in enumerate(self.processes)
+                    if not process.is_alive()]
+            if dead:
+                raise RuntimeError(f"嵌入工作进程异常退出（进程, 退出码）: {dead}")
+            if deadline is not None and time.monotonic() >= deadline:
+                raise RuntimeError(f"等待嵌入工作进程超过 {timeout} 秒")
+
+    def dispatch_window(self, window_id, texts, lengths):
+        """为一个窗口分配共享内存并派发所有批次"""
+        shape = (len(texts), self.dim)
+        shm = shared_memory.SharedMemory(create=True, size=max(len(texts) * self.dim * 4, 1))
+        batches = plan_batches(lengths, self.max_batch_tokens, self.max_batch_size)
+        for batch_id, batch in enumerate(batches):
+            self.task_queue.put((window_id, batch_id, shm.name, shape, batch, [texts[i] for i in batch]))
+        return {"shm": shm, "shape": shape, "pending": len(batches)}
+
+    def iter_encode(self, texts, lengths=None):
+        """按原始顺序流式返回嵌入结果，每次产出 (起始索引, 向量矩阵)
+
+        文本按窗口切分，同时保持两个窗口在途，主进程拷贝结果时工作进程不会空闲。
+        """
+        self.start()
+        if lengths is None:
+            lengths = [len(text) for text in texts]
+
+        windows = [(start, min(start + self.window_size, len(texts)))
+                   for start in range(0, len(texts), self.window_size)]
+        in_flight = {}
+        next_dispatch = 0
+
+        try:
+            for window_id, (start, end) in enumerate(windows):
+                while next_dispatch < len(windows) and next_dispatch <= window_id + 1:
+                    dispatch_start, dispatch_end = windows[next_dispatch]
+                    in_flight[next_dispatch] = self.dispatch_window(
+                        next_dispatch, texts[dispatch_start:dispatch_end], lengths[dispatch_start:dispatch_end]
+                    )
+                    next_dispatch += 1
+
+                # 等待当前窗口的所有批次完成
+                while in_flight[window_id]["pending"] > 0:
+                    status, done_window, batch_id, message = self.next_result()
+                    if status == "error":
+                        raise RuntimeError(f"嵌入批次 {done_window}/{batch_id} 失败: {message}")
+                    in_flight[done_window]["pending"] -= 1
+
+                window = in_flight.pop(window_id)
+                matrix = np.ndarray(window["shape"], dtype=np.float32, buffer=window["shm"].buf).copy()
+                window["shm"].close()
+                window["shm"].unlink()
+                yield start, matrix
+        except Exception:
+            # 队列中可能残留失败窗口的任务，重启进程池以免影响下一次调用
+            self.close()
+            raise
+        finally:
+            for window in in_flight.values():
+                window["shm"].close()
+                window["shm"].unlink()
+
+    def encode(self, texts, lengths=None):
+        """编码全部文本，返回按原始顺序排列的向量矩阵"""
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.vstack([matrix for _, matrix in self.iter_encode(texts, lengths)])
+
+    def close(self):
+        """关闭工作进程"""
+        for _ in self.processes:
+            try:
+                self.task_queue.put(None)
+            except Exception:
+                pass
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
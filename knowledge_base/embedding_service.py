@@ -0,0 +1,150 @@
+# 在线查询嵌入的跨请求微批处理
+
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+class EmbeddingOverloadError(RuntimeError):
+    """等待队列已满，请求被拒绝（调用方应降级或稍后重试，而不是阻塞请求线程）"""
+
+class EmbeddingBatcher:
+    """收集短时间窗口内的并发嵌入请求，合并为一个批次推理，每个调用方拿到自己的Future"""
+
+    def __init__(self, encode_fn, max_batch_size=16, max_wait_ms=5, max_queue_size=1024):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.running = True
+
+        # 统计指标
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self.batch_sizes = deque(maxlen=1000)
+        self.latencies = deque(maxlen=1000)
+
+        self.thread = threading.Thread(target=self.run, name="embedding-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, text):
+        """提交一个嵌入请求，返回Future；队列已满时Future以EmbeddingOverloadError失败
+
+        检查running与入队在同一把锁内完成，close之后不会再有请求排在关闭信号之后。
+        """
+        future = Future()
+        with self.lock:
+            if not self.running:
+                future.set_exception(RuntimeError("embedding batcher is closed"))
+                return future
+            try:
+                self.queue.put_nowait((text, future, time.monotonic()))
+            except queue.Full:
+                self.rejected += 1
+                future.set_exception(EmbeddingOverloadError(
+                    f"embedding queue is full ({self.queue.maxsize} pending requests)"))
+                return future
+            self.requests += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return future
+
+    def embed(self, text, timeout=None):
+        """提交请求并等待结果"""
+        return self.submit(text).result(timeout=timeout)
+
+    def collect_batch(self):
+        """阻塞等待第一个请求，然后在max_wait内继续收集，直到达到批大小上限"""
+        item = self.queue.get()
+        if item is None:
+            return None
+
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # 关闭信号放回队列，处理完当前批次后退出（刚取出一个请求，队列一定有空位）
+                self.queue.put_nowait(None)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self):
+        """后台线程：循环收集批次并推理"""
+        while True:
+            # 关闭时队列已满、放不进关闭信号：处理完队列中的请求后退出
+            batch = None if not self.running and self.queue.empty() else self.collect_batch()
+            if batch is None:
+                self.fail_remaining()
+                break
+
+            texts = [text for text, _, _ in batch]
+            try:
+                embeddings = list(self.encode_fn(texts))
+                if len(embeddings) != len(batch):
+                    # 行数不符时无法确定每行对应哪个请求，整批失败，不让任何调用方一直等待
+                    raise RuntimeError(f"encoder returned {len(embeddings)} embeddings for {len(batch)} texts")
+                for (_, future, _), embedding in zip(batch, embeddings):
+                    future.set_result(embedding)
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                for _, future, _ in batch:
+                    future.set_exception(e)
+
+            finished = time.monotonic()
+            with self.lock:
+                self.batches += 1
+                self.batch_sizes.append(len(batch))
+                self.latencies.extend(finished - submitted for _, _, submitted in batch)
+
+    def fail_remaining(self):
+        """退出前让仍在队列中的请求失败，调用方不会一直等待"""
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[1].set_exception(RuntimeError("embedding batcher is closed"))
+
+    def stats(self):
+        """队列深度、批大小与延迟统计"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            batch_sizes = list(self.batch_sizes)
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "errors": self.errors,
+                "rejected": self.rejected,
+                "queue_depth": self.queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "avg_batch_size": sum(batch_sizes) / len(batch_sizes) if batch_sizes else 0.0,
+                "p50_latency_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+                "p99_latency_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0
+            }
+
+    def close(self):
+        """停止后台线程（关闭信号之前提交的请求会先处理完）"""
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+        # 不再有新请求入队；队列已满时不等待，后台线程处理完队列后按running标志退出
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self.thread.join(timeout=5)
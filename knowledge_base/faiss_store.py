@@ -0,0 +1,324 @@
+# FAISS 存储后端（Flat / HNSW / IVF-PQ），ID、正文和元数据保存在SQLite旁路表中
+
+import os
+import threading
+import numpy as np
+from knowledge_base.metadata_filter import matches_filter
+from knowledge_base.metrics import check_metric, scores_to_distances
+from knowledge_base.row_table import RowTable
+
+INDEX_TYPES = ("flat", "hnsw", "ivfpq")
+# k-means每个聚类中心至少需要的训练样本数（少于该数量时FAISS给出训练不足的警告）
+MIN_POINTS_PER_CENTROID = 39
+
+class FaissStore:
+    """VectorDatabase 的 FAISS 后端
+
+    向量由 VectorDatabase 在入库和查询时L2归一化，索引按内积检索，返回集合度量（metric）下的距离。
+    索引中的整数ID即SQLite表的行号；删除和覆盖写入只在表中标记墓碑，由 compact 从索引中移除，
+    检索时墓碑和元数据过滤通过 RowTable 的元数据索引在打分前排除。
+    """
+
+    def __init__(self, persist_directory, collection_name, dim, read_only=False, config=None, metric="cosine"):
+        import faiss
+        self.faiss = faiss
+
+        config = config or {}
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name
+        self.dim = dim
+        self.read_only = read_only
+        self.index_type = config.get("INDEX_TYPE", "hnsw")
+        if self.index_type not in INDEX_TYPES:
+            raise ValueError(f"Unsupported FAISS index type: {self.index_type}")
+        self.config = config
+        self.metric = check_metric(metric)
+
+        self.index_path = os.path.join(persist_directory, f"{collection_name}.faiss")
+        self.rows = RowTable(os.path.join(persist_directory, f"{collection_name}_faiss.sqlite"), read_only)
+        self.lock = threading.Lock()
+        self.index = None
+
+        # IVF-PQ训练前暂存的向量
+        self.pending_rows = []
+        self.pending_vectors = []
+
+    def exists(self):
+        """索引是否存在"""
+        return self.rows.exists()
+
+    def create(self):
+        """创建空索引"""
+        self.drop()
+        os.makedirs(self.persist_directory, exist_ok=True)
+        self.rows.connect()
+        self.index = self.new_index(self.index_type)
+        self.configure_search()
+
+    def open(self):
+        """打开已有索引；只读模式下以内存映射方式加载，多个进程共享页缓存"""
+        self.rows.connect()
+        if not os.path.exists(self.index_path):
+            self.index = self.new_index(self.index_type)
+        elif self.read_only:
+            try:
+                self.index = self.faiss.read_index(self.index_path, self.faiss.IO_FLAG_MMAP)
+            except RuntimeError:
+                # 部分索引类型不支持内存映射
+                self.index = self.faiss.read_index(self.index_path)
+        else:
+            self.index = self.faiss.read_index(self.index_path)
+        self.configure_search()
+
+    def drop(self):
+        """删除索引文件"""
+        self.rows.remove()
+        self.index = None
+        self.pending_rows = []
+        self.pending_vectors = []
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
+    def new_index(self, index_type, nlist=None):
+        """按类型创建索引（内积度量）；nlist只用于IVF-PQ，默认取配置"""
+        faiss = self.faiss
+        if index_type == "flat":
+            return faiss.IndexIDMap2(faiss.IndexFlatIP(self.dim))
+        if index_type == "hnsw":
+            base = faiss.IndexHNSWFlat(self.dim, self.config.get("HNSW_M", 32), faiss.METRIC_INNER_PRODUCT)
+            base.hnsw.efConstruction = self.config.get("HNSW_EF_CONSTRUCTION", 200)
+            return faiss.IndexIDMap2(base)
+        # IVF-PQ：倒排列表本身支持自定义ID
+        self.quantizer = faiss.IndexFlatIP(self.dim)
+        return faiss.IndexIVFPQ(
+            self.quantizer,
+            self.dim,
+            nlist or self.config.get("IVF_NLIST", 4096),
+            self.config.get("PQ_M", 64),
+            self.config.get("PQ_NBITS", 8),
+            faiss.METRIC_INNER_PRODUCT
+        )
+
+    def configure_search(self):
+        """设置查询参数（HNSW的efSearch、IVF的nprobe）"""
+        base = self.index
+        if isinstance(base, self.faiss.IndexIDMap2):
+            base = self.faiss.downcast_index(base.index)
+        if hasattr(base, "hnsw"):
+            base.hnsw.efSearch = self.config.get("HNSW_EF_SEARCH", 64)
+        if hasattr(base, "nprobe"):
+            base.nprobe = self.config.get("IVF_NPROBE", 32)
+
+    def as_vectors(self, embeddings):
+        """转换为连续的float32矩阵（向量已由调用方L2归一化，这里不再逐次归一化）"""
+        return np.ascontiguousarray(np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim))
+
+    def count(self):
+        """文本块数量（不含墓碑）"""
+        with self.lock:
+            return self.rows.count()
+
+    def existing_ids(self, ids):
+        """返回已存在的ID集合"""
+        with self.lock:
+            return {row[0] for row in self.rows.lookup(ids)}
+
+    def max_batch_size(self):
+        """FAISS没有批大小限制"""
+        return None
+
+    def write(self, ids, embeddings, documents, metadatas, upsert=False):
+        """写入一批向量；已存在的ID在upsert时覆盖，否则保持不变"""
+        vectors = self.as_vectors(embeddings)
+        with self.lock:
+            rows, keep, _ = self.rows.insert(ids, documents, metadatas, upsert=upsert)
+            if keep:
+                self.add_vectors(np.asarray(rows, dtype=np.int64), vectors[keep])
+
+    def add_vectors(self, rows, vectors):
+        """向索引添加向量；IVF-PQ在积累到训练样本量之前先暂存"""
+        if self.index.is_trained:
+            self.index.add_with_ids(vectors, rows)
+            return
+        self.pending_rows.append(rows)
+        self.pending_vectors.append(vectors)
+        if sum(len(batch) for batch in self.pending_rows) >= self.train_size():
+            self.train_pending()
+
+    def train_size(self):
+        """开始训练IVF-PQ所需的暂存向量数：不少于TRAIN_SIZE，也不少于配置的每个聚类中心39个样本"""
+        return max(self.config.get("TRAIN_SIZE", 100000),
+                   MIN_POINTS_PER_CENTROID * self.config.get("IVF_NLIST", 4096))
+
+    def train_pending(self):
+        """用暂存向量的随机样本训练索引，然后写入全部暂存向量"""
+        rows = np.concatenate(self.pending_rows)
+        vectors = np.vstack(self.pending_vectors)
+        self.pending_rows = []
+        self.pending_vectors = []
+
+        # PQ码本（2^PQ_NBITS个中心）和IVF聚类都需要每个中心约39个样本：
+        # 样本不足以训练PQ时退化为精确检索，不足以支撑配置的nlist时按样本数减少聚类数
+        pq_points = MIN_POINTS_PER_CENTROID * 2 ** self.config.get("PQ_NBITS", 8)
+        if len(vectors) < pq_points:
+            print(f"训练样本 {len(vectors)} 个，少于IVF-PQ所需的 {pq_points} 个，改用Flat索引")
+            self.index = self.new_index("flat")
+            self.index.add_with_ids(vectors, rows)
+            return
+
+        nlist = min(self.index.nlist, len(vectors) // MIN_POINTS_PER_CENTROID)
+        if nlist < self.index.nlist:
+            print(f"训练样本 {len(vectors)} 个，聚类数从 {self.index.nlist} 降为 {nlist}")
+            self.index = self.new_index("ivfpq", nlist)
+
+        sample_size = min(len(vectors), self.train_size())
+        sample = vectors[np.random.default_rng(0).choice(len(vectors), sample_size, replace=False)]
+        print(f"训练IVF-PQ索引: {sample_size} 个样本, nlist={nlist}")
+        self.index.train(sample)
+        self.configure_search()
+        self.index.add_with_ids(vectors, rows)
+
+    def search_params(self, allowed, k):
+        """只在候选行内检索的查询参数（行位图转换为FAISS的IDSelectorBitmap）"""
+        faiss = self.faiss
+        packed = np.packbits(allowed, bitorder='little')
+        selector = faiss.IDSelectorBitmap(len(packed), faiss.swig_ptr(packed))
+        base = self.index
+        if isinstance(base, faiss.IndexIDMap2):
+            base = faiss.downcast_index(base.index)
+        if hasattr(base, "hnsw"):
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=max(self.config.get("HNSW_EF_SEARCH", 64), k))
+        elif hasattr(base, "nprobe"):
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=self.config.get("IVF_NPROBE", 32))
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        # 参数对象只保存指针，位图和选择器需要在检索期间保持存活
+        return params, (packed, selector)
+
+    def exact_search(self, vectors, rows, k):
+        """候选行较少时直接取回向量精确打分（IVF-PQ没有行号到向量的映射，不支持）"""
+        scores = vectors @ self.index.reconstruct_batch(np.asarray(rows, dtype=np.int64)).T
+        top = np.argsort(-scores, axis=1)[:, :k]
+        return np.take_along_axis(scores, top, axis=1), np.asarray(rows, dtype=np.int64)[top]
+
+    def query(self, embedding, top_k, where=None):
+        """向量检索"""
+        return self.query_many([embedding], top_k, where)[0]
+
+    def query_many(self, embeddings, top_k, where=None):
+        """批量向量检索（一次FAISS调用），返回每个查询的结果列表
+
+        过滤条件和墓碑先在元数据索引上求出候选行位图：候选行很少时直接精确打分，
+        否则把位图作为IDSelector传给FAISS，只在候选行内检索；
+        索引无法精确表达的条件多取候选再逐行检查。
+        """
+        vectors = self.as_vectors(embeddings)
+        empty = [[] for _ in range(len(vectors))]
+        with self.lock:
+            total = self.index.ntotal
+            if total == 0:
+                return empty
+            bitmap, exact = self.rows.index.evaluate(where) if where else (None, True)
+            overfetch = 1 if exact else self.config.get("OVERFETCH", 10)
+
+            if bitmap is None and not self.rows.deleted:
+                scores, labels = self.index.search(vectors, min(top_k * overfetch, total))
+            else:
+                alive = self.rows.index.alive.values
+                allowed = alive if bitmap is None else alive & bitmap
+                candidates = int(allowed.sum())
+                if candidates == 0:
+                    return empty
+                k = min(top_k * overfetch, candidates)
+                if candidates <= self.config.get("EXACT_FILTER_ROWS", 4096) and isinstance(self.index, self.faiss.IndexIDMap2):
+                    scores, labels = self.exact_search(vectors, np.flatnonzero(allowed), k)
+                else:
+                    params, keep_alive = self.search_params(allowed, k)
+                    scores, labels = self.index.search(vectors, k, params=params)
+
+            stored = self.rows.fetch_rows(np.unique(labels[labels >= 0]))
+
+        results = []
+        for rows, row_scores in zip(labels, scores):
+            hits = []
+            for row, score in zip(rows, row_scores):
+                row = int(row)
+                if row < 0 or row not in stored:
+                    continue
+                doc_id, document, metadata = stored[row]
+                if not exact and not matches_filter(metadata, where):
+                    continue
+                hits.append((doc_id, float(scores_to_distances(score, self.metric)), document, metadata))
+                if len(hits) >= top_k:
+                    break
+            results.append(hits)
+        return results
+
+    def get(self, ids):
+        """按ID取回正文和元数据，返回 {ID: (正文, 元数据)}"""
+        with self.lock:
+            return self.rows.get(ids)
+
+    def update(self, doc_id, document=None, metadata=None, embedding=None):
+        """更新单个文本块；更新向量时写入新行并将旧行标记为墓碑"""
+        stored = self.get([doc_id])
+        if doc_id not in stored:
+            raise KeyError(doc_id)
+        if embedding is not None:
+            old_document, old_metadata = stored[doc_id]
+            self.write([doc_id], [embedding],
+                       [document if document is not None else old_document],
+                       [metadata if metadata is not None else old_metadata], upsert=True)
+            return
+        with self.lock:
+            self.rows.update(doc_id, document, metadata)
+
+    def delete(self, ids):
+        """删除文本块（标记墓碑）"""
+        with self.lock:
+            self.rows.delete(ids)
+
+    def tombstone_ratio(self):
+        """仍在索引中的墓碑行占全部行的比例"""
+        with self.lock:
+            return self.rows.deleted / self.rows.next_row if self.rows.next_row else 0.0
+
+    def compact(self):
+        """从索引中移除墓碑向量（行号不变）；HNSW不支持删除，用保留的向量重建图
+
+        先原子写入新索引再提交映射表，中断时墓碑仍由元数据索引排除。
+        """
+        with self.lock:
+            if self.pending_rows:
+                self.train_pending()
+            tombstones = np.asarray(self.rows.tombstone_rows(), dtype=np.int64)
+            if not len(tombstones):
+                return 0
+            base = self.index
+            if isinstance(base, self.faiss.IndexIDMap2):
+                base = self.faiss.downcast_index(base.index)
+            if hasattr(base, "hnsw"):
+                alive = np.flatnonzero(self.rows.index.alive.values).astype(np.int64)
+                index = self.new_index("hnsw")
+                if len(alive):
+                    index.add_with_ids(self.index.reconstruct_batch(alive), alive)
+                self.index = index
+                self.configure_search()
+            else:
+                self.index.remove_ids(self.faiss.IDSelectorBatch(len(tombstones), self.faiss.swig_ptr(tombstones)))
+            tmp_path = self.index_path + ".tmp"
+            self.faiss.write_index(self.index, tmp_path)
+            os.replace(tmp_path, self.index_path)
+            self.rows.compact()
+            print(f"已从FAISS索引移除 {len(tombstones)} 个墓碑向量")
+            return len(tombstones)
+
+    def flush(self):
+        """训练剩余的暂存向量，原子写入索引文件并提交旁路表"""
+        with self.lock:
+            if self.pending_rows:
+                self.train_pending()
+            tmp_path = self.index_path + ".tmp"
+            self.faiss.write_index(self.index, tmp_path)
+            os.replace(tmp_path, self.index_path)
+            self.rows.commit()
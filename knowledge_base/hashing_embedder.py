@@ -0,0 +1,118 @@
+# 离线特征哈希嵌入器（模型无法加载时的备用方案）
+
+import os
+import re
+import zlib
+import numpy as np
+import jieba
+
+# 分词时忽略的空白和标点
+SKIP_TOKEN_PATTERN = re.compile(r'^[\s\W_]+$')
+
+# 备用嵌入器构建的集合在schema中记录的模型名
+HASHING_FALLBACK_MODEL = "hashing-fallback"
+# IDF统计文件名（保存在知识库版本目录中，与集合一起发布和回滚）
+HASHING_IDF_FILE = "hashing_idf.npz"
+
+class HashingEmbedder:
+    """基于jieba词语和字符n-gram的特征哈希 + TF-IDF嵌入，不需要下载模型"""
+
+    def __init__(self, dim=1024, ngram_range=(2, 3), idf_path=None):
+        self.dim = dim
+        self.ngram_range = tuple(ngram_range)
+        self.idf_path = idf_path
+        self.hash_cache = {}
+
+        # 文档频率统计（按哈希桶）
+        self.doc_count = 0
+        self.doc_freq = np.zeros(dim, dtype=np.float64)
+        self.load_idf()
+
+    def reset(self):
+        """清空文档频率统计"""
+        self.doc_count = 0
+        self.doc_freq = np.zeros(self.dim, dtype=np.float64)
+
+    def load_idf(self):
+        """加载持久化的文档频率统计"""
+        if self.idf_path and os.path.exists(self.idf_path):
+            try:
+                data = np.load(self.idf_path)
+                if data["doc_freq"].shape[0] == self.dim:
+                    self.doc_count = int(data["doc_count"])
+                    self.doc_freq = data["doc_freq"].astype(np.float64)
+            except Exception as e:
+                print(f"Error loading hashing idf: {e}")
+
+    def save_idf(self):
+        """保存文档频率统计，查询进程使用同一份IDF"""
+        if not self.idf_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.idf_path)), exist_ok=True)
+        tmp_path = self.idf_path + ".tmp.npz"
+        np.savez(tmp_path, doc_count=self.doc_count, doc_freq=self.doc_freq)
+        os.replace(tmp_path, self.idf_path)
+
+    def features(self, text):
+        """提取特征：jieba词语（关闭HMM，未登录词由n-gram覆盖） + 去空白后的字符n-gram"""
+        text = text.lower()
+        features = [token for token in jieba.lcut(text, HMM=False) if not SKIP_TOKEN_PATTERN.match(token)]
+        compact = re.sub(r'\s+', '', text)
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            features.extend("#" + compact[i:i + n] for i in range(len(compact) - n + 1))
+        return features
+
+    def hash_feature(self, feature):
+        """特征哈希：低位决定桶号，最高位决定符号"""
+        value = self.hash_cache.get(feature)
+        if value is None:
+            if len(self.hash_cache) > 1000000:
+                self.hash_cache.clear()
+            value = zlib.crc32(feature.encode('utf-8'))
+            self.hash_cache[feature] = value
+        return value
+
+    def hashed_counts(self, texts):
+        """批量计算带符号的哈希词频矩阵"""
+        rows = []
+        hashes = []
+        for row, text in enumerate(texts):
+            feature_hashes = [self.hash_feature(feature) for feature in self.features(text)]
+            rows.extend([row] * len(feature_hashes))
+            hashes.extend(feature_hashes)
+
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = (hashes % self.dim).astype(np.int64)
+        signs = np.where((hashes >> 31) & 1, -1.0, 1.0)
+
+        flat_index = rows * self.dim + columns
+        counts = np.bincount(flat_index, weights=signs, minlength=len(texts) * self.dim)
+        return counts.reshape(len(texts), self.dim)
+
+    def idf(self):
+        """平滑IDF，未拟合时所有维度权重相同"""
+        return np.log((1.0 + self.doc_count) / (1.0 + self.doc_freq)) + 1.0
+
+    def fit(self, texts, save=True, block_size=4096):
+        """用整个语料重新拟合文档频率统计（构建时调用一次，不在旧统计上累加；分块计数控制内存）"""
+        self.reset()
+        for start in range(0, len(texts), block_size):
+            counts = self.hashed_counts(texts[start:start + block_size])
+            self.doc_freq += (counts != 0).sum(axis=0)
+        self.doc_count = len(texts)
+        if save:
+            self.save_idf()
+        return self
+
+    def embed(self, texts, counts=None):
+        """批量嵌入，返回L2归一化的float32矩阵"""
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        if counts is None:
+            counts = self.hashed_counts(texts)
+
+        # 亚线性词频 × IDF
+        weights = np.sign(counts) * np.log1p(np.abs(counts)) * self.idf()
+        norms = np.linalg.norm(weights, axis=1, keepdims=True)
+        return (weights / np.maximum(norms, 1e-12)).astype(np.float32)
@@ -0,0 +1,153 @@
+# 元数据过滤条件（与chromadb的where语法兼容）
+
+import re
+from config.data_sources import MVP_DISEASES
+
+# 比较运算符
+OPERATORS = {
+    "$eq": lambda value, target: value == target,
+    "$ne": lambda value, target: value != target,
+    "$gt": lambda value, target: value is not None and value > target,
+    "$gte": lambda value, target: value is not None and value >= target,
+    "$lt": lambda value, target: value is not None and value < target,
+    "$lte": lambda value, target: value is not None and value <= target,
+    "$in": lambda value, target: value in target,
+    "$nin": lambda value, target: value not in target
+}
+
+# 建立取值位图的类别字段
+INDEXED_FIELDS = ("source", "source_organization", "chunk_type")
+
+# 日期字段 -> 入库时写入的整数字段（YYYYMMDD，缺少的月、日记为00）
+DATE_FIELDS = {"publication_date": "publication_date_value"}
+
+# 标签字段 -> 标签词表；每个标签入库为一个布尔字段（如 "disease:高血压"）
+TAG_FIELDS = {"disease": MVP_DISEASES}
+
+DATE_PATTERN = re.compile(r'(\d{4})(?:\s*[-/.年]\s*(\d{1,2}))?(?:\s*[-/.月]\s*(\d{1,2}))?')
+
+def matches_filter(metadata, where):
+    """判断元数据是否满足过滤条件
+
+    支持 {"字段": 值}、{"字段": {"$eq"/"$ne"/"$gt"/"$gte"/"$lt"/"$lte"/"$in"/"$nin": 值}}
+    以及 {"$and": [...]}、{"$or": [...]} 组合。
+    """
+    if not where:
+        return True
+    metadata = metadata or {}
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, item) for item in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_filter(metadata, item) for item in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for operator, target in condition.items():
+                if operator not in OPERATORS:
+                    raise ValueError(f"Unsupported filter operator: {operator}")
+                if not OPERATORS[operator](value, target):
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+def parse_date(value, upper=False):
+    """把 "2022年3月"、"2021-05-01"、2020 等日期转换为整数 YYYYMMDD，无法识别时返回None
+
+    upper为True时缺少的月、日补99（区间上界），否则补00。
+    """
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, int):
+        value = str(value)
+    match = DATE_PATTERN.search(str(value))
+    if not match:
+        return None
+    year, month, day = match.groups()
+    missing = 99 if upper else 0
+    return int(year) * 10000 + (int(month) if month else missing) * 100 + (int(day) if day else missing)
+
+def tag_key(field, tag):
+    """标签对应的布尔字段名"""
+    return f"{field}:{tag}"
+
+def filter_fields(metadata, text=None):
+    """由完整元数据计算入库时附加的可过滤字段：日期整数和标签布尔字段
+
+    text为None时不计算标签（例如只更新元数据时）。
+    """
+    fields = {}
+    for field, value_field in DATE_FIELDS.items():
+        value = parse_date(metadata.get(field))
+        if value is not None:
+            fields[value_field] = value
+    if text is not None:
+        for field, tags in TAG_FIELDS.items():
+            for tag in tags:
+                fields[tag_key(field, tag)] = tag in text
+    return fields
+
+def date_condition(value_field, operator, target):
+    """把日期字段上的单个条件改写为整数字段上的区间条件
+
+    部分日期表示一个区间："2020" 即 [20200000, 20209999]，
+    因此 $gt "2020" 从2021年开始，$eq "2020" 匹配2020年内的所有日期。
+    没有日期的文本块不满足任何日期条件（包括 $ne、$nin），chromadb后端无法表达"字段缺失"，各后端保持一致。
+    """
+    if operator in ("$in", "$nin"):
+        parts = [date_condition(value_field, "$eq", item) for item in target]
+        if operator == "$in":
+            return {"$or": parts} if len(parts) > 1 else parts[0]
+        return {"$and": [date_condition(value_field, "$ne", item) for item in target]} if len(target) > 1 \
+            else date_condition(value_field, "$ne", target[0])
+    low, high = parse_date(target), parse_date(target, upper=True)
+    if low is None:
+        raise ValueError(f"Unrecognized date in filter: {target}")
+    if operator in ("$gt", "$lte"):
+        return {value_field: {operator: high}}
+    if operator in ("$gte", "$lt"):
+        return {value_field: {operator: low}}
+    if operator == "$eq":
+        return {"$and": [{value_field: {"$gte": low}}, {value_field: {"$lte": high}}]}
+    if operator == "$ne":
+        return {"$or": [{value_field: {"$lt": low}}, {value_field: {"$gt": high}}]}
+    raise ValueError(f"Unsupported filter operator: {operator}")
+
+def tag_condition(field, operator, target):
+    """把标签字段上的单个条件改写为标签布尔字段上的条件"""
+    if operator == "$eq":
+        return {tag_key(field, target): True}
+    if operator == "$ne":
+        return {tag_key(field, target): {"$ne": True}}
+    if operator in ("$in", "$nin"):
+        parts = [tag_condition(field, "$eq" if operator == "$in" else "$ne", tag) for tag in target]
+        if len(parts) == 1:
+            return parts[0]
+        return {"$or": parts} if operator == "$in" else {"$and": parts}
+    raise ValueError(f"Unsupported filter operator for tag field {field}: {operator}")
+
+def normalize_where(where):
+    """把面向用户的过滤条件改写为入库字段上的条件（日期转为整数区间，标签转为布尔字段）
+
+    例如 {"$and": [{"source_organization": "中国CDC"}, {"publication_date": {"$gt": "2020"}}]}
+    改写为 {"$and": [{"source_organization": "中国CDC"}, {"publication_date_value": {"$gt": 20209999}}]}。
+    每个条件只保留一个键，兼容chromadb。
+    """
+    if not where:
+        return where
+    parts = []
+    for key, condition in where.items():
+        if key in ("$and", "$or"):
+            parts.append({key: [normalize_where(item) for item in condition]})
+            continue
+        conditions = condition.items() if isinstance(condition, dict) else [("$eq", condition)]
+        for operator, target in conditions:
+            if key in DATE_FIELDS:
+                parts.append(date_condition(DATE_FIELDS[key], operator, target))
+            elif key in TAG_FIELDS:
+                parts.append(tag_condition(key, operator, target))
+            else:
+                parts.append({key: {operator: target}} if isinstance(condition, dict) else {key: target})
+    return parts[0] if len(parts) == 1 else {"$and": parts}
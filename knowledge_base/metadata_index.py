@@ -0,0 +1,207 @@
+# 元数据预过滤索引：按行号保存类别字段的取值编码和日期整数，过滤条件在向量打分之前转换为行位图
+
+import os
+import json
+from functools import reduce
+import numpy as np
+from knowledge_base.metadata_filter import INDEXED_FIELDS, DATE_FIELDS, TAG_FIELDS, tag_key
+
+# 整数字段缺失值
+MISSING = np.iinfo(np.int64).min
+
+class Column:
+    """按容量倍增的numpy列（追加为均摊O(1)，视图不会阻塞扩容）"""
+
+    def __init__(self, dtype, fill):
+        self.dtype = dtype
+        self.fill = fill
+        self.data = np.full(1024, fill, dtype=dtype)
+        self.size = 0
+
+    @property
+    def values(self):
+        """有效部分的视图"""
+        return self.data[:self.size]
+
+    def extend(self, values):
+        """追加一批值"""
+        values = np.asarray(values, dtype=self.dtype)
+        end = self.size + len(values)
+        if end > len(self.data):
+            data = np.full(max(end, len(self.data) * 2), self.fill, dtype=self.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:end] = values
+        self.size = end
+
+class MetadataIndex:
+    """行号 -> 可过滤字段的内存索引
+
+    类别字段（来源、机构、块类型、疾病标签）保存取值编码，每个取值的行位图按需生成并缓存；
+    日期字段保存整数 YYYYMMDD。evaluate 把过滤条件转换为候选行位图，调用方只对位图内的行打分。
+    """
+
+    def __init__(self):
+        self.categorical_fields = list(INDEXED_FIELDS) + [tag_key(field, tag) for field, tags in TAG_FIELDS.items()
+                                                          for tag in tags]
+        self.numeric_fields = list(DATE_FIELDS.values())
+        self.reset()
+
+    def reset(self):
+        """清空索引"""
+        self.alive = Column(bool, False)
+        self.codes = {field: Column(np.int32, -1) for field in self.categorical_fields}
+        self.vocab = {field: {} for field in self.categorical_fields}
+        self.numbers = {field: Column(np.int64, MISSING) for field in self.numeric_fields}
+        self.bitmaps = {}
+
+    def __len__(self):
+        return self.alive.size
+
+    def encode(self, field, value):
+        """类别取值 -> 编码（不可索引的取值记为-1）"""
+        if not isinstance(value, (str, bool, int, float)):
+            return -1
+        vocab = self.vocab[field]
+        code = vocab.get(value)
+        if code is None:
+            code = len(vocab)
+            vocab[value] = code
+        return code
+
+    def add(self, rows, metadatas, deleted=None):
+        """追加一批行（行号必须从当前行数开始连续）"""
+        if not len(rows):
+            return
+        if rows[0] != len(self):
+            raise ValueError(f"Metadata index expects row {len(self)}, got {rows[0]}")
+        metadatas = [metadata or {} for metadata in metadatas]
+        for field in self.categorical_fields:
+            self.codes[field].extend([self.encode(field, metadata.get(field)) for metadata in metadatas])
+        for field in self.numeric_fields:
+            self.numbers[field].extend([
+                metadata[field] if isinstance(metadata.get(field), int) else MISSING for metadata in metadatas
+            ])
+        self.alive.extend([True] * len(rows) if deleted is None else [not flag for flag in deleted])
+        self.bitmaps = {}
+
+    def set(self, row, metadata):
+        """更新单行的元数据"""
+        for field in self.categorical_fields:
+            self.codes[field].data[row] = self.encode(field, metadata.get(field))
+        for field in self.numeric_fields:
+            value = metadata.get(field)
+            self.numbers[field].data[row] = value if isinstance(value, int) else MISSING
+        self.bitmaps = {}
+
+    def mark_deleted(self, rows):
+        """标记墓碑行"""
+        self.alive.data[list(rows)] = False
+
+    def bitmap(self, field, value):
+        """某个类别取值的行位图（缓存到下次写入）"""
+        key = (field, value)
+        bitmap = self.bitmaps.get(key)
+        if bitmap is None:
+            code = self.vocab[field].get(value) if isinstance(value, (str, bool, int, float)) else None
+            if code is None:
+                bitmap = np.zeros(len(self), dtype=bool)
+            else:
+                bitmap = self.codes[field].values == code
+            self.bitmaps[key] = bitmap
+        return bitmap
+
+    def leaf(self, field, operator, target):
+        """单个条件的行位图，字段未建索引或运算符不支持时返回None"""
+        if field in self.vocab:
+            if operator in ("$eq", "$ne"):
+                bitmap = self.bitmap(field, target)
+            elif operator in ("$in", "$nin"):
+                bitmap = reduce(np.logical_or, [self.bitmap(field, value) for value in target],
+                                np.zeros(len(self), dtype=bool))
+            else:
+                return None
+            return bitmap if operator in ("$eq", "$in") else ~bitmap
+        if field in self.numbers:
+            values = self.numbers[field].values
+            present = values != MISSING
+            if operator in ("$in", "$nin"):
+                bitmap = np.isin(values, [value for value in target if isinstance(value, int)])
+                return bitmap if operator == "$in" else ~bitmap
+            if not isinstance(target, int) or isinstance(target, bool):
+                return None
+            if operator == "$eq":
+                return values == target
+            if operator == "$ne":
+                return values != target
+            if operator == "$gt":
+                return present & (values > target)
+            if operator == "$gte":
+                return present & (values >= target)
+            if operator == "$lt":
+                return present & (values < target)
+            if operator == "$lte":
+                return present & (values <= target)
+        return None
+
+    def evaluate(self, where):
+        """把过滤条件转换为 (候选行位图, 是否精确)
+
+        无法用索引计算的条件不缩小候选集：$and 中跳过该项，$or 中整体返回None。
+        位图不精确时调用方仍需逐行检查过滤条件。
+        """
+        parts = []
+        for key, condition in where.items():
+            if key in ("$and", "$or"):
+                results = [self.evaluate(item) for item in condition]
+                if key == "$and":
+                    parts.extend(results)
+                elif any(bitmap is None for bitmap, _ in results):
+                    parts.append((None, False))
+                else:
+                    parts.append((reduce(np.logical_or, [bitmap for bitmap, _ in results]),
+                                  all(exact for _, exact in results)))
+            elif isinstance(condition, dict):
+                for operator, target in condition.items():
+                    bitmap = self.leaf(key, operator, target)
+                    parts.append((bitmap, bitmap is not None))
+            else:
+                bitmap = self.leaf(key, "$eq", condition)
+                parts.append((bitmap, bitmap is not None))
+
+        bitmaps = [bitmap for bitmap, _ in parts if bitmap is not None]
+        if not bitmaps:
+            return None, False
+        return reduce(np.logical_and, bitmaps), all(exact for _, exact in parts)
+
+    def save(self, path):
+        """原子写入索引文件"""
+        header = {
+            "categorical_fields": self.categorical_fields,
+            "numeric_fields": self.numeric_fields,
+            "vocab": [list(self.vocab[field].items()) for field in self.categorical_fields]
+        }
+        arrays = {"alive": self.alive.values}
+        arrays.update({f"codes_{i}": self.codes[field].values for i, field in enumerate(self.categorical_fields)})
+        arrays.update({f"numbers_{i}": self.numbers[field].values for i, field in enumerate(self.numeric_fields)})
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, header=np.array(json.dumps(header, ensure_ascii=False)), **arrays)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """加载索引文件；文件不存在或索引字段与当前配置不一致时返回False"""
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as data:
+            header = json.loads(str(data["header"]))
+            if header["categorical_fields"] != self.categorical_fields or header["numeric_fields"] != self.numeric_fields:
+                return False
+            self.reset()
+            self.alive.extend(data["alive"])
+            for i, field in enumerate(self.categorical_fields):
+                self.codes[field].extend(data[f"codes_{i}"])
+                self.vocab[field] = {value: code for value, code in header["vocab"][i]}
+            for i, field in enumerate(self.numeric_fields):
+                self.numbers[field].extend(data[f"numbers_{i}"])
+        return True
@@ -0,0 +1,34 @@
+# 距离度量：嵌入向量在入库和查询时各L2归一化一次，检索只做内积；三种度量给出相同的排序，只是距离的尺度不同
+
+import numpy as np
+
+METRIC_COSINE = "cosine"  # 距离 = 1 - 余弦相似度
+METRIC_IP = "ip"          # 距离 = 1 - 内积（与chromadb的ip一致）
+METRIC_L2 = "l2"          # 距离 = 平方欧氏距离（与chromadb的l2一致）
+METRICS = (METRIC_COSINE, METRIC_IP, METRIC_L2)
+
+def check_metric(metric):
+    """校验距离度量名称"""
+    if metric not in METRICS:
+        raise ValueError(f"Unsupported distance metric: {metric}")
+    return metric
+
+def normalize_embeddings(embeddings):
+    """转换为float32矩阵并L2归一化（零向量保持为零）"""
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def scores_to_distances(scores, metric):
+    """单位向量的内积 -> 度量下的距离（越小越相似）"""
+    if metric == METRIC_L2:
+        return 2.0 - 2.0 * scores
+    return 1.0 - scores
+
+def distance_to_similarity(distance, metric):
+    """度量下的距离 -> 余弦相似度（向量均为单位向量，相似度阈值在这一尺度上比较）"""
+    if metric == METRIC_L2:
+        return 1.0 - distance / 2.0
+    return 1.0 - distance
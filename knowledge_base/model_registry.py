@@ -0,0 +1,126 @@
+# 进程内共享的模型注册表（每个模型只加载一次，支持后台预热）
+
+import time
+import threading
+
+# 加载状态
+STATE_PENDING = "pending"
+STATE_LOADING = "loading"
+STATE_READY = "ready"
+STATE_FAILED = "failed"
+
+class ModelRegistry:
+    """按名称登记模型/组件，首次使用时加载，之后所有调用方共享同一个实例"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def claim(self, name, loader):
+        """获取条目；返回 (条目, 是否由当前线程负责加载)"""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                entry = {
+                    "state": STATE_PENDING,
+                    "value": None,
+                    "error": None,
+                    "loader": loader,
+                    "event": threading.Event(),
+                    "started": None,
+                    "seconds": None
+                }
+                self.entries[name] = entry
+            if entry["state"] == STATE_PENDING:
+                entry["state"] = STATE_LOADING
+                entry["started"] = time.monotonic()
+                return entry, True
+            return entry, False
+
+    def load(self, name, entry):
+        """执行加载函数并记录结果，唤醒所有等待者"""
+        try:
+            value = entry["loader"]()
+            entry["value"] = value
+            entry["state"] = STATE_READY
+            print(f"模型 {name} 加载完成，耗时 {time.monotonic() - entry['started']:.1f} 秒")
+        except Exception as e:
+            entry["error"] = str(e)
+            entry["state"] = STATE_FAILED
+            print(f"Error loading {name}: {e}")
+        finally:
+            entry["seconds"] = time.monotonic() - entry["started"]
+            entry["event"].set()
+
+    def get(self, name, loader, timeout=None):
+        """获取模型，未加载时在当前线程加载；其他线程正在加载时等待其完成
+
+        加载失败时抛出RuntimeError；等待超时时抛出TimeoutError。
+        """
+        entry, owner = self.claim(name, loader)
+        if owner:
+            self.load(name, entry)
+        elif not entry["event"].wait(timeout):
+            raise TimeoutError(f"模型 {name} 仍在加载")
+
+        if entry["state"] == STATE_FAILED:
+            raise RuntimeError(f"模型 {name} 加载失败: {entry['error']}")
+        return entry["value"]
+
+    def warm(self, name, loader):
+        """在后台线程中开始加载（已加载或正在加载时不做任何事）"""
+        entry, owner = self.claim(name, loader)
+        if owner:
+            thread = threading.Thread(target=self.load, args=(name, entry), name=f"warm-{name}", daemon=True)
+            thread.start()
+        return entry["event"]
+
+    def peek(self, name):
+        """已就绪时返回模型，否则返回None（不触发加载）"""
+        entry = self.entries.get(name)
+        if entry is not None and entry["state"] == STATE_READY:
+            return entry["value"]
+        return None
+
+    def is_ready(self, name):
+        """模型是否已加载完成"""
+        entry = self.entries.get(name)
+        return entry is not None and entry["state"] == STATE_READY
+
+    def state(self, name):
+        """模型的加载状态（未登记时为pending）"""
+        entry = self.entries.get(name)
+        return entry["state"] if entry is not None else STATE_PENDING
+
+    def reset_failed(self, older_than=0.0):
+        """移除失败超过older_than秒的所有失败条目，下次使用时重新加载（依赖它们的组件也一起重试），返回移除的名称"""
+        now = time.monotonic()
+        with self.lock:
+            names = [name for name, entry in self.entries.items()
+                     if entry["state"] == STATE_FAILED and now - entry["started"] - entry["seconds"] >= older_than]
+            for name in names:
+                del self.entries[name]
+        return names
+
+    def status(self):
+        """所有模型的加载状态，用于健康检查"""
+        with self.lock:
+            entries = list(self.entries.items())
+        now = time.monotonic()
+        return {
+            name: {
+                "state": entry["state"],
+                "seconds": entry["seconds"] if entry["seconds"] is not None
+                else (now - entry["started"] if entry["started"] is not None else 0.0),
+                "error": entry["error"]
+            }
+            for name, entry in entries
+        }
+
+# 进程级单例
+registry = ModelRegistry()
+
+def get_embedder():
+    """进程内共享的MedicalEmbedder（检索、Web界面等组件共用同一个模型和微批处理线程）"""
+    from knowledge_base.embedder import MedicalEmbedder
+    return registry.get("embedder", MedicalEmbedder)
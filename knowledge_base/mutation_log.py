@@ -0,0 +1,260 @@
+# 变更日志：更新和删除先成组写入预写日志（一次fsync），再由后台线程批量应用到存储后端
+
+import os
+import json
+import base64
+import threading
+import numpy as np
+
+# 变更类型
+OP_UPSERT = "upsert"   # 完整的行（向量、正文、元数据），覆盖已存在的ID
+OP_UPDATE = "update"   # 部分字段更新，为None的字段保持不变
+OP_DELETE = "delete"
+
+def merge_mutation(previous, mutation):
+    """把同一文本块先后两次变更合并为一次"""
+    if previous is None or mutation["op"] != OP_UPDATE:
+        return mutation
+    if previous["op"] == OP_DELETE:
+        # 删除之后的更新不生效
+        return previous
+    merged = dict(previous)
+    for field in ("document", "metadata", "embedding"):
+        if mutation.get(field) is not None:
+            merged[field] = mutation[field]
+    merged["seq"] = mutation["seq"]
+    return merged
+
+def coalesce(mutations):
+    """按文本块ID合并一批变更，返回 {ID: 最终变更}"""
+    final = {}
+    for mutation in mutations:
+        final[mutation["id"]] = merge_mutation(final.get(mutation["id"]), mutation)
+    return final
+
+def encode_mutation(mutation):
+    """变更 -> 日志行（向量以float32的base64保存）"""
+    record = {key: value for key, value in mutation.items() if key != "seq" and value is not None}
+    if "embedding" in record:
+        record["embedding"] = base64.b64encode(np.asarray(record["embedding"], dtype=np.float32).tobytes()).decode("ascii")
+    if "sparse" in record:
+        record["sparse"] = [[int(token_id), float(weight)] for token_id, weight in record["sparse"].items()]
+    return json.dumps(record, ensure_ascii=False)
+
+def decode_mutation(line):
+    """日志行 -> 变更"""
+    mutation = json.loads(line)
+    if "embedding" in mutation:
+        mutation["embedding"] = np.frombuffer(base64.b64decode(mutation["embedding"]), dtype=np.float32).tolist()
+    if "sparse" in mutation:
+        mutation["sparse"] = {token_id: weight for token_id, weight in mutation["sparse"]}
+    return mutation
+
+class MutationLog:
+    """集合的预写变更日志
+
+    append 把变更放入内存队列，变更立即对本进程的查询可见（pending，读己之写）。
+    写日志线程把队列中积累的变更一次写入日志文件并fsync（成组提交：前一次fsync期间到达的变更共用下一次fsync）；
+    应用线程等待 apply_delay_ms 收集更多已持久化的变更，按文本块ID合并后调用 apply 批量应用到存储后端
+    （每组只落盘一次），全部应用后清空日志文件。
+    进程在应用前中断时，下次以可写模式打开集合会重放日志中的变更（变更是幂等的）。
+    同一组变更连续 max_attempts 次应用失败时移入隔离文件（path + ".quarantine"），不再阻塞后续变更。
+    """
+
+    def __init__(self, path, apply, group_commit_ms=0, apply_delay_ms=100, max_batch=1000, retry_seconds=5,
+                 max_attempts=5):
+        self.path = path
+        self.quarantine_path = path + ".quarantine"
+        self.apply = apply
+        self.max_attempts = max_attempts
+        self.failed_attempts = 0
+        self.group_commit_seconds = group_commit_ms / 1000
+        self.apply_delay_seconds = apply_delay_ms / 1000
+        self.max_batch = max_batch
+        self.retry_seconds = retry_seconds
+
+        self.condition = threading.Condition()
+        # 写日志与清空日志互斥
+        self.file_lock = threading.Lock()
+        self.queue = []       # 尚未写入日志文件的变更
+        self.unapplied = []   # 已写入日志文件、尚未应用的变更
+        self.pending = {}     # 文本块ID -> 尚未应用的合并后变更
+        self.next_seq = 0
+        self.durable_seq = -1
+        self.applied_seq = -1
+        self.closed = False
+        # 后台线程已退出（在通知前设置，避免等待方错过退出）
+        self.writer_done = False
+        self.applier_done = False
+
+        self.replay()
+        self.writer = threading.Thread(target=self.write_loop, name="mutation-log-writer", daemon=True)
+        self.applier = threading.Thread(target=self.apply_loop, name="mutation-log-applier", daemon=True)
+        self.writer.start()
+        self.applier.start()
+
+    def replay(self):
+        """读取上次未应用完的日志；中断时写了一半的最后一行被截掉，之后追加的变更不会接在残行后面"""
+        if not os.path.exists(self.path):
+            return
+        valid_bytes = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    mutation = decode_mutation(line.decode('utf-8'))
+                except ValueError:
+                    break
+                valid_bytes += len(line)
+                mutation["seq"] = self.next_seq
+                self.next_seq += 1
+                self.unapplied.append(mutation)
+                self.pending[mutation["id"]] = merge_mutation(self.pending.get(mutation["id"]), mutation)
+        if valid_bytes < os.path.getsize(self.path):
+            print(f"变更日志末尾有不完整的记录，截断到 {valid_bytes} 字节")
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_bytes)
+                os.fsync(f.fileno())
+        self.durable_seq = self.next_seq - 1
+        if self.unapplied:
+            print(f"重放变更日志: {len(self.unapplied)} 条未应用的变更")
+
+    def append(self, mutations, wait=True):
+        """追加一批变更，返回最后一条的序号；wait为True时等到变更写入日志文件（持久化）后返回"""
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Mutation log is closed")
+            for mutation in mutations:
+                mutation["seq"] = self.next_seq
+                self.next_seq += 1
+                self.queue.append(mutation)
+                self.pending[mutation["id"]] = merge_mutation(self.pending.get(mutation["id"]), mutation)
+            seq = self.next_seq - 1
+            self.condition.notify_all()
+            if wait:
+                self.condition.wait_for(lambda: self.durable_seq >= seq or self.writer_done)
+        return seq
+
+    def pending_mutations(self):
+        """尚未应用到存储后端的变更 {ID: 变更}（查询时叠加在存储结果之上）"""
+        with self.condition:
+            return dict(self.pending)
+
+    def sync(self, timeout=None):
+        """等待目前为止追加的变更全部应用，超时返回False"""
+        with self.condition:
+            seq = self.next_seq - 1
+            self.condition.wait_for(lambda: self.applied_seq >= seq or self.applier_done, timeout=timeout)
+            return self.applied_seq >= seq
+
+    def close(self):
+        """写入并应用剩余变更后停止后台线程"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.writer.join()
+        self.applier.join()
+
+    def write_loop(self):
+        """写日志线程：成组提交"""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or self.closed)
+                if not self.queue:
+                    self.writer_done = True
+                    self.condition.notify_all()
+                    return
+                if self.group_commit_seconds and len(self.queue) < self.max_batch and not self.closed:
+                    self.condition.wait_for(lambda: len(self.queue) >= self.max_batch or self.closed,
+                                            timeout=self.group_commit_seconds)
+                batch = self.queue
+                self.queue = []
+
+            with self.file_lock:
+                try:
+                    self.write(batch)
+                except Exception as e:
+                    print(f"写入变更日志失败: {e}")
+                    with self.condition:
+                        self.queue = batch + self.queue
+                        self.condition.wait(timeout=self.retry_seconds)
+                    continue
+                with self.condition:
+                    self.unapplied.extend(batch)
+                    self.durable_seq = batch[-1]["seq"]
+                    self.condition.notify_all()
+
+    def write(self, batch):
+        """把一组变更追加到日志文件并fsync"""
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write("".join(encode_mutation(mutation) + "\n" for mutation in batch))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def apply_loop(self):
+        """应用线程：收集一段时间内已持久化的变更，合并后批量应用"""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.unapplied or self.writer_done)
+                if not self.unapplied:
+                    self.applier_done = True
+                    self.condition.notify_all()
+                    return
+                if not self.closed:
+                    self.condition.wait_for(lambda: len(self.unapplied) >= self.max_batch or self.closed,
+                                            timeout=self.apply_delay_seconds)
+                batch = self.unapplied[:self.max_batch]
+
+            if self.apply_batch(batch):
+                continue
+            with self.condition:
+                if self.writer_done:
+                    print(f"{len(self.unapplied)} 条变更未能应用，保留在日志中，下次打开集合时重放")
+                    self.applier_done = True
+                    self.condition.notify_all()
+                    return
+                self.condition.wait(timeout=self.retry_seconds)
+
+    def apply_batch(self, batch):
+        """把一组已持久化的变更合并后应用到存储后端，日志中的变更全部应用后清空日志文件
+
+        连续失败达到 max_attempts 次的一组变更移入隔离文件后视为已处理，返回是否可以继续处理下一组。
+        """
+        try:
+            self.apply(list(coalesce(batch).values()))
+        except Exception as e:
+            self.failed_attempts += 1
+            print(f"应用 {len(batch)} 条变更失败（第 {self.failed_attempts}/{self.max_attempts} 次）: {e}")
+            if self.failed_attempts < self.max_attempts:
+                return False
+            try:
+                self.quarantine(batch)
+            except Exception as quarantine_error:
+                print(f"隔离变更失败: {quarantine_error}")
+                return False
+        self.failed_attempts = 0
+        self.mark_applied(batch)
+        return True
+
+    def quarantine(self, batch):
+        """把无法应用的一组变更追加到隔离文件并fsync（供人工检查后重新提交）"""
+        with open(self.quarantine_path, 'a', encoding='utf-8') as f:
+            f.write("".join(encode_mutation(mutation) + "\n" for mutation in batch))
+            f.flush()
+            os.fsync(f.fileno())
+        print(f"警告: {len(batch)} 条变更连续 {self.max_attempts} 次应用失败，已移入 {self.quarantine_path}")
+
+    def mark_applied(self, batch):
+        """从待应用队列和读己之写视图中移除一组已处理的变更，全部处理后清空日志文件"""
+        with self.condition:
+            self.unapplied = self.unapplied[len(batch):]
+            self.applied_seq = batch[-1]["seq"]
+            for doc_id in {mutation["id"] for mutation in batch}:
+                if doc_id in self.pending and self.pending[doc_id]["seq"] <= self.applied_seq:
+                    del self.pending[doc_id]
+            self.condition.notify_all()
+        with self.file_lock:
+            with self.condition:
+                if not self.unapplied:
+                    open(self.path, 'w').close()
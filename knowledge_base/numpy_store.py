@@ -0,0 +1,353 @@
+# NumPy 精确检索后端（内存映射的float16矩阵，不依赖chromadb/onnxruntime）
+
+import os
+import threading
+import numpy as np
+from knowledge_base.metadata_filter import matches_filter
+from knowledge_base.metrics import check_metric, scores_to_distances
+from knowledge_base.row_table import RowTable
+
+class NumpyStore:
+    """VectorDatabase 的 NumPy 后端
+
+    向量（由 VectorDatabase 在入库时L2归一化）按行号存放在float16的 .npy 文件中，只读打开时使用内存映射，
+    同一台机器上的多个Web进程共享操作系统页缓存。查询为分块的矩阵-向量乘积（内积）加 argpartition 取top-k，
+    返回集合度量（metric）下的距离。墓碑和元数据过滤使用 RowTable 的元数据索引（按行号对齐）。
+
+    QUANTIZATION 为 "int8" 时另存一份按维度对称量化的int8矩阵（每维一个缩放系数）：
+    全量扫描只读取int8矩阵（float32的1/4），取 top_k × RESCORE_FACTOR 个候选后，
+    再从内存映射的float16矩阵中只读取候选行精确重新打分，返回的距离与不量化时一致。
+    """
+
+    def __init__(self, persist_directory, collection_name, dim, read_only=False, config=None, metric="cosine"):
+        config = config or {}
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name
+        self.dim = dim
+        self.read_only = read_only
+        self.metric = check_metric(metric)
+        self.block_rows = config.get("BLOCK_ROWS", 16384)
+        self.overfetch = config.get("OVERFETCH", 10)
+        self.quantization = config.get("QUANTIZATION")
+        if self.quantization not in (None, "int8"):
+            raise ValueError(f"Unsupported quantization: {self.quantization}")
+        self.rescore_factor = config.get("RESCORE_FACTOR", 4)
+
+        self.matrix_path = os.path.join(persist_directory, f"{collection_name}_vectors.npy")
+        self.compact_path = os.path.join(persist_directory, f"{collection_name}_vectors.compact.npy")
+        self.codes_path = os.path.join(persist_directory, f"{collection_name}_vectors_int8.npy")
+        self.scales_path = os.path.join(persist_directory, f"{collection_name}_int8_scales.npy")
+        self.rows = RowTable(os.path.join(persist_directory, f"{collection_name}_numpy.sqlite"), read_only)
+        self.lock = threading.Lock()
+
+        # 已落盘的矩阵（内存映射）+ 尚未落盘的新增向量
+        self.matrix = np.zeros((0, dim), dtype=np.float16)
+        self.pending = []
+
+        # int8量化矩阵（与已落盘矩阵逐行对应）和每维缩放系数；为None时查询不使用量化
+        self.codes = None
+        self.scales = None
+
+    def exists(self):
+        """索引是否存在"""
+        return self.rows.exists()
+
+    def create(self):
+        """创建空索引"""
+        self.drop()
+        os.makedirs(self.persist_directory, exist_ok=True)
+        self.rows.connect()
+
+    def open(self):
+        """以内存映射方式打开向量矩阵（毫秒级，不读入内存）"""
+        self.rows.connect()
+        if os.path.exists(self.compact_path):
+            # 上次压缩在提交映射表之后、替换矩阵之前中断时完成替换，否则丢弃
+            if not self.read_only and len(np.load(self.compact_path, mmap_mode='r')) == self.rows.next_row:
+                os.replace(self.compact_path, self.matrix_path)
+            elif not self.read_only:
+                os.remove(self.compact_path)
+        if os.path.exists(self.matrix_path):
+            self.matrix = np.load(self.matrix_path, mmap_mode='r')
+        disk_rows = len(self.matrix)
+        if len(self.matrix) > self.rows.next_row:
+            # 上次落盘在提交映射表之前中断，多出的行没有对应的文本块
+            self.matrix = self.matrix[:self.rows.next_row]
+        elif len(self.matrix) < self.rows.next_row:
+            raise RuntimeError(f"Vector matrix has {len(self.matrix)} rows, row table has {self.rows.next_row}")
+        if self.quantization:
+            self.load_codes(disk_rows)
+
+    def drop(self):
+        """删除索引文件"""
+        self.rows.remove()
+        self.matrix = np.zeros((0, self.dim), dtype=np.float16)
+        self.pending = []
+        self.codes = None
+        self.scales = None
+        for path in (self.matrix_path, self.codes_path, self.scales_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def as_vectors(self, embeddings):
+        """转换为float32矩阵（向量已由调用方L2归一化，这里不再逐次归一化）"""
+        return np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+
+    def load_codes(self, disk_rows):
+        """以内存映射方式打开int8矩阵；缺失或与float16矩阵文件行数不一致时重新量化（只读模式下退化为不量化）"""
+        self.codes = None
+        if os.path.exists(self.codes_path) and os.path.exists(self.scales_path):
+            codes = np.load(self.codes_path, mmap_mode='r')
+            if len(codes) == disk_rows:
+                self.scales = np.load(self.scales_path)
+                self.codes = codes[:len(self.matrix)]
+                return
+        if not len(self.matrix):
+            return
+        if self.read_only:
+            print("int8量化矩阵缺失或已过期，本次查询不使用量化（以可写模式打开集合可重新生成）")
+            return
+        self.write_codes()
+
+    def fit_scales(self, sample_rows=100000):
+        """按样本每维绝对值的99.99分位数确定缩放系数（个别离群值截断，不拉大整体量化步长）"""
+        step = max(len(self.matrix) // sample_rows, 1)
+        sample = np.abs(self.matrix[::step].astype(np.float32))
+        return np.maximum(np.quantile(sample, 0.9999, axis=0), 1e-6).astype(np.float32) / 127
+
+    def quantize(self, vectors):
+        """float向量 -> int8编码"""
+        return np.clip(np.rint(vectors / self.scales), -127, 127).astype(np.int8)
+
+    def write_codes(self):
+        """由已落盘的float16矩阵生成int8矩阵（原子替换）；首次生成时拟合缩放系数"""
+        if self.scales is None or not os.path.exists(self.scales_path):
+            self.scales = self.fit_scales()
+            np.save(self.scales_path, self.scales)
+        tmp_path = self.codes_path + ".tmp.npy"
+        codes = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.int8, shape=self.matrix.shape)
+        for start in range(0, len(self.matrix), self.block_rows):
+            block = self.matrix[start:start + self.block_rows].astype(np.float32)
+            codes[start:start + len(block)] = self.quantize(block)
+        codes.flush()
+        del codes
+        os.replace(tmp_path, self.codes_path)
+        self.codes = np.load(self.codes_path, mmap_mode='r')
+
+    def count(self):
+        """文本块数量（不含墓碑）"""
+        with self.lock:
+            return self.rows.count()
+
+    def existing_ids(self, ids):
+        """返回已存在的ID集合"""
+        with self.lock:
+            return {row[0] for row in self.rows.lookup(ids)}
+
+    def max_batch_size(self):
+        """没有批大小限制"""
+        return None
+
+    def write(self, ids, embeddings, documents, metadatas, upsert=False):
+        """追加一批向量（行号与矩阵行一一对应）；已存在的ID在upsert时覆盖，否则保持不变"""
+        vectors = self.as_vectors(embeddings)
+        with self.lock:
+            rows, keep, _ = self.rows.insert(ids, documents, metadatas, upsert=upsert)
+            if keep:
+                self.pending.append(vectors[keep].astype(np.float16))
+
+    def blocks(self):
+        """按顺序产出 (起始行号, 向量块)，已落盘矩阵按 block_rows 分块读取"""
+        for start in range(0, len(self.matrix), self.block_rows):
+            yield start, self.matrix[start:start + self.block_rows]
+        offset = len(self.matrix)
+        for block in self.pending:
+            yield offset, block
+            offset += len(block)
+
+    def code_blocks(self):
+        """与 blocks 相同，但已落盘部分取int8矩阵（尚未落盘的新增向量仍为float16）"""
+        for start in range(0, len(self.codes), self.block_rows):
+            yield start, self.codes[start:start + self.block_rows]
+        offset = len(self.codes)
+        for block in self.pending:
+            yield offset, block
+            offset += len(block)
+
+    def gather(self, rows):
+        """按行号（升序）取出向量，只读取这些行所在的页"""
+        on_disk = int(np.searchsorted(rows, len(self.matrix)))
+        parts = [self.matrix[rows[:on_disk]]]
+        if on_disk < len(rows):
+            parts.append(np.vstack(self.pending)[rows[on_disk:] - len(self.matrix)])
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+    def candidate_blocks(self, candidates=None, quantized=False):
+        """按块产出 (行号数组, 向量块)；candidates为None时遍历所有行，quantized为True时读取int8矩阵"""
+        if candidates is None:
+            for start, block in (self.code_blocks() if quantized else self.blocks()):
+                yield np.arange(start, start + len(block)), block
+            return
+        for start in range(0, len(candidates), self.block_rows):
+            rows = candidates[start:start + self.block_rows]
+            yield rows, self.gather(rows)
+
+    def top_scores(self, vectors, k, candidates=None, allowed=None, quantized=False):
+        """分块计算矩阵乘积并逐块合并每个查询的top-k，临时内存只有 块行数 × 查询数
+
+        返回按得分降序排列的 (行号矩阵, 得分矩阵)，形状均为 查询数 × k；不足k个时得分为-inf。
+        quantized为True时int8块的得分为近似值（查询向量乘以每维缩放系数后与int8编码相乘）。
+        """
+        num_queries = len(vectors)
+        scaled = vectors * self.scales if quantized else None
+        best_rows = np.zeros((num_queries, 0), dtype=np.int64)
+        best_scores = np.zeros((num_queries, 0), dtype=np.float32)
+        for rows, block in self.candidate_blocks(candidates, quantized):
+            if block.dtype == np.int8:
+                scores = scaled @ block.astype(np.float32).T
+            else:
+                scores = vectors @ block.astype(np.float32).T
+            if allowed is not None:
+                scores[:, ~allowed[rows]] = -np.inf
+            best_scores = np.hstack([best_scores, scores])
+            best_rows = np.hstack([best_rows, np.broadcast_to(rows, scores.shape)])
+            if best_scores.shape[1] > k:
+                top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, top, axis=1)
+                best_rows = np.take_along_axis(best_rows, top, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def rescore(self, vectors, top_rows, top_scores, k):
+        """用float16矩阵对int8初筛的候选精确重新打分，返回按精确得分排列的前k个 (行号矩阵, 得分矩阵)"""
+        valid = np.isfinite(top_scores)
+        unique = np.unique(top_rows[valid])
+        if not len(unique):
+            return top_rows[:, :k], top_scores[:, :k]
+        exact = vectors @ self.gather(unique).astype(np.float32).T
+        positions = np.minimum(np.searchsorted(unique, top_rows), len(unique) - 1)
+        scores = np.where(valid, np.take_along_axis(exact, positions, axis=1), -np.inf)
+        order = np.argsort(-scores, axis=1)[:, :k]
+        return np.take_along_axis(top_rows, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+    def query(self, embedding, top_k, where=None):
+        """精确检索"""
+        return self.query_many([embedding], top_k, where)[0]
+
+    def query_many(self, embeddings, top_k, where=None):
+        """批量精确检索：所有查询共享一次矩阵-矩阵乘积，返回每个查询的结果列表
+
+        过滤条件先在元数据索引上求出候选行位图，候选行较少时只对这些行打分，
+        因此条件越严格查询越快；索引无法精确表达的条件在取回后逐行检查。
+        调用方应控制每次的查询数（临时得分矩阵为 BLOCK_ROWS × 查询数）。
+        """
+        vectors = self.as_vectors(embeddings)
+        with self.lock:
+            alive = self.rows.index.alive.values
+            bitmap, exact = self.rows.index.evaluate(where) if where else (None, True)
+            allowed = alive if bitmap is None else alive & bitmap
+            total = int(allowed.sum())
+            if total == 0:
+                return [[] for _ in range(len(vectors))]
+            k = min(top_k * (1 if exact else self.overfetch), total)
+
+            if bitmap is not None and total <= len(alive) // 2:
+                top_rows, top_scores = self.top_scores(vectors, k, candidates=np.flatnonzero(allowed))
+            elif self.codes is not None:
+                # int8全量初筛，再对候选精确打分
+                top_rows, top_scores = self.top_scores(vectors, min(k * self.rescore_factor, total),
+                                                       allowed=allowed, quantized=True)
+                top_rows, top_scores = self.rescore(vectors, top_rows, top_scores, k)
+            else:
+                top_rows, top_scores = self.top_scores(vectors, k, allowed=allowed)
+            valid = np.isfinite(top_scores)
+            stored = self.rows.fetch_rows(np.unique(top_rows[valid]))
+
+        results = []
+        for rows, scores, keep in zip(top_rows, top_scores, valid):
+            hits = []
+            for row, score in zip(rows[keep], scores[keep]):
+                row = int(row)
+                if row not in stored:
+                    continue
+                doc_id, document, metadata = stored[row]
+                if not exact and not matches_filter(metadata, where):
+                    continue
+                hits.append((doc_id, float(scores_to_distances(score, self.metric)), document, metadata))
+                if len(hits) >= top_k:
+                    break
+            results.append(hits)
+        return results
+
+    def get(self, ids):
+        """按ID取回正文和元数据，返回 {ID: (正文, 元数据)}"""
+        with self.lock:
+            return self.rows.get(ids)
+
+    def update(self, doc_id, document=None, metadata=None, embedding=None):
+        """更新单个文本块；更新向量时追加新行并将旧行标记为墓碑"""
+        stored = self.get([doc_id])
+        if doc_id not in stored:
+            raise KeyError(doc_id)
+        if embedding is not None:
+            old_document, old_metadata = stored[doc_id]
+            self.write([doc_id], [embedding],
+                       [document if document is not None else old_document],
+                       [metadata if metadata is not None else old_metadata], upsert=True)
+            return
+        with self.lock:
+            self.rows.update(doc_id, document, metadata)
+
+    def delete(self, ids):
+        """删除文本块（标记墓碑）"""
+        with self.lock:
+            self.rows.delete(ids)
+
+    def tombstone_ratio(self):
+        """墓碑行占全部行的比例"""
+        with self.lock:
+            return self.rows.deleted / self.rows.next_row if self.rows.next_row else 0.0
+
+    def compact(self):
+        """清理墓碑：只保留有效行写入新矩阵并重新编号行号
+
+        顺序为 写入临时矩阵 -> 提交映射表 -> 替换矩阵，中断时由 open 完成或丢弃临时矩阵。
+        """
+        with self.lock:
+            alive = np.flatnonzero(self.rows.index.alive.values)
+            if len(alive) == self.rows.next_row:
+                return 0
+            removed = self.rows.next_row - len(alive)
+            compacted = np.lib.format.open_memmap(self.compact_path, mode='w+', dtype=np.float16,
+                                                  shape=(len(alive), self.dim))
+            for start in range(0, len(alive), self.block_rows):
+                rows = alive[start:start + self.block_rows]
+                compacted[start:start + len(rows)] = self.gather(rows)
+            compacted.flush()
+            del compacted
+            self.rows.compact(renumber=True)
+            os.replace(self.compact_path, self.matrix_path)
+            self.matrix = np.load(self.matrix_path, mmap_mode='r')
+            self.pending = []
+            if self.quantization:
+                self.write_codes()
+            print(f"已清理 {removed} 个墓碑行，剩余 {len(alive)} 行")
+            return removed
+
+    def flush(self):
+        """把新增向量与已有矩阵合并写入新的 .npy 文件（原子替换），再以内存映射方式重新打开"""
+        with self.lock:
+            if self.pending:
+                total = self.rows.next_row
+                tmp_path = self.matrix_path + ".tmp.npy"
+                merged = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=(total, self.dim))
+                for start, block in self.blocks():
+                    merged[start:start + len(block)] = block
+                merged.flush()
+                del merged
+                os.replace(tmp_path, self.matrix_path)
+                self.matrix = np.load(self.matrix_path, mmap_mode='r')
+                self.pending = []
+                if self.quantization:
+                    self.write_codes()
+            self.rows.commit()
@@ -0,0 +1,171 @@
+# ONNX Runtime CPU推理后端（可选int8动态量化）
+
+import os
+import argparse
+import numpy as np
+from config.model_config import EMBEDDING_CONFIG
+
+# 用于一致性校验的示例文本
+PARITY_TEXTS = [
+    "高血压能吃什么水果？",
+    "糖尿病的常见症状包括多尿、口渴、多食、体重减轻。",
+    "老年患者的降压目标应根据个体情况适当放宽。",
+    "二甲双胍是2型糖尿病的一线治疗药物。",
+    "定期监测血压，并记录每日的测量结果。",
+    "Patients should monitor their blood pressure regularly.",
+    "Metformin is recommended as the first-line therapy for type 2 diabetes.",
+    "低盐饮食是高血压非药物治疗的重要措施。"
+]
+
+class OnnxEmbeddingModel:
+    """与 SentenceTransformer.encode 接口兼容的 onnxruntime 嵌入模型"""
+
+    def __init__(self, model_dir, quantized=True, intra_op_threads=0, max_length=512, pooling="cls"):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_file = "model_quantized.onnx" if quantized else "model.onnx"
+        model_path = os.path.join(model_dir, model_file)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"ONNX model not found: {model_path}")
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=True)
+        self.max_seq_length = max_length
+        self.pooling = pooling
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def get_sentence_embedding_dimension(self):
+        """嵌入维度：取自ONNX输出 (batch, seq, hidden) 的最后一维，动态维度时返回None"""
+        hidden_size = self.session.get_outputs()[0].shape[-1]
+        return hidden_size if isinstance(hidden_size, int) else None
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, convert_to_tensor=False, **kwargs):
+        """编码文本，返回L2归一化的numpy向量"""
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        embeddings = []
+        for i in range(0, len(sentences), batch_size):
+            batch = sentences[i:i+batch_size]
+            encoded = self.tokenizer(
+                batch,
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np"
+            )
+            feed = {name: encoded[name].astype(np.int64) for name in self.input_names if name in encoded}
+            hidden_states = self.session.run(None, feed)[0]
+
+            if self.pooling == "mean":
+                mask = encoded["attention_mask"][:, :, None].astype(np.float32)
+                pooled = (hidden_states * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            else:
+                pooled = hidden_states[:, 0]
+
+            norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+            embeddings.append(pooled / np.maximum(norms, 1e-12))
+
+        embeddings = np.vstack(embeddings).astype(np.float32) if embeddings else np.zeros((0, 0), dtype=np.float32)
+        return embeddings[0] if single else embeddings
+
+def export_onnx_model(model_name, output_dir, quantize=True, opset=14):
+    """将HuggingFace模型导出为ONNX，并可选进行int8动态量化"""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    model = AutoModel.from_pretrained(model_name)
+    model.eval()
+
+    sample = tokenizer(["示例文本"], return_tensors="pt")
+    model_path = os.path.join(output_dir, "model.onnx")
+    print(f"导出ONNX模型: {model_path}")
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample["input_ids"], sample["attention_mask"]),
+            model_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"}
+            },
+            opset_version=opset
+        )
+    tokenizer.save_pretrained(output_dir)
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantized_path = os.path.join(output_dir, "model_quantized.onnx")
+        print(f"int8动态量化: {quantized_path}")
+        quantize_dynamic(
+            model_path,
+            quantized_path,
+            weight_type=QuantType.QInt8,
+            use_external_data_format=True
+        )
+
+    return output_dir
+
+def check_parity(onnx_model, reference_model, texts=None, threshold=0.99):
+    """比较ONNX与PyTorch输出的余弦一致性"""
+    texts = texts or PARITY_TEXTS
+    onnx_embeddings = np.asarray(onnx_model.encode(texts), dtype=np.float32)
+    reference_embeddings = np.asarray(
+        reference_model.encode(texts, normalize_embeddings=True, convert_to_tensor=False),
+        dtype=np.float32
+    )
+
+    onnx_embeddings /= np.maximum(np.linalg.norm(onnx_embeddings, axis=1, keepdims=True), 1e-12)
+    reference_embeddings /= np.maximum(np.linalg.norm(reference_embeddings, axis=1, keepdims=True), 1e-12)
+    cosines = (onnx_embeddings * reference_embeddings).sum(axis=1)
+
+    result = {
+        "texts": len(texts),
+        "min_cosine": float(cosines.min()),
+        "mean_cosine": float(cosines.mean()),
+        "passed": bool(cosines.min() >= threshold)
+    }
+    print(f"一致性校验: 最小余弦 {result['min_cosine']:.4f}, 平均余弦 {result['mean_cosine']:.4f}, "
+          f"{'通过' if result['passed'] else '未通过'} (阈值 {threshold})")
+    return result
+
+def main():
+    """命令行入口：导出模型或进行一致性校验"""
+    onnx_config = EMBEDDING_CONFIG["ONNX"]
+    parser = argparse.ArgumentParser(description="ONNX嵌入模型工具")
+    parser.add_argument('action', choices=['export', 'parity'], help='导出模型或一致性校验')
+    parser.add_argument('--model', default=EMBEDDING_CONFIG["MODEL_NAME"], help='源模型名称或路径')
+    parser.add_argument('--output', default=onnx_config["MODEL_DIR"], help='ONNX模型目录')
+    parser.add_argument('--no-quantize', action='store_true', help='不进行int8量化')
+    parser.add_argument('--threshold', type=float, default=0.99, help='余弦一致性阈值')
+    args = parser.parse_args()
+
+    if args.action == 'export':
+        export_onnx_model(args.model, args.output, quantize=not args.no_quantize)
+    else:
+        from sentence_transformers import SentenceTransformer
+        onnx_model = OnnxEmbeddingModel(
+            args.output,
+            quantized=not args.no_quantize,
+            intra_op_threads=onnx_config["INTRA_OP_THREADS"],
+            max_length=EMBEDDING_CONFIG["MAX_LENGTH"],
+            pooling=onnx_config["POOLING"]
+        )
+        reference_model = SentenceTransformer(args.model, device="cpu")
+        reference_model.max_seq_length = EMBEDDING_CONFIG["MAX_LENGTH"]
+        check_parity(onnx_model, reference_model, threshold=args.threshold)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# 查询嵌入缓存（线程安全的LRU + TTL）
+
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+
+class QueryEmbeddingCache:
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+        # 统计计数
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def normalize(self, query):
+        """规范化查询文本：全角转半角、合并空白"""
+        return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', query)).strip()
+
+    def get(self, query):
+        """查询缓存，未命中或已过期时返回None"""
+        key = self.normalize(query)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            embedding, expires_at = entry
+            if self.ttl_seconds and expires_at < time.monotonic():
+                self.remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return embedding.tolist()
+
+    def put(self, query, embedding):
+        """写入缓存，超出条目数或内存上限时淘汰最久未使用的条目"""
+        key = self.normalize(query)
+        vector = np.asarray(embedding, dtype=np.float32)
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else 0.0
+
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (vector, expires_at)
+            self.total_bytes += vector.nbytes
+
+            while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                oldest_key = next(iter(self.entries))
+                self.remove(oldest_key)
+                self.evictions += 1
+
+    def remove(self, key):
+        """删除条目（调用方需持有锁）"""
+        vector, _ = self.entries.pop(key)
+        self.total_bytes -= vector.nbytes
+
+    def clear(self):
+        """清空缓存"""
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """命中率等统计信息"""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / total if total else 0.0
+            }
@@ -0,0 +1,188 @@
+# 向量行号与文本块ID、正文、元数据的SQLite映射表（FAISS / NumPy 后端共用）
+
+import os
+import json
+import sqlite3
+from knowledge_base.metadata_index import MetadataIndex
+
+class RowTable:
+    """整数行号 -> (文本块ID, 正文, 元数据)；删除和覆盖写入只标记墓碑，由 compact 清理
+
+    deleted 列：0 为有效行，1 为墓碑（向量仍在索引中），2 为已清理的墓碑（向量已移除，只保留行号）。
+
+    同时维护按行号对齐的元数据预过滤索引（self.index），随映射表一起提交。调用方负责加锁。
+    """
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + "_index.npz"
+        self.read_only = read_only
+        self.conn = None
+        self.next_row = 0
+        self.deleted = 0
+        self.index = MetadataIndex()
+
+    def exists(self):
+        """映射表文件是否存在"""
+        return os.path.exists(self.path)
+
+    def connect(self):
+        """连接映射表（只读模式以只读URI打开）"""
+        if self.read_only:
+            self.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rows ("
+                "row INTEGER PRIMARY KEY, id TEXT NOT NULL, document TEXT, metadata TEXT, "
+                "deleted INTEGER NOT NULL DEFAULT 0)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_rows_id ON rows(id)")
+            self.conn.commit()
+        self.next_row = self.conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM rows").fetchone()[0]
+        self.deleted = self.conn.execute("SELECT COUNT(*) FROM rows WHERE deleted = 1").fetchone()[0]
+        if not self.index.load(self.index_path) or len(self.index) != self.next_row:
+            self.rebuild_index()
+
+    def rebuild_index(self, batch_size=10000):
+        """从映射表重建元数据索引（索引文件缺失、过期或索引字段变化时）"""
+        self.index.reset()
+        cursor = self.conn.execute("SELECT row, metadata, deleted FROM rows ORDER BY row")
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            self.index.add([row for row, _, _ in batch],
+                           [json.loads(metadata) if metadata else {} for _, metadata, _ in batch],
+                           deleted=[bool(deleted) for _, _, deleted in batch])
+        if self.next_row:
+            print(f"元数据索引已重建: {self.next_row} 行")
+
+    def close(self):
+        """关闭连接"""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def remove(self):
+        """关闭并删除映射表文件"""
+        self.close()
+        self.next_row = 0
+        self.deleted = 0
+        self.index.reset()
+        for path in (self.path, self.path + "-wal", self.path + "-shm", self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def count(self):
+        """未删除的行数"""
+        return self.conn.execute("SELECT COUNT(*) FROM rows WHERE deleted = 0").fetchone()[0]
+
+    def lookup(self, ids, columns="id"):
+        """按文本块ID查询未删除的行"""
+        rows = []
+        unique_ids = list(dict.fromkeys(ids))
+        for i in range(0, len(unique_ids), 500):
+            batch = unique_ids[i:i+500]
+            placeholders = ",".join("?" * len(batch))
+            rows.extend(self.conn.execute(
+                f"SELECT {columns} FROM rows WHERE deleted = 0 AND id IN ({placeholders})", batch
+            ).fetchall())
+        return rows
+
+    def fetch_rows(self, rows):
+        """按行号取回未删除的行，返回 {行号: (文本块ID, 正文, 元数据)}"""
+        fetched = {}
+        rows = [int(row) for row in rows]
+        for i in range(0, len(rows), 500):
+            batch = rows[i:i+500]
+            placeholders = ",".join("?" * len(batch))
+            for row, doc_id, document, metadata in self.conn.execute(
+                f"SELECT row, id, document, metadata FROM rows WHERE deleted = 0 AND row IN ({placeholders})", batch
+            ):
+                fetched[row] = (doc_id, document, json.loads(metadata) if metadata else {})
+        return fetched
+
+    def get(self, ids):
+        """按文本块ID取回正文和元数据，返回 {ID: (正文, 元数据)}"""
+        return {doc_id: (document, json.loads(metadata) if metadata else {})
+                for doc_id, document, metadata in self.lookup(ids, "id, document, metadata")}
+
+    def insert(self, ids, documents, metadatas, upsert=False):
+        """登记一批文本块，返回 (新行号列表, 写入的输入下标列表, 被覆盖的旧行号列表)
+
+        已存在的ID在upsert时将旧行标记为墓碑并写入新行，否则跳过；同一批中重复的ID只写入最后一次出现。
+        """
+        documents = documents if documents is not None else [None] * len(ids)
+        metadatas = metadatas if metadatas is not None else [None] * len(ids)
+
+        existing = {doc_id: row for doc_id, row in self.lookup(ids, "id, row")}
+        replaced = []
+        if existing and upsert:
+            replaced = list(existing.values())
+            self.conn.executemany("UPDATE rows SET deleted = 1 WHERE row = ?", [(row,) for row in replaced])
+            self.deleted += len(replaced)
+            self.index.mark_deleted(replaced)
+            existing = {}
+
+        last = {doc_id: i for i, doc_id in enumerate(ids)}
+        keep = [i for i, doc_id in enumerate(ids) if last[doc_id] == i and doc_id not in existing]
+        rows = list(range(self.next_row, self.next_row + len(keep)))
+        self.next_row += len(keep)
+        self.conn.executemany(
+            "INSERT INTO rows (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+            [(row, ids[i], documents[i], json.dumps(metadatas[i], ensure_ascii=False)) for row, i in zip(rows, keep)]
+        )
+        self.index.add(rows, [metadatas[i] for i in keep])
+        return rows, keep, replaced
+
+    def update(self, doc_id, document=None, metadata=None):
+        """原地更新正文或元数据"""
+        if document is not None:
+            self.conn.execute("UPDATE rows SET document = ? WHERE deleted = 0 AND id = ?", (document, doc_id))
+        if metadata is not None:
+            self.conn.execute("UPDATE rows SET metadata = ? WHERE deleted = 0 AND id = ?",
+                              (json.dumps(metadata, ensure_ascii=False), doc_id))
+            for _, row in self.lookup([doc_id], "id, row"):
+                self.index.set(row, metadata)
+
+    def delete(self, ids):
+        """标记墓碑，返回被删除的行号"""
+        rows = [row for _, row in self.lookup(ids, "id, row")]
+        self.conn.executemany("UPDATE rows SET deleted = 1 WHERE row = ?", [(row,) for row in rows])
+        self.deleted += len(rows)
+        self.index.mark_deleted(rows)
+        return rows
+
+    def tombstone_rows(self):
+        """尚未清理的墓碑行号"""
+        return [row for (row,) in self.conn.execute("SELECT row FROM rows WHERE deleted = 1 ORDER BY row")]
+
+    def compact(self, renumber=False):
+        """清理墓碑并提交，返回保留的旧行号（升序）
+
+        renumber为True时删除墓碑行，保留的行按原顺序重新编号为 0..n-1（向量按行号存放的后端）；
+        否则只清空墓碑的正文和元数据并标记为已清理，行号不变（索引中自带行号的后端）。
+        """
+        alive = [row for (row,) in self.conn.execute("SELECT row FROM rows WHERE deleted = 0 ORDER BY row")]
+        if renumber:
+            self.conn.execute("DELETE FROM rows WHERE deleted != 0")
+            # 按升序改小行号：目标行号上的行要么已被删除，要么已经改过号，不会冲突
+            self.conn.executemany("UPDATE rows SET row = ? WHERE row = ?",
+                                  [(new, old) for new, old in enumerate(alive) if new != old])
+            self.next_row = len(alive)
+            self.conn.commit()
+            self.rebuild_index()
+        else:
+            self.conn.execute("UPDATE rows SET deleted = 2, document = NULL, metadata = NULL WHERE deleted = 1")
+        self.deleted = 0
+        self.commit()
+        return alive
+
+    def commit(self):
+        """提交写入并保存元数据索引"""
+        if not self.read_only:
+            self.conn.commit()
+            self.index.save(self.index_path)
@@ -0,0 +1,452 @@
+# 分片向量库：文本块按ID哈希或来源机构分布到N个分片进程，协调端并行分发查询并合并各分片的top-k
+
+import os
+import sys
+import time
+import zlib
+import heapq
+import secrets
+import builtins
+import argparse
+import ipaddress
+import threading
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+
+# 分片进程对外提供的存储后端方法
+SHARD_METHODS = (
+    "exists", "create", "open", "drop", "count", "existing_ids", "max_batch_size", "write",
+    "query", "query_many", "get", "update", "delete", "tombstone_ratio", "compact", "flush"
+)
+
+# 分区方式
+PARTITION_HASH = "hash"      # 按文本块ID哈希，按ID的读写只访问一个分片
+PARTITION_SOURCE = "source"  # 按来源机构，同一机构的文本块在同一分片，按机构过滤的查询只访问一个分片
+PARTITION_FIELD = "source_organization"
+
+# 分片连接的认证密钥从环境变量读取（请求以pickle传输，拿到密钥即可在分片进程中执行任意代码，不能写在仓库里）
+AUTHKEY_ENV = "KB_SHARD_AUTHKEY"
+# 曾经作为默认值随仓库发布的密钥，视为未设置
+INSECURE_AUTHKEYS = ("", "medical-kb-shards")
+
+def is_loopback(host):
+    """监听或连接地址是否只在本机可达"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def resolve_authkey(configured=None, required=False):
+    """分片认证密钥：环境变量 KB_SHARD_AUTHKEY 优先，其次为配置的 AUTHKEY
+
+    required为True（连接其他节点上的分片、分片监听非本机地址）时未设置或为旧默认值则拒绝启动；
+    否则（本机子进程分片）未设置时为本次启动生成随机密钥。
+    """
+    authkey = os.environ.get(AUTHKEY_ENV) or configured or ""
+    if authkey in INSECURE_AUTHKEYS:
+        if required:
+            raise RuntimeError(f"Shard authkey is not set: export {AUTHKEY_ENV}=<random secret> "
+                               f"on the coordinator and every shard node")
+        authkey = secrets.token_hex(32)
+    return authkey.encode("utf-8")
+
+def raise_remote_error(error):
+    """还原分片返回的异常：内置异常类型按原类型抛出（如 KeyError），其他类型抛出RuntimeError"""
+    type_name, message = error
+    exc_type = getattr(builtins, type_name, None)
+    if isinstance(exc_type, type) and issubclass(exc_type, Exception):
+        raise exc_type(message)
+    raise RuntimeError(f"{type_name}: {message}")
+
+def partition_key(value):
+    """稳定的分区哈希（跨进程、跨机器一致，不使用带随机盐的 hash()）"""
+    return zlib.crc32(str(value).encode("utf-8"))
+
+def parse_address(address):
+    """"host:port" -> (host, port)"""
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+class ShardServer:
+    """在一个进程中托管一个存储后端，按请求调用其方法
+
+    每个连接一个线程；请求为 (方法名, 位置参数, 关键字参数)，响应为 ("ok", 返回值) 或 ("error", (异常类型名, repr))。
+    连接使用 multiprocessing.connection 的authkey做HMAC认证，本机子进程和其他节点上的分片使用同一协议。
+    """
+
+    def __init__(self, store, authkey, host="127.0.0.1", port=0):
+        self.store = store
+        self.listener = Listener((host, port), authkey=authkey)
+        self.address = self.listener.address
+
+    def serve_forever(self):
+        """接受连接直到进程退出"""
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception as e:
+                print(f"分片连接失败: {e}")
+                continue
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        """处理一个连接上的请求"""
+        try:
+            while True:
+                try:
+                    method, args, kwargs = conn.recv()
+                except EOFError:
+                    return
+                try:
+                    if method == "metric":
+                        result = self.store.metric
+                    elif method in SHARD_METHODS:
+                        result = getattr(self.store, method)(*args, **kwargs)
+                    else:
+                        raise ValueError(f"Unsupported shard method: {method}")
+                    conn.send(("ok", result))
+                except Exception as e:
+                    # 异常对象不一定能pickle，只发送类型名和描述
+                    conn.send(("error", (type(e).__name__, repr(e))))
+        finally:
+            conn.close()
+
+def serve_shard(shard, directory, collection_name, dim, db_type, read_only, authkey, host="127.0.0.1", port=0,
+                ready=None, metric="cosine"):
+    """分片进程入口：打开该分片的存储后端并提供服务；ready为管道时把监听地址发回父进程"""
+    if not is_loopback(host) and authkey.decode("utf-8") in INSECURE_AUTHKEYS:
+        raise RuntimeError(f"Refusing to listen on {host} without a shard authkey ({AUTHKEY_ENV})")
+    from knowledge_base.vector_db import create_store
+    store = create_store(db_type, directory, collection_name, dim, read_only, metric=metric)
+    if store.exists():
+        store.open()
+    server = ShardServer(store, authkey, host, port)
+    print(f"分片 {shard} 已启动: {server.address[0]}:{server.address[1]}（{db_type}，{directory}）")
+    if ready is not None:
+        ready.send(server.address)
+        ready.close()
+    server.serve_forever()
+
+class ShardClient:
+    """一个分片的连接池；并发请求各用一个连接，超时的连接直接丢弃（迟到的响应不会串到下一个请求）"""
+
+    def __init__(self, shard, address, authkey):
+        self.shard = shard
+        self.address = address
+        self.authkey = authkey
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def call(self, method, *args, deadline=None, **kwargs):
+        """调用分片上的方法；deadline（time.monotonic()时刻）之前没有响应时抛出TimeoutError"""
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = Client(self.address, authkey=self.authkey)
+        try:
+            conn.send((method, args, kwargs))
+            if deadline is not None and not conn.poll(max(deadline - time.monotonic(), 0)):
+                raise TimeoutError(f"Shard {self.shard} missed the query deadline")
+            status, result = conn.recv()
+        except BaseException:
+            conn.close()
+            raise
+        with self.lock:
+            self.idle.append(conn)
+        if status == "error":
+            raise_remote_error(result)
+        return result
+
+    def close(self):
+        """关闭空闲连接"""
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+def launch_local_shards(num_shards, directory, collection_name, dim, db_type, read_only, authkey, timeout=120,
+                        metric="cosine"):
+    """在本机启动分片子进程（数据目录为 directory/shards/shard-<i>），返回 [(地址, 进程)]"""
+    context = mp.get_context("spawn")
+    shards = []
+    for shard in range(num_shards):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=serve_shard,
+            args=(shard, os.path.join(directory, "shards", f"shard-{shard}"), collection_name, dim, db_type, read_only,
+                  authkey),
+            kwargs={"ready": sender, "metric": metric},
+            name=f"kb-shard-{shard}",
+            daemon=True
+        )
+        process.start()
+        sender.close()
+        shards.append((receiver, process))
+
+    launched = []
+    for shard, (receiver, process) in enumerate(shards):
+        try:
+            if not receiver.poll(timeout):
+                raise RuntimeError(f"Shard {shard} failed to start within {timeout}s")
+            launched.append((receiver.recv(), process))
+        except EOFError:
+            for _, started in shards:
+                started.terminate()
+            raise RuntimeError(f"Shard {shard} exited during startup")
+        except RuntimeError:
+            for _, started in shards:
+                started.terminate()
+            raise
+        finally:
+            receiver.close()
+    return launched
+
+class ShardedStore:
+    """VectorDatabase 的分片存储后端（协调端）
+
+    提供与其他存储后端相同的接口，VectorDatabase 和 MultiRetriever 无需区分单机和分片。
+    写入按分区键路由到一个分片；查询并行发往所有相关分片，在 QUERY_DEADLINE_MS 内返回的分片结果
+    按距离用堆合并为全局top-k，超时或失败的分片被跳过（结果为部分结果，记录在 last_missing_shards）。
+    ADDRESSES 为空时在本机启动 NUM_SHARDS 个分片子进程，否则连接其他节点上已启动的分片：
+        KB_SHARD_AUTHKEY=<密钥> python -m knowledge_base.sharding serve --shard 0 --directory ./vector_db/shard-0 --host 10.0.0.2 --port 7000
+    按来源机构分区时，修改元数据不会把文本块迁移到其他分片。
+    """
+
+    def __init__(self, persist_directory, collection_name, dim, read_only=False, db_type="chromadb", config=None,
+                 metric="cosine"):
+        config = config or {}
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name
+        self.dim = dim
+        self.read_only = read_only
+        self.partition = config.get("PARTITION", PARTITION_HASH)
+        if self.partition not in (PARTITION_HASH, PARTITION_SOURCE):
+            raise ValueError(f"Unsupported partition: {self.partition}")
+        self.deadline = config.get("QUERY_DEADLINE_MS", 500) / 1000
+        addresses = config.get("ADDRESSES") or []
+        # 连接其他节点时必须配置密钥；本机子进程分片未配置时使用随机密钥
+        authkey = resolve_authkey(config.get("AUTHKEY"), required=bool(addresses))
+
+        self.processes = []
+        if addresses:
+            addresses = [parse_address(address) for address in addresses]
+        else:
+            launched = launch_local_shards(config.get("NUM_SHARDS", 4), persist_directory, collection_name, dim,
+                                           db_type, read_only, authkey, config.get("STARTUP_TIMEOUT", 120),
+                                           metric=metric)
+            addresses = [address for address, _ in launched]
+            self.processes = [process for _, process in launched]
+        self.shards = [ShardClient(shard, address, authkey) for shard, address in enumerate(addresses)]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.shards) * 4, thread_name_prefix="shard-query")
+        self.last_missing_shards = []
+
+    @property
+    def metric(self):
+        """分片使用的距离度量（各分片后端相同）"""
+        return self.shards[0].call("metric")
+
+    def shard_of(self, doc_id, metadata=None):
+        """文本块所在的分片"""
+        if self.partition == PARTITION_SOURCE:
+            value = (metadata or {}).get(PARTITION_FIELD) or ""
+        else:
+            value = doc_id
+        return partition_key(value) % len(self.shards)
+
+    def shards_for_ids(self, ids):
+        """按ID访问时的 {分片: ID列表}；按来源分区时无法由ID确定分片，发往所有分片"""
+        if self.partition == PARTITION_SOURCE:
+            return {shard: list(ids) for shard in range(len(self.shards))}
+        routed = {}
+        for doc_id in ids:
+            routed.setdefault(self.shard_of(doc_id), []).append(doc_id)
+        return routed
+
+    def shards_for_where(self, where):
+        """查询需要访问的分片：按来源分区且过滤条件限定了单个机构时只访问该分片"""
+        all_shards = list(range(len(self.shards)))
+        if self.partition != PARTITION_SOURCE or not where:
+            return all_shards
+        conditions = where.get("$and", [where])
+        for condition in conditions:
+            value = condition.get(PARTITION_FIELD) if isinstance(condition, dict) else None
+            if isinstance(value, dict) and list(value) == ["$eq"]:
+                value = value["$eq"]
+            if isinstance(value, str):
+                return [self.shard_of(None, {PARTITION_FIELD: value})]
+        return all_shards
+
+    def broadcast(self, method, *args, shards=None, **kwargs):
+        """在所有（或指定）分片上并行调用方法，返回按分片顺序的结果列表；任一分片失败时抛出异常"""
+        shards = range(len(self.shards)) if shards is None else shards
+        futures = [self.executor.submit(self.shards[shard].call, method, *args, **kwargs) for shard in shards]
+        return [future.result() for future in futures]
+
+    def exists(self):
+        """所有分片上的集合都存在"""
+        return all(self.broadcast("exists"))
+
+    def create(self):
+        """在所有分片上创建集合"""
+        self.broadcast("create")
+
+    def open(self):
+        """打开所有分片上的集合"""
+        self.broadcast("open")
+
+    def drop(self):
+        """删除所有分片上的集合"""
+        self.broadcast("drop")
+
+    def count(self):
+        """文本块总数"""
+        return sum(self.broadcast("count"))
+
+    def existing_ids(self, ids):
+        """返回已存在的ID集合"""
+        routed = self.shards_for_ids(ids)
+        existing = set()
+        for found in self.broadcast_routed("existing_ids", routed):
+            existing.update(found)
+        return existing
+
+    def broadcast_routed(self, method, routed, *args, **kwargs):
+        """按 {分片: 参数} 并行调用，返回结果列表"""
+        futures = [self.executor.submit(self.shards[shard].call, method, shard_args, *args, **kwargs)
+                   for shard, shard_args in routed.items()]
+        return [future.result() for future in futures]
+
+    def max_batch_size(self):
+        """各分片批大小限制的最小值"""
+        limits = [limit for limit in self.broadcast("max_batch_size") if limit]
+        return min(limits) if limits else None
+
+    def write(self, ids, embeddings, documents, metadatas, upsert=False):
+        """按分区键把一批行拆分到各分片并行写入"""
+        parts = {}
+        for i, doc_id in enumerate(ids):
+            parts.setdefault(self.shard_of(doc_id, metadatas[i] if metadatas is not None else None), []).append(i)
+        futures = []
+        for shard, rows in parts.items():
+            futures.append(self.executor.submit(
+                self.shards[shard].call, "write",
+                [ids[i] for i in rows],
+                [embeddings[i] for i in rows],
+                [documents[i] for i in rows] if documents is not None else None,
+                [metadatas[i] for i in rows] if metadatas is not None else None,
+                upsert=upsert
+            ))
+        for future in futures:
+            future.result()
+
+    def query(self, embedding, top_k, where=None):
+        """向量检索"""
+        return self.query_many([embedding], top_k, where)[0]
+
+    def query_many(self, embeddings, top_k, where=None):
+        """并行查询各分片，在截止时间内返回的结果按距离合并为每个查询的全局top-k"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        shards = self.shards_for_where(where)
+        deadline = time.monotonic() + self.deadline
+        futures = {
+            shard: self.executor.submit(self.shards[shard].call, "query_many", embeddings, top_k, where,
+                                        deadline=deadline)
+            for shard in shards
+        }
+        # 连接无响应的节点时建立连接本身可能阻塞，协调端最多等到截止时间
+        wait(futures.values(), timeout=max(deadline - time.monotonic(), 0) + 0.05)
+        per_shard = []
+        missing = []
+        for shard, future in futures.items():
+            if not future.done():
+                missing.append(shard)
+                print(f"分片 {shard} 未在截止时间内返回，跳过")
+                continue
+            try:
+                per_shard.append(future.result())
+            except Exception as e:
+                missing.append(shard)
+                print(f"分片 {shard} 查询失败，跳过: {e!r}")
+        self.last_missing_shards = missing
+        if per_shard and missing:
+            print(f"{len(missing)}/{len(shards)} 个分片未在截止时间内返回，结果可能不完整")
+
+        results = []
+        for i in range(len(embeddings)):
+            hits = (hit for shard_results in per_shard for hit in shard_results[i])
+            results.append(heapq.nsmallest(top_k, hits, key=lambda hit: hit[1]))
+        return results
+
+    def get(self, ids):
+        """按ID取回正文和元数据，返回 {ID: (正文, 元数据)}"""
+        stored = {}
+        for found in self.broadcast_routed("get", self.shards_for_ids(ids)):
+            stored.update(found)
+        return stored
+
+    def update(self, doc_id, document=None, metadata=None, embedding=None):
+        """更新单个文本块（按来源分区时发往所有分片，由持有该块的分片执行）"""
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+        updated = False
+        for shard in self.shards_for_ids([doc_id]):
+            try:
+                self.shards[shard].call("update", doc_id, document=document, metadata=metadata, embedding=embedding)
+                updated = True
+            except KeyError:
+                continue
+        if not updated:
+            raise KeyError(doc_id)
+
+    def delete(self, ids):
+        """删除文本块"""
+        self.broadcast_routed("delete", self.shards_for_ids(ids))
+
+    def tombstone_ratio(self):
+        """各分片中最大的墓碑比例"""
+        return max(self.broadcast("tombstone_ratio"))
+
+    def compact(self):
+        """清理所有分片的墓碑，返回清理的总行数"""
+        return sum(self.broadcast("compact"))
+
+    def flush(self):
+        """持久化所有分片"""
+        self.broadcast("flush")
+
+    def close(self):
+        """关闭连接并停止本机启动的分片子进程"""
+        self.executor.shutdown(wait=False)
+        for shard in self.shards:
+            shard.close()
+        for process in self.processes:
+            process.terminate()
+            process.join(5)
+        self.processes = []
+
+def main():
+    """命令行入口：在本节点上启动一个分片"""
+    from config.model_config import VECTOR_DB_CONFIG, EMBEDDING_CONFIG
+    parser = argparse.ArgumentParser(description="启动向量库分片")
+    parser.add_argument('command', choices=['serve'], help='命令')
+    parser.add_argument('--shard', type=int, default=0, help='分片编号')
+    parser.add_argument('--directory', required=True, help='分片数据目录')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址（非本机地址需要设置 KB_SHARD_AUTHKEY）')
+    parser.add_argument('--port', type=int, default=7000, help='监听端口')
+    parser.add_argument('--read-only', action='store_true', help='只读打开（在线服务）')
+    parser.add_argument('--dim', type=int, default=EMBEDDING_CONFIG["EMBEDDING_DIM"],
+                        help='嵌入维度（与协调端嵌入模型实际输出的维度一致）')
+    args = parser.parse_args()
+
+    # 协调端通过 ADDRESSES 连接命令行启动的分片，两边必须使用同一个显式配置的密钥
+    authkey = resolve_authkey(VECTOR_DB_CONFIG["SHARDING"]["AUTHKEY"], required=True)
+    serve_shard(args.shard, args.directory, VECTOR_DB_CONFIG["COLLECTION_NAME"], args.dim,
+                VECTOR_DB_CONFIG["DB_TYPE"], args.read_only, authkey, args.host, args.port,
+                metric=VECTOR_DB_CONFIG["METRIC"])
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+# 知识库版本快照：每次构建写入新的版本目录，原子切换CURRENT指针发布
+
+import os
+import json
+import shutil
+from datetime import datetime
+
+# 草稿版本的标记文件（记录草稿基于的已发布版本）
+DRAFT_FILE = "DRAFT"
+
+def version_key(version):
+    """版本号的排序键：(时间戳, 序号)，"20240101-120000-10" 排在 "20240101-120000-9" 之后"""
+    base, _, suffix = version.rpartition("-") if version.count("-") > 1 else (version, "", "")
+    return base, int(suffix) if suffix.isdigit() else 0
+
+class SnapshotManager:
+    """管理 PERSIST_DIRECTORY 下的知识库版本
+
+    目录结构：
+        versions/<版本号>/   一个版本的向量库、文档表、稀疏索引和BM25语料，发布后不再修改
+        CURRENT             当前版本号（先写临时文件再 os.replace，读者不会看到半个文件）
+        history.json        发布顺序，用于回滚和清理旧版本
+    没有CURRENT文件时视为旧的单目录布局，直接使用根目录。
+
+    增量写入（append模式）不修改已发布的版本：fork 把当前版本复制为草稿版本（目录中有DRAFT标记），
+    变更日志和墓碑清理都写在草稿中，publish 后成为新版本。未发布的草稿不会被清理，
+    下次 fork 时继续使用；期间有新版本发布时，草稿中尚未应用和已隔离的变更日志转移到基于新版本的草稿中重放。
+    """
+
+    def __init__(self, root, keep_versions=3):
+        self.root = root
+        self.keep_versions = keep_versions
+        self.versions_dir = os.path.join(root, "versions")
+        self.current_path = os.path.join(root, "CURRENT")
+        self.history_path = os.path.join(root, "history.json")
+
+    def path(self, version):
+        """版本目录"""
+        return os.path.join(self.versions_dir, version)
+
+    def current(self):
+        """当前版本号，尚未发布过版本时返回None"""
+        try:
+            with open(self.current_path, 'r', encoding='utf-8') as f:
+                version = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return version or None
+
+    def resolve(self):
+        """返回 (当前版本号, 数据目录)；旧布局返回 (None, 根目录)"""
+        version = self.current()
+        if version is None:
+            return None, self.root
+        return version, self.path(version)
+
+    def versions(self):
+        """磁盘上的所有版本号（按创建顺序排序）"""
+        if not os.path.isdir(self.versions_dir):
+            return []
+        return sorted((name for name in os.listdir(self.versions_dir) if os.path.isdir(self.path(name))),
+                      key=version_key)
+
+    def load_history(self):
+        """已发布的版本号列表"""
+        try:
+            with open(self.history_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def write_atomic(self, path, content):
+        """先写临时文件再原子替换"""
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def new_version(self):
+        """创建新的版本目录，返回 (版本号, 目录)
+
+        新版本号总是排在所有已有版本（包括已清理、只留在发布历史中的版本）之后：
+        同一秒内创建或时钟回拨时在最新版本的序号上加一，不会复用已删除版本的名称。
+        """
+        base, suffix = datetime.now().strftime("%Y%m%d-%H%M%S"), 0
+        existing = self.versions() + self.load_history()
+        if existing:
+            latest_base, latest_suffix = version_key(max(existing, key=version_key))
+            if base <= latest_base:
+                base, suffix = latest_base, latest_suffix + 1
+        version = f"{base}-{suffix}" if suffix else base
+        os.makedirs(self.path(version))
+        return version, self.path(version)
+
+    def draft_base(self, version):
+        """草稿版本基于的已发布版本；不是草稿时返回None"""
+        try:
+            with open(os.path.join(self.path(version), DRAFT_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)["base"]
+        except FileNotFoundError:
+            return None
+
+    def drafts(self):
+        """未发布的草稿版本（按创建时间排序）"""
+        return [version for version in self.versions()
+                if os.path.exists(os.path.join(self.path(version), DRAFT_FILE))]
+
+    def fork(self, carry_files=()):
+        """返回 (版本号, 目录) 用于增量写入：继续使用基于当前版本的草稿，没有时复制当前版本创建草稿
+
+        基于旧版本的草稿（期间发布了新构建）中的 carry_files（变更日志、隔离文件）追加到新草稿中，
+        新草稿打开时重放，然后删除旧草稿。
+        """
+        current = self.current()
+        if current is None:
+            raise FileNotFoundError("尚未发布知识库版本，无法创建草稿")
+        stale = []
+        for version in self.drafts():
+            if self.draft_base(version) == current:
+                print(f"继续使用草稿版本: {version}（基于 {current}）")
+                return version, self.path(version)
+            stale.append(version)
+
+        version, directory = self.new_version()
+        shutil.copytree(self.path(current), directory, dirs_exist_ok=True)
+        for name in carry_files:
+            for draft in stale:
+                source = os.path.join(self.path(draft), name)
+                if os.path.exists(source):
+                    with open(source, 'rb') as src, open(os.path.join(directory, name), 'ab') as dst:
+                        shutil.copyfileobj(src, dst)
+        self.write_atomic(os.path.join(directory, DRAFT_FILE), json.dumps({"base": current}))
+        for draft in stale:
+            print(f"草稿版本 {draft} 基于旧版本 {self.draft_base(draft)}，未应用的变更转移到 {version}")
+            shutil.rmtree(self.path(draft), ignore_errors=True)
+        print(f"创建草稿版本: {version}（基于 {current}）")
+        return version, directory
+
+    def publish(self, version):
+        """发布版本：原子切换CURRENT，运行中的服务在下次检查时切换到该版本"""
+        if not os.path.isdir(self.path(version)):
+            raise FileNotFoundError(f"Snapshot version not found: {version}")
+        draft_path = os.path.join(self.path(version), DRAFT_FILE)
+        if os.path.exists(draft_path):
+            os.remove(draft_path)
+        history = [item for item in self.load_history() if item != version]
+        history.append(version)
+        self.write_atomic(self.history_path, json.dumps(history, ensure_ascii=False))
+        self.write_atomic(self.current_path, version)
+        print(f"已发布知识库版本: {version}")
+        self.prune()
+
+    def rollback(self):
+        """回滚到上一个已发布且仍存在的版本，返回回滚后的版本号（没有可回滚的版本时返回None）"""
+        history = self.load_history()
+        current = self.current()
+        if current in history:
+            history = history[:history.index(current)]
+        candidates = [version for version in history if os.path.isdir(self.path(version))]
+        if not candidates:
+            print("没有可回滚的知识库版本")
+            return None
+        target = candidates[-1]
+        self.write_atomic(self.history_path, json.dumps(candidates, ensure_ascii=False))
+        self.write_atomic(self.current_path, target)
+        print(f"已回滚知识库版本: {current} -> {target}")
+        return target
+
+    def prune(self):
+        """删除旧版本，保留当前版本和最近发布的 keep_versions 个版本
+
+        未发布的目录（构建中或构建失败）只有在比当前版本更早时才删除；草稿版本不删除。
+        """
+        current = self.current()
+        keep = set(self.load_history()[-self.keep_versions:])
+        keep.add(current)
+        keep.update(self.drafts())
+        for version in self.versions():
+            if version in keep or (current is not None and version_key(version) > version_key(current)):
+                continue
+            shutil.rmtree(self.path(version), ignore_errors=True)
+            print(f"已删除旧知识库版本: {version}")
+
+    def discard(self, version):
+        """删除未发布的版本目录（构建失败时）"""
+        if version != self.current():
+            shutil.rmtree(self.path(version), ignore_errors=True)
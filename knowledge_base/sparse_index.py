@@ -0,0 +1,146 @@
+# 稀疏词权重倒排索引（bge-m3 lexical weights，替代BM25）
+
+import os
+from array import array
+import numpy as np
+
+class SparseInvertedIndex:
+    """token_id -> (文档行号, 权重) 倒排表，查询得分为查询与文档稀疏权重的点积"""
+
+    def __init__(self):
+        self.ids = []
+        self.id_to_row = {}
+        self.postings = {}
+        # 已删除或被覆盖的行号（墓碑），保存时清理
+        self.deleted = set()
+
+        # 查询时使用的numpy倒排表和墓碑行号，添加或删除文档后失效
+        self.frozen = None
+        self.frozen_deleted = None
+
+    def __len__(self):
+        return len(self.id_to_row)
+
+    def add(self, doc_id, weights, replace=False):
+        """添加一个文档；ID已存在时默认跳过（块ID由内容决定），replace为True时覆盖旧的词权重"""
+        if doc_id in self.id_to_row:
+            if not replace:
+                return False
+            self.remove([doc_id])
+        if not weights:
+            return False
+        row = len(self.ids)
+        self.ids.append(doc_id)
+        self.id_to_row[doc_id] = row
+        for token_id, weight in weights.items():
+            posting = self.postings.get(token_id)
+            if posting is None:
+                posting = (array('i'), array('f'))
+                self.postings[token_id] = posting
+            posting[0].append(row)
+            posting[1].append(weight)
+        self.frozen = None
+        return True
+
+    def add_many(self, doc_ids, weights_list, replace=False):
+        """批量添加，返回新增文档数"""
+        return sum(self.add(doc_id, weights, replace) for doc_id, weights in zip(doc_ids, weights_list))
+
+    def remove(self, doc_ids):
+        """删除文档（标记墓碑，倒排链在保存时清理），返回删除的文档数"""
+        removed = 0
+        for doc_id in doc_ids:
+            row = self.id_to_row.pop(doc_id, None)
+            if row is not None:
+                self.deleted.add(row)
+                removed += 1
+        if removed:
+            self.frozen_deleted = None
+        return removed
+
+    def compact(self):
+        """清理墓碑：重新编号剩余行并重写倒排链"""
+        if not self.deleted:
+            return 0
+        row_map = np.full(len(self.ids), -1, dtype=np.int64)
+        live_rows = sorted(self.id_to_row.values())
+        row_map[live_rows] = np.arange(len(live_rows))
+        postings = {}
+        for token_id, (rows, weights) in self.postings.items():
+            rows = row_map[np.frombuffer(rows, dtype=np.int32)]
+            keep = rows >= 0
+            if keep.any():
+                postings[token_id] = (array('i', rows[keep].astype(np.int32).tobytes()),
+                                      array('f', np.frombuffer(weights, dtype=np.float32)[keep].tobytes()))
+        removed = len(self.deleted)
+        self.ids = [self.ids[row] for row in live_rows]
+        self.id_to_row = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        self.postings = postings
+        self.deleted = set()
+        self.frozen = None
+        self.frozen_deleted = None
+        return removed
+
+    def freeze(self):
+        """把倒排表和墓碑行号复制为numpy数组（复制而不是引用缓冲区，之后仍可以继续追加），返回 (倒排表, 墓碑行号)"""
+        if self.frozen is None:
+            self.frozen = {
+                token_id: (np.frombuffer(rows, dtype=np.int32).copy(), np.frombuffer(weights, dtype=np.float32).copy())
+                for token_id, (rows, weights) in self.postings.items()
+            }
+        if self.frozen_deleted is None:
+            self.frozen_deleted = np.array(list(self.deleted), dtype=np.int64)
+        return self.frozen, self.frozen_deleted
+
+    def search(self, query_weights, top_k=10):
+        """返回得分最高的 [(文档ID, 得分)]，只遍历查询词对应的倒排链"""
+        if not self.id_to_row or not query_weights:
+            return []
+        postings, deleted = self.freeze()
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for token_id, query_weight in query_weights.items():
+            posting = postings.get(token_id)
+            if posting is not None:
+                # 同一倒排链内行号不重复，可以直接按下标累加
+                scores[posting[0]] += query_weight * posting[1]
+        # 墓碑行不参与排序
+        scores[deleted] = 0
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(self.ids[row], float(scores[row])) for row in candidates]
+
+    def save(self, path):
+        """原子保存：先清理墓碑，所有倒排链拼接为连续数组"""
+        self.compact()
+        token_ids = np.fromiter(self.postings.keys(), dtype=np.int64, count=len(self.postings))
+        lengths = np.fromiter((len(rows) for rows, _ in self.postings.values()), dtype=np.int64,
+                              count=len(self.postings))
+        rows = np.concatenate([np.frombuffer(rows, dtype=np.int32) for rows, _ in self.postings.values()]) \
+            if self.postings else np.zeros(0, dtype=np.int32)
+        weights = np.concatenate([np.frombuffer(weights, dtype=np.float32) for _, weights in self.postings.values()]) \
+            if self.postings else np.zeros(0, dtype=np.float32)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, ids=np.array(self.ids, dtype=str), token_ids=token_ids, lengths=lengths,
+                 rows=rows, weights=weights)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """加载索引，文件不存在时返回空索引"""
+        index = cls()
+        if not os.path.exists(path):
+            return index
+        data = np.load(path)
+        index.ids = data["ids"].tolist()
+        index.id_to_row = {doc_id: row for row, doc_id in enumerate(index.ids)}
+        offsets = np.concatenate([[0], np.cumsum(data["lengths"])])
+        rows, weights = data["rows"], data["weights"]
+        for i, token_id in enumerate(data["token_ids"].tolist()):
+            start, end = offsets[i], offsets[i + 1]
+            index.postings[token_id] = (array('i', rows[start:end].tobytes()), array('f', weights[start:end].tobytes()))
+        return index
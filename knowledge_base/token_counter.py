@@ -0,0 +1,84 @@
+# 分词器token计数
+
+import os
+from config.model_config import EMBEDDING_CONFIG
+
+class TokenCounter:
+    def __init__(self, tokenizer=None, cache_size=200000):
+        self.cache_size = cache_size
+        self.cache = {}
+
+        # 加载分词器（与嵌入模型保持一致）
+        self.tokenizer = tokenizer if tokenizer is not None else self.load_tokenizer()
+
+    def load_tokenizer(self):
+        """加载嵌入模型对应的快速分词器（进程内共享）"""
+        from knowledge_base.model_registry import registry
+
+        medical_model = EMBEDDING_CONFIG["MEDICAL_MODEL"]
+        if medical_model["ENABLED"] and os.path.exists(medical_model["MODEL_PATH"]):
+            model_path = medical_model["MODEL_PATH"]
+        else:
+            model_path = EMBEDDING_CONFIG["MODEL_NAME"]
+
+        return registry.get(f"tokenizer:{model_path}", lambda: self.create_tokenizer(model_path))
+
+    def create_tokenizer(self, model_path):
+        """实际创建分词器"""
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
+        if not getattr(tokenizer, "is_fast", False):
+            print(f"警告: {model_path} 没有快速分词器，分块速度会较慢")
+        return tokenizer
+
+    def count(self, text):
+        """计算单个文本的token数（不含特殊token）"""
+        return self.count_many([text])[0]
+
+    def count_many(self, texts):
+        """批量计算token数，只对未缓存的文本调用分词器"""
+        missing = list({text for text in texts if text not in self.cache})
+
+        if missing:
+            # 缓存过大时整体清空，避免无限增长
+            if len(self.cache) + len(missing) > self.cache_size:
+                self.cache.clear()
+
+            encoded = self.tokenizer(
+                missing,
+                add_special_tokens=False,
+                return_attention_mask=False,
+                return_token_type_ids=False
+            )
+            for text, input_ids in zip(missing, encoded["input_ids"]):
+                self.cache[text] = len(input_ids)
+
+        return [self.cache[text] if text in self.cache else self.count_uncached(text) for text in texts]
+
+    def count_uncached(self, text):
+        """缓存被清空后的兜底计数"""
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def token_spans(self, text, max_tokens):
+        """将文本按token数切分为不超过max_tokens的字符区间"""
+        encoded = self.tokenizer(
+            text,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            return_attention_mask=False,
+            return_token_type_ids=False
+        )
+        offsets = encoded["offset_mapping"]
+
+        spans = []
+        start = 0
+        for i in range(max_tokens, len(offsets), max_tokens):
+            end = offsets[i][0]
+            if end > start:
+                spans.append((start, end))
+                start = end
+        if start < len(text):
+            spans.append((start, len(text)))
+
+        return spans
@@ -1,184 +1,724 @@
 # 向量数据库操作
 
 import os
-import chromadb
-from chromadb.config import Settings
-from config.model_config import VECTOR_DB_CONFIG
+import json
+import time
+import queue
+import threading
+from datetime import datetime
+import numpy as np
+from config.model_config import VECTOR_DB_CONFIG, EMBEDDING_CONFIG
+from knowledge_base.chunk_store import Chunk, DocumentTable
+from knowledge_base.metadata_filter import filter_fields, matches_filter, normalize_where
+from knowledge_base.metrics import check_metric, normalize_embeddings, scores_to_distances, distance_to_similarity
+from knowledge_base.mutation_log import MutationLog, OP_UPSERT, OP_UPDATE, OP_DELETE
+from knowledge_base.sparse_index import SparseInvertedIndex
+
+# 集合旁的schema记录格式版本（格式不兼容时递增）
+SCHEMA_VERSION = 1
+
+# 打开模式
+MODE_OPEN = "open"        # 只读打开已有集合（在线服务）
+MODE_APPEND = "append"    # 打开或创建集合，可以写入
+MODE_REBUILD = "rebuild"  # 删除并重建集合（build_kb）
+OPEN_MODES = (MODE_OPEN, MODE_APPEND, MODE_REBUILD)
+
+def create_store(db_type, persist_directory, collection_name, dim, read_only=False, metric="cosine"):
+    """按DB_TYPE创建单机存储后端（chromadb / faiss / numpy），metric为集合的距离度量"""
+    if db_type == "chromadb":
+        from knowledge_base.chroma_store import ChromaStore
+        return ChromaStore(persist_directory, collection_name, dim, read_only=read_only, metric=metric)
+    elif db_type == "faiss":
+        from knowledge_base.faiss_store import FaissStore
+        return FaissStore(persist_directory, collection_name, dim, read_only=read_only,
+                          config=VECTOR_DB_CONFIG["FAISS"], metric=metric)
+    elif db_type == "numpy":
+        from knowledge_base.numpy_store import NumpyStore
+        return NumpyStore(persist_directory, collection_name, dim, read_only=read_only,
+                          config=VECTOR_DB_CONFIG["NUMPY"], metric=metric)
+    else:
+        raise ValueError(f"Unsupported database type: {db_type}")
 
 class VectorDatabase:
-    def __init__(self):
+    def __init__(self, mode=None, persist_directory=None, embedding_dim=None):
         self.db_type = VECTOR_DB_CONFIG["DB_TYPE"]
-        self.persist_directory = VECTOR_DB_CONFIG["PERSIST_DIRECTORY"]
         self.collection_name = VECTOR_DB_CONFIG["COLLECTION_NAME"]
-        self.similarity_threshold = VECTOR_DB_CONFIG["SIMILARITY_THRESHOLD"]
+        
+        # 打开模式：默认只读打开，重启服务不会删除或重建索引
+        self.mode = mode or VECTOR_DB_CONFIG.get("OPEN_MODE", MODE_OPEN)
+        if self.mode not in OPEN_MODES:
+            raise ValueError(f"Unsupported open mode: {self.mode}")
+        self.read_only = self.mode == MODE_OPEN
+        
+        # 数据目录：默认为当前发布的版本快照（没有发布过版本时为 PERSIST_DIRECTORY 本身）
+        # 已发布的版本不再修改：可写模式在当前版本的草稿副本中写入，publish 后发布为新版本
+        self.version = None
+        self.draft = False
+        if persist_directory is None:
+            snapshots = self.snapshot_manager()
+            self.version, persist_directory = snapshots.resolve()
+            if self.version is not None and not self.read_only:
+                self.version, persist_directory = snapshots.fork(carry_files=(
+                    f"{self.collection_name}_mutations.log",
+                    f"{self.collection_name}_mutations.log.quarantine"
+                ))
+                self.draft = True
+        self.persist_directory = persist_directory
         self.top_k = VECTOR_DB_CONFIG["TOP_K"]
         self.metadata_filters = VECTOR_DB_CONFIG["METADATA_FILTERS"]
+        self.query_batch_size = VECTOR_DB_CONFIG.get("QUERY_BATCH_SIZE", 256)
+        self.ingest_config = VECTOR_DB_CONFIG["INGEST"]
+        self.last_ingest_stats = {}
+        # 自适应写入批大小（跨多次写入保留）
+        self.write_batch_size = None
+        # 增量变更：预写日志 + 后台批量应用（可写模式下打开）
+        self.mutation_config = VECTOR_DB_CONFIG["MUTATION_LOG"]
+        self.mutations = None
+        self.write_lock = threading.Lock()
+        
+        # 共享文档元数据表（与集合一起持久化，块元数据只保存文档ID）
+        self.documents_path = os.path.join(self.persist_directory, f"{self.collection_name}_documents.json")
+        self.documents = DocumentTable.load(self.documents_path)
+        
+        # bge-m3稀疏词权重倒排索引（与集合一起持久化，替代BM25）
+        self.sparse_index_path = os.path.join(self.persist_directory, f"{self.collection_name}_sparse.npz")
+        self.sparse_index = SparseInvertedIndex.load(self.sparse_index_path)
+        
+        # 集合schema记录（版本、嵌入维度、模型、距离度量）
+        self.schema_path = os.path.join(self.persist_directory, f"{self.collection_name}_schema.json")
+        self.schema = None
+        
+        # 距离度量：已有集合沿用schema记录的度量，新建或重建的集合使用配置的度量
+        self.metric = self.collection_metric()
+        # 嵌入维度：由调用方按嵌入模型实际输出的维度传入（MedicalEmbedder.embedding_dimension）
+        self.embedding_dim = self.collection_dim(embedding_dim)
+        
+        # 变更日志（尚未应用到存储后端的增量变更）
+        self.mutations_path = os.path.join(self.persist_directory, f"{self.collection_name}_mutations.log")
         
-        # 初始化数据库
-        self.client = self.init_client()
-        self.collection = self.init_collection()
+        # 初始化存储后端（chromadb / faiss / numpy）并按打开模式打开集合
+        self.store = self.init_store()
+        self.ready = self.init_collection()
+        # 以存储后端实际使用的度量换算距离（未声明度量的旧chromadb集合为l2）
+        self.metric = self.store.metric
+        if self.ready and not self.read_only and self.mutation_config["ENABLED"]:
+            self.mutations = MutationLog(
+                self.mutations_path,
+                self.apply_mutations,
+                group_commit_ms=self.mutation_config["GROUP_COMMIT_MS"],
+                apply_delay_ms=self.mutation_config["APPLY_DELAY_MS"],
+                max_batch=self.mutation_config["MAX_BATCH"],
+                retry_seconds=self.mutation_config["RETRY_SECONDS"],
+                max_attempts=self.mutation_config["MAX_ATTEMPTS"]
+            )
+    
+    @staticmethod
+    def snapshot_manager():
+        """PERSIST_DIRECTORY 下的版本快照管理器"""
+        from knowledge_base.snapshots import SnapshotManager
+        return SnapshotManager(VECTOR_DB_CONFIG["PERSIST_DIRECTORY"], VECTOR_DB_CONFIG["SNAPSHOTS"]["KEEP_VERSIONS"])
+    
+    def collection_metric(self):
+        """打开集合时使用的距离度量"""
+        if self.mode != MODE_REBUILD:
+            schema = self.load_schema()
+            if schema and schema.get("metric"):
+                return check_metric(schema["metric"])
+        return check_metric(VECTOR_DB_CONFIG["METRIC"])
+    
+    @property
+    def similarity_threshold(self):
+        """相似度阈值（余弦尺度）：按集合schema记录的模型取校准值，未单独校准的模型使用默认阈值"""
+        model = self.schema.get("model") if self.schema else None
+        return VECTOR_DB_CONFIG.get("SIMILARITY_THRESHOLDS", {}).get(model, VECTOR_DB_CONFIG["SIMILARITY_THRESHOLD"])
+    
+    def collection_dim(self, embedding_dim):
+        """集合的嵌入维度：优先使用嵌入模型实际的维度；未提供时已有集合沿用schema记录，新建集合使用配置"""
+        if embedding_dim:
+            return int(embedding_dim)
+        if self.mode != MODE_REBUILD:
+            schema = self.load_schema()
+            if schema and schema.get("embedding_dim"):
+                return schema["embedding_dim"]
+        return EMBEDDING_CONFIG["EMBEDDING_DIM"]
     
-    def init_client(self):
-        """初始化数据库客户端"""
+    def init_store(self):
+        """按DB_TYPE创建存储后端；启用分片时创建分片协调端，各分片使用DB_TYPE后端"""
         try:
-            if self.db_type == "chromadb":
-                # 创建持久化目录
-                os.makedirs(self.persist_directory, exist_ok=True)
-                
-                # 初始化ChromaDB客户端（使用新的PersistentClient）
-                client = chromadb.PersistentClient(
-                    path=self.persist_directory
-                )
-                
-                return client
-            else:
-                raise ValueError(f"Unsupported database type: {self.db_type}")
+            dim = self.embedding_dim
+            sharding = VECTOR_DB_CONFIG["SHARDING"]
+            if sharding["ENABLED"]:
+                from knowledge_base.sharding import ShardedStore
+                return ShardedStore(self.persist_directory, self.collection_name, dim, read_only=self.read_only,
+                                    db_type=self.db_type, config=sharding, metric=self.metric)
+            return create_store(self.db_type, self.persist_directory, self.collection_name, dim, self.read_only,
+                                metric=self.metric)
         except Exception as e:
             print(f"Error initializing client: {e}")
             raise
     
     def init_collection(self):
-        """初始化集合"""
+        """按打开模式初始化集合，返回集合是否可用"""
         try:
-            # 检查集合是否存在
-            collections = self.client.list_collections()
-            collection_names = [col.name for col in collections]
-            
-            # 尝试删除现有的集合，以便重新创建
-            if self.collection_name in collection_names:
-                print(f"删除现有集合: {self.collection_name}")
-                self.client.delete_collection(self.collection_name)
-            
-            # 创建新集合，不指定嵌入函数
-            collection = self.client.create_collection(
-                name=self.collection_name,
-                metadata={"description": "Medical knowledge base"}
-            )
-            print(f"创建新集合: {self.collection_name}")
+            exists = self.store.exists()
+            
+            if self.mode == MODE_REBUILD:
+                if exists:
+                    print(f"删除现有集合: {self.collection_name}")
+                    self.store.drop()
+                # 文档表、稀疏索引和schema随集合一起重建
+                self.reset_sidecars()
+                self.create_collection()
+                return True
             
-            return collection
+            if not exists:
+                if self.read_only:
+                    print(f"集合 {self.collection_name} 不存在，请先运行 build_kb 构建知识库")
+                    return False
+                self.create_collection()
+                return True
+            
+            self.store.open()
+            self.schema = self.load_schema()
+            self.validate_schema()
+            print(f"打开现有集合: {self.collection_name}（{self.db_type}，{self.mode}模式，{self.store.count()} 个文本块）")
+            return True
         except Exception as e:
             print(f"Error initializing collection: {e}")
             raise
     
-    def add_chunks(self, chunks):
-        """添加文本块到向量数据库"""
+    def create_collection(self):
+        """创建新集合并写入schema记录"""
+        self.store.create()
+        self.schema = self.expected_schema()
+        self.save_schema()
+        print(f"创建新集合: {self.collection_name}（{self.db_type}）")
+    
+    def expected_schema(self):
+        """根据当前嵌入模型生成的schema记录（嵌入维度为模型实际的维度）"""
+        medical_model = EMBEDDING_CONFIG["MEDICAL_MODEL"]
+        if medical_model["ENABLED"] and os.path.exists(medical_model["MODEL_PATH"]):
+            model = medical_model["MODEL_PATH"]
+        else:
+            model = EMBEDDING_CONFIG["MODEL_NAME"]
+        return {
+            "schema_version": SCHEMA_VERSION,
+            "collection": self.collection_name,
+            "db_type": self.db_type,
+            "embedding_dim": self.embedding_dim,
+            "model": model,
+            "model_type": EMBEDDING_CONFIG["MODEL_TYPE"],
+            "metric": self.store.metric,
+            "created_at": datetime.now().isoformat(timespec="seconds")
+        }
+    
+    def record_build_info(self, **fields):
+        """在schema中记录构建时实际使用的设置（如离线备用嵌入器、分块方式），检索和增量写入时据此确认一致"""
+        self.schema.update(fields)
+        self.save_schema()
+    
+    def load_schema(self):
+        """加载schema记录，不存在时返回None"""
+        if not os.path.exists(self.schema_path):
+            return None
+        with open(self.schema_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def save_schema(self):
+        """原子写入schema记录"""
+        self.schema["updated_at"] = datetime.now().isoformat(timespec="seconds")
+        tmp_path = self.schema_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.schema, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.schema_path)
+    
+    def validate_schema(self):
+        """校验已有集合与当前配置是否兼容，嵌入维度不一致时拒绝打开"""
+        expected = self.expected_schema()
+        if self.schema is None:
+            # 旧版本构建的集合没有schema记录：可写模式下补写，只读模式下跳过校验
+            print(f"警告: 集合 {self.collection_name} 没有schema记录")
+            if not self.read_only:
+                self.schema = expected
+                self.save_schema()
+            return
+        
+        if self.schema.get("schema_version") != SCHEMA_VERSION:
+            raise ValueError(f"集合schema版本 {self.schema.get('schema_version')} 与当前版本 {SCHEMA_VERSION} "
+                             f"不兼容，请使用 rebuild 模式重建知识库")
+        if self.schema.get("embedding_dim") != expected["embedding_dim"]:
+            raise ValueError(f"集合嵌入维度 {self.schema.get('embedding_dim')} 与当前模型维度 "
+                             f"{expected['embedding_dim']} 不一致，请使用 rebuild 模式重建知识库")
+        if (self.schema.get("model"), self.schema.get("model_type")) != (expected["model"], expected["model_type"]):
+            print(f"警告: 集合由 {self.schema.get('model')}（{self.schema.get('model_type')}）构建，"
+                  f"当前配置为 {expected['model']}（{expected['model_type']}），检索结果可能不准确")
+        if expected["metric"] != VECTOR_DB_CONFIG["METRIC"]:
+            print(f"警告: 集合使用 {expected['metric']} 距离度量，当前配置为 {VECTOR_DB_CONFIG['METRIC']}，"
+                  f"按集合的度量检索（使用 rebuild 模式重建后切换）")
+    
+    def check_writable(self):
+        """只读模式下拒绝写操作"""
+        if self.read_only:
+            print(f"集合 {self.collection_name} 以只读模式打开，拒绝写入")
+            return False
+        if not self.ready:
+            print(f"集合 {self.collection_name} 不存在")
+            return False
+        return True
+    
+    def reset_sidecars(self):
+        """清空与集合一起持久化的文档表、稀疏索引和变更日志"""
+        self.documents = DocumentTable()
+        self.sparse_index = SparseInvertedIndex()
+        for path in (self.documents_path, self.sparse_index_path, self.schema_path, self.mutations_path):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def get_existing_ids(self, ids):
+        """返回集合中已存在的ID集合"""
         try:
+            return self.store.existing_ids(ids)
+        except Exception as e:
+            print(f"Error getting existing ids: {e}")
+            return set()
+    
+    def filter_existing(self, chunks):
+        """块ID由内容决定，去掉已入库的块"""
+        existing_ids = self.get_existing_ids([chunk["id"] for chunk in chunks if "id" in chunk])
+        if existing_ids:
+            print(f"跳过 {len(existing_ids)} 个未变化的文本块")
+            chunks = [chunk for chunk in chunks if chunk.get("id") not in existing_ids]
+        return chunks
+    
+    def prepare_rows(self, chunks):
+        """将文本块转换为入库的列数据，缺少嵌入向量的块被跳过"""
+        ids = []
+        embeddings = []
+        documents = []
+        metadatas = []
+        sparse_weights = []
+        document_id_maps = {}
+        skipped = 0
+        
+        for chunk in chunks:
+            # 检查必要字段
+            if not all(key in chunk for key in ["id", "content", "embedding"]):
+                skipped += 1
+                continue
+            
+            ids.append(chunk["id"])
+            embeddings.append(chunk["embedding"])
+            documents.append(chunk["content"])
+            sparse_weights.append(chunk.get("sparse"))
+            
+            if isinstance(chunk, Chunk):
+                # 紧凑块：文档级元数据只写入文档表一次，块元数据只保存文档ID
+                table_key = id(chunk.table)
+                if table_key not in document_id_maps:
+                    document_id_maps[table_key] = self.documents.merge(chunk.table)
+                metadata = chunk.compact_metadata()
+                metadata["doc_id"] = document_id_maps[table_key][chunk.doc_id]
+                full_metadata = chunk.table.get(chunk.doc_id)
+            else:
+                metadata = chunk.get("metadata", {})
+                full_metadata = metadata
+            
+            # 处理元数据，将列表转换为字符串
+            processed_metadata = {}
+            for key, value in metadata.items():
+                if isinstance(value, list):
+                    # 将列表转换为字符串
+                    processed_metadata[key] = ", ".join(str(item) for item in value)
+                else:
+                    processed_metadata[key] = value
+            # 可过滤字段：日期整数、疾病标签（标签按文档标题和块正文判断）
+            processed_metadata.update(filter_fields(
+                full_metadata, f"{full_metadata.get('document_title', '')}\n{chunk['content']}"
+            ))
+            metadatas.append(processed_metadata)
+        
+        if skipped:
+            print(f"跳过 {skipped} 个缺少ID、内容或嵌入向量的文本块")
+        # 入库时归一化一次，存储后端和查询不再逐次归一化
+        if embeddings:
+            embeddings = normalize_embeddings(embeddings)
+        return ids, embeddings, documents, metadatas, sparse_weights
+    
+    def save_sidecars(self):
+        """持久化存储后端，并保存文档表和稀疏索引"""
+        self.store.flush()
+        self.documents.save(self.documents_path)
+        if len(self.sparse_index) or os.path.exists(self.sparse_index_path):
+            self.sparse_index.save(self.sparse_index_path)
+    
+    def add_chunks(self, chunks, skip_existing=False, upsert=False, save=True):
+        """添加已嵌入的文本块到向量数据库（使用块中预先计算的嵌入向量）"""
+        try:
+            if not self.check_writable():
+                return 0
             if not chunks:
                 print("No chunks to add")
                 return 0
             
-            # 准备数据
-            ids = []
-            documents = []
-            metadatas = []
-            
-            for chunk in chunks:
-                # 检查必要字段
-                if not all(key in chunk for key in ["id", "content"]):
-                    continue
-                
-                ids.append(chunk["id"])
-                documents.append(chunk["content"])
-                
-                # 处理元数据，将列表转换为字符串
-                metadata = chunk.get("metadata", {})
-                processed_metadata = {}
-                for key, value in metadata.items():
-                    if isinstance(value, list):
-                        # 将列表转换为字符串
-                        processed_metadata[key] = ", ".join(str(item) for item in value)
-                    else:
-                        processed_metadata[key] = value
-                metadatas.append(processed_metadata)
+            if skip_existing:
+                chunks = self.filter_existing(chunks)
             
+            ids, embeddings, documents, metadatas, sparse_weights = self.prepare_rows(chunks)
             if not ids:
                 print("No valid chunks to add")
                 return 0
             
-            # 尝试添加到集合，使用最简单的方式
-            # 由于 onnxruntime 问题，我们只添加文本和元数据，不使用嵌入功能
-            # 这样至少可以存储数据，后续可以再处理查询问题
-            print(f"尝试添加 {len(ids)} 个文本块到集合")
-            
-            # 分批次添加，避免一次性添加太多数据
-            batch_size = 10
-            total_added = 0
-            
-            for i in range(0, len(ids), batch_size):
-                batch_ids = ids[i:i+batch_size]
-                batch_documents = documents[i:i+batch_size]
-                batch_metadatas = metadatas[i:i+batch_size]
-                
-                try:
-                    # 只添加文本和元数据，不使用嵌入功能
-                    self.collection.add(
-                        ids=batch_ids,
-                        documents=batch_documents,
-                        metadatas=batch_metadatas
-                    )
-                    total_added += len(batch_ids)
-                    print(f"已添加批次 {i//batch_size + 1}，共 {total_added} 个文本块")
-                except Exception as e:
-                    print(f"添加批次 {i//batch_size + 1} 时出错: {e}")
-                    continue
+            total_added = self.add_embeddings(ids, embeddings, documents, metadatas, upsert=upsert,
+                                              sparse=sparse_weights)
+            if save:
+                self.save_sidecars()
+            return total_added
+        except Exception as e:
+            print(f"Error adding chunks: {e}")
+            return 0
+    
+    def max_write_batch(self):
+        """单次写入的行数上限（不超过存储后端的批大小限制）"""
+        limit = self.ingest_config["MAX_BATCH_SIZE"]
+        try:
+            store_limit = self.store.max_batch_size()
+            if store_limit:
+                limit = min(limit, store_limit)
+        except Exception:
+            pass
+        return max(limit, 1)
+    
+    def add_embeddings(self, ids, embeddings, documents=None, metadatas=None, upsert=False, sparse=None):
+        """批量写入预先计算的嵌入向量（应已L2归一化，见 prepare_rows）
+        
+        批大小按每批写入耗时自适应调整：快于目标耗时加倍，慢于目标耗时减半，写入失败时减半重试。
+        upsert为True时覆盖已存在的ID，否则已存在的ID保持不变。
+        """
+        if not self.check_writable() or not ids:
+            return 0
+        
+        # 嵌入维度必须与schema记录一致
+        dim = len(embeddings[0])
+        if self.schema and dim != self.schema.get("embedding_dim"):
+            print(f"嵌入维度 {dim} 与集合维度 {self.schema.get('embedding_dim')} 不一致，拒绝写入")
+            return 0
+        
+        max_batch = self.max_write_batch()
+        batch_size = min(self.write_batch_size or self.ingest_config["BATCH_SIZE"], max_batch)
+        target_seconds = self.ingest_config["TARGET_BATCH_SECONDS"]
+        
+        total_added = 0
+        failed = 0
+        start = time.perf_counter()
+        i = 0
+        while i < len(ids):
+            end = min(i + batch_size, len(ids))
+            batch_embeddings = embeddings[i:end]
+            if hasattr(batch_embeddings, "tolist"):
+                batch_embeddings = batch_embeddings.tolist()
             
-            # 持久化
+            batch_start = time.perf_counter()
             try:
-                self.client.persist()
-                print("数据持久化完成")
+                self.store.write(
+                    ids[i:end],
+                    batch_embeddings,
+                    documents[i:end] if documents is not None else None,
+                    metadatas[i:end] if metadatas is not None else None,
+                    upsert=upsert
+                )
             except Exception as e:
-                print(f"持久化时出错: {e}")
+                if end - i > 1:
+                    # 失败的批大小作为本次写入的上限，不再增长回去
+                    batch_size = max((end - i) // 2, 1)
+                    max_batch = batch_size
+                    print(f"写入 {end - i} 行失败（{e}），批大小降为 {batch_size} 后重试")
+                else:
+                    print(f"写入文本块 {ids[i]} 失败: {e}")
+                    failed += 1
+                    i = end
+                continue
             
-            print(f"成功添加 {total_added} 个文本块到向量数据库")
-            return total_added
-        except Exception as e:
-            print(f"Error adding chunks: {e}")
+            if sparse is not None:
+                # upsert时覆盖旧的词权重（没有新词权重的块从稀疏索引中移除）
+                self.sparse_index.add_many(ids[i:end], sparse[i:end], replace=upsert)
+            total_added += end - i
+            i = end
+            
+            elapsed = time.perf_counter() - batch_start
+            if elapsed < target_seconds / 2:
+                batch_size = min(batch_size * 2, max_batch)
+            elif elapsed > target_seconds * 2:
+                batch_size = max(batch_size // 2, 1)
+        
+        self.write_batch_size = batch_size
+        elapsed = time.perf_counter() - start
+        self.last_ingest_stats = {
+            "rows": total_added,
+            "failed": failed,
+            "seconds": elapsed,
+            "rows_per_sec": total_added / elapsed if elapsed else 0.0,
+            "final_batch_size": batch_size
+        }
+        print(f"写入 {total_added} 个文本块（失败 {failed}），耗时 {elapsed:.1f} 秒，"
+              f"{self.last_ingest_stats['rows_per_sec']:.0f} 行/秒，批大小 {batch_size}")
+        return total_added
+    
+    def ingest_chunks(self, chunks, embed_fn, skip_existing=False, upsert=False, window_size=None):
+        """流水线入库：后台线程按窗口嵌入文本块，主线程同时写入上一个窗口的结果
+        
+        embed_fn 接收一个文本块列表，返回带嵌入向量的文本块列表（如 MedicalEmbedder.embed_chunks）。
+        某个窗口嵌入失败时继续处理其余窗口；返回入库的文本块数，last_ingest_stats 记录
+        跳过的重复块（skipped，ID相同或已入库）和失败的块数（failed），调用方据此判断入库是否完整。
+        """
+        if not self.check_writable():
             return 0
+        # ID由内容决定，同一输入中ID相同的块只入库一次
+        total_chunks = len(chunks)
+        seen = set()
+        unique_chunks = []
+        for chunk in chunks:
+            if "id" in chunk:
+                if chunk["id"] in seen:
+                    continue
+                seen.add(chunk["id"])
+            unique_chunks.append(chunk)
+        chunks = unique_chunks
+        if skip_existing:
+            chunks = self.filter_existing(chunks)
+        skipped = total_chunks - len(chunks)
+        self.last_ingest_stats = {"rows": 0, "skipped": skipped, "failed": 0}
+        if not chunks:
+            print("No chunks to add")
+            return 0
+        
+        window_size = window_size or self.ingest_config["EMBED_WINDOW"]
+        windows = queue.Queue(maxsize=self.ingest_config["QUEUE_SIZE"])
+        
+        def produce():
+            try:
+                for window_start in range(0, len(chunks), window_size):
+                    try:
+                        windows.put(embed_fn(chunks[window_start:window_start + window_size]))
+                    except Exception as e:
+                        windows.put(e)
+            finally:
+                windows.put(None)
+        
+        producer = threading.Thread(target=produce, name="ingest-embedder", daemon=True)
+        start = time.perf_counter()
+        producer.start()
+        
+        total_added = 0
+        while True:
+            embedded_chunks = windows.get()
+            if embedded_chunks is None:
+                break
+            if isinstance(embedded_chunks, Exception):
+                print(f"Error embedding chunks: {embedded_chunks}")
+                continue
+            total_added += self.add_chunks(embedded_chunks, upsert=upsert, save=False)
+            print(f"已入库 {total_added}/{len(chunks)} 个文本块")
+        producer.join()
+        self.save_sidecars()
+        
+        elapsed = time.perf_counter() - start
+        failed = len(chunks) - total_added
+        self.last_ingest_stats = {"rows": total_added, "skipped": skipped, "failed": failed, "seconds": elapsed}
+        print(f"流水线入库完成: {total_added} 个文本块（跳过重复 {skipped}，失败 {failed}），耗时 {elapsed:.1f} 秒，"
+              f"{total_added / elapsed if elapsed else 0.0:.0f} 行/秒（含嵌入）")
+        return total_added
     
     def query(self, query_embedding, top_k=None, filters=None):
-        """查询向量数据库"""
+        """查询向量数据库
+
+        filters使用chromadb的where语法；publication_date 可以按日期区间比较（如 {"$gt": "2020"}），
+        疾病标签写作 {"disease": "高血压"}。
+        """
+        if not query_embedding:
+            return []
+        return self.query_many([query_embedding], top_k=top_k, filters=filters)[0]
+    
+    def query_many(self, query_embeddings, top_k=None, filters=None, batch_size=None):
+        """批量查询向量数据库，返回与输入顺序一致的结果列表（无效向量对应空列表）
+
+        每批查询只调用一次存储后端（NumPy为一次矩阵-矩阵乘积，FAISS/chromadb为一次批量检索）。
+        本进程尚未应用的增量变更叠加在存储结果之上（读己之写）。
+        """
+        results = [[] for _ in query_embeddings]
         try:
-            if not query_embedding:
-                return []
+            if not self.ready:
+                return results
             
             # 使用默认值
             if top_k is None:
                 top_k = self.top_k
+            if filters is None:
+                filters = self.metadata_filters
+            batch_size = batch_size or self.query_batch_size
             
+            # 日期、标签条件改写为入库时的可过滤字段
+            where = normalize_where(filters)
+            # 先取未应用的变更再查询存储后端：期间应用完成的变更仍以叠加的版本为准，不会丢失
+            pending = self.mutations.pending_mutations() if self.mutations is not None else {}
+            # 存储结果中的文本块可能已被删除或改写，多取候选补足
+            fetch_k = top_k + min(len(pending), top_k * 10)
+            valid = [i for i, embedding in enumerate(query_embeddings) if embedding is not None and len(embedding)]
+            for start in range(0, len(valid), batch_size):
+                batch = valid[start:start + batch_size]
+                # 每批查询向量归一化一次，存储后端直接按内积打分
+                batch_embeddings = normalize_embeddings([query_embeddings[i] for i in batch])
+                batch_results = self.store.query_many(batch_embeddings, fetch_k, where=where)
+                if pending:
+                    batch_results = self.overlay_pending(batch_embeddings, batch_results, pending, where, top_k)
+                for i, hits in zip(batch, batch_results):
+                    results[i] = self.format_results(hits)
+            return results
+        except Exception as e:
+            print(f"Error querying database: {e}")
+            return results
+    
+    def overlay_distances(self, query_embeddings, embeddings):
+        """按集合的距离度量计算查询与变更向量的距离（与存储后端返回的距离一致，两边均已归一化）"""
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        return scores_to_distances(queries @ vectors.T, self.metric)
+    
+    def overlay_pending(self, query_embeddings, results, pending, where, top_k):
+        """把尚未应用的变更叠加到存储后端的结果上
+        
+        已删除的块从结果中去掉，只改正文或元数据的块就地替换，带新向量的块重新打分后与存储结果合并。
+        只改元数据、因此新满足过滤条件的块在变更应用后才会出现在结果中。
+        """
+        scored = [mutation for mutation in pending.values()
+                  if mutation["op"] != OP_DELETE and mutation.get("embedding") is not None]
+        incomplete = [mutation["id"] for mutation in scored if mutation["op"] == OP_UPDATE]
+        stored = self.store.get(incomplete) if incomplete else {}
+        
+        candidates = []
+        for mutation in scored:
+            document, metadata = mutation.get("document"), mutation.get("metadata")
+            if mutation["op"] == OP_UPDATE:
+                # 部分更新缺少的字段取自存储后端；更新不存在的块不生效
+                if mutation["id"] not in stored:
+                    continue
+                old_document, old_metadata = stored[mutation["id"]]
+                document = old_document if document is None else document
+                metadata = old_metadata if metadata is None else metadata
+            if matches_filter(metadata, where):
+                candidates.append((mutation["id"], document, metadata, mutation["embedding"]))
+        distances = None
+        if candidates:
+            distances = self.overlay_distances(query_embeddings, [candidate[3] for candidate in candidates])
+        
+        merged = []
+        for i, hits in enumerate(results):
+            combined = []
+            for doc_id, distance, document, metadata in hits:
+                mutation = pending.get(doc_id)
+                if mutation is not None:
+                    if mutation["op"] != OP_UPDATE or mutation.get("embedding") is not None:
+                        continue
+                    document = mutation["document"] if mutation.get("document") is not None else document
+                    metadata = mutation["metadata"] if mutation.get("metadata") is not None else metadata
+                    if not matches_filter(metadata, where):
+                        continue
+                combined.append((doc_id, distance, document, metadata))
+            for j, (doc_id, document, metadata, _) in enumerate(candidates):
+                combined.append((doc_id, float(distances[i, j]), document, metadata))
+            combined.sort(key=lambda hit: hit[1])
+            merged.append(combined[:top_k])
+        return merged
+    
+    def format_results(self, hits):
+        """把存储后端的 (ID, 距离, 正文, 元数据) 转换为结果字典，过滤相似度低于阈值的结果
+
+        score为余弦相似度（越大越相似，按集合的度量由距离换算），distance为存储后端返回的原始距离。
+        """
+        processed_results = []
+        for doc_id, distance, content, metadata in hits:
+            similarity = distance_to_similarity(distance, self.metric)
+            if similarity >= self.similarity_threshold:
+                processed_results.append({
+                    "id": doc_id,
+                    "score": similarity,
+                    "distance": distance,
+                    "content": content,
+                    "metadata": self.join_metadata(metadata)
+                })
+        return processed_results
+    
+    def sparse_query(self, query_weights, top_k=None, filters=None):
+        """用bge-m3稀疏词权重查询倒排索引，得分越高越相关"""
+        try:
+            if not query_weights or not len(self.sparse_index) or not self.ready:
+                return []
+            if top_k is None:
+                top_k = self.top_k
             if filters is None:
                 filters = self.metadata_filters
+            where = normalize_where(filters)
             
-            # 执行查询
-            results = self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=top_k,
-                where=filters
-            )
+            # 有过滤条件时多取候选，取回元数据后再过滤；尚未应用的删除会丢掉候选，按删除数多取
+            pending = self.mutations.pending_mutations() if self.mutations is not None else {}
+            pending_deletes = sum(1 for mutation in pending.values() if mutation["op"] == OP_DELETE)
+            hits = self.sparse_index.search(query_weights, (top_k * 10 if where else top_k) + pending_deletes)
+            if not hits:
+                return []
+            
+            # 只为命中的块取回正文和元数据，叠加本进程尚未应用的变更
+            rows = self.store.get([doc_id for doc_id, _ in hits])
             
-            # 处理结果
-            processed_results = []
-            for i in range(len(results["ids"][0])):
-                result = {
-                    "id": results["ids"][0][i],
-                    "score": results["distances"][0][i],
-                    "content": results["documents"][0][i],
-                    "metadata": results["metadatas"][0][i]
-                }
-                
-                # 过滤相似度低于阈值的结果
-                if result["score"] <= (1 - self.similarity_threshold):
-                    processed_results.append(result)
-            
-            return processed_results
+            results = []
+            for doc_id, score in hits:
+                mutation = pending.get(doc_id)
+                if mutation is not None:
+                    if mutation["op"] == OP_DELETE:
+                        continue
+                    if doc_id in rows or mutation["op"] == OP_UPSERT:
+                        content, metadata = rows.get(doc_id, (None, None))
+                        rows[doc_id] = (mutation["document"] if mutation.get("document") is not None else content,
+                                        mutation["metadata"] if mutation.get("metadata") is not None else metadata)
+                if doc_id in rows:
+                    content, metadata = rows[doc_id]
+                    if not matches_filter(metadata, where):
+                        continue
+                    results.append({
+                        "id": doc_id,
+                        "score": score,
+                        "content": content,
+                        "metadata": self.join_metadata(metadata)
+                    })
+                    if len(results) >= top_k:
+                        break
+            return results
         except Exception as e:
-            print(f"Error querying database: {e}")
+            print(f"Error querying sparse index: {e}")
             return []
     
+    def matches_filters(self, content, metadata, filters):
+        """判断不经过向量库的结果（如BM25结果）是否满足过滤条件，metadata为完整元数据"""
+        if not filters:
+            return True
+        metadata = {**metadata, **filter_fields(metadata, f"{metadata.get('document_title', '')}\n{content}")}
+        return matches_filter(metadata, normalize_where(filters))
+    
+    def join_metadata(self, metadata):
+        """将块元数据与文档表拼接为完整元数据（仅对返回的结果执行）"""
+        if not metadata or "doc_id" not in metadata:
+            return metadata
+        doc_id = metadata["doc_id"]
+        if not 0 <= doc_id < len(self.documents):
+            return metadata
+        joined = self.documents.get(doc_id)
+        joined.update(metadata)
+        return joined
+    
     def get_collection_stats(self):
         """获取集合统计信息"""
         try:
-            stats = self.collection.count()
+            if not self.ready:
+                return 0
+            stats = self.store.count()
             print(f"Collection contains {stats} documents")
             return stats
         except Exception as e:
@@ -188,46 +728,184 @@ class VectorDatabase:
     def clear_collection(self):
         """清空集合"""
         try:
-            self.client.delete_collection(self.collection_name)
-            self.collection = self.init_collection()
+            if not self.check_writable():
+                return
+            self.sync_mutations()
+            self.store.drop()
+            self.reset_sidecars()
+            self.create_collection()
             print(f"Collection {self.collection_name} cleared")
         except Exception as e:
             print(f"Error clearing collection: {e}")
     
+    def stored_document(self, chunk_id):
+        """文本块当前的正文（优先取本进程尚未应用的变更）"""
+        if self.mutations is not None:
+            mutation = self.mutations.pending_mutations().get(chunk_id)
+            if mutation is not None and mutation.get("document") is not None:
+                return mutation["document"]
+        return self.store.get([chunk_id]).get(chunk_id, ("", None))[0] or ""
+    
+    def upsert_chunks(self, chunks, wait=True):
+        """写入或覆盖已嵌入的文本块（增量更新），返回接受的文本块数
+        
+        启用变更日志时追加到日志后立即返回（对本进程的查询立即可见），由后台线程批量写入存储后端；
+        wait为True时等到变更写入日志文件后返回。
+        """
+        try:
+            if not self.check_writable():
+                return 0
+            if self.mutations is None:
+                return self.add_chunks(chunks, upsert=True)
+            with self.write_lock:
+                ids, embeddings, documents, metadatas, sparse_weights = self.prepare_rows(chunks)
+            if not ids:
+                print("No valid chunks to add")
+                return 0
+            dim = len(embeddings[0])
+            if self.schema and dim != self.schema.get("embedding_dim"):
+                print(f"嵌入维度 {dim} 与集合维度 {self.schema.get('embedding_dim')} 不一致，拒绝写入")
+                return 0
+            self.mutations.append([
+                {"op": OP_UPSERT, "id": doc_id, "embedding": embedding, "document": document,
+                 "metadata": metadata, "sparse": sparse}
+                for doc_id, embedding, document, metadata, sparse
+                in zip(ids, embeddings, documents, metadatas, sparse_weights)
+            ], wait=wait)
+            return len(ids)
+        except Exception as e:
+            print(f"Error upserting chunks: {e}")
+            return 0
+    
     def update_chunk(self, chunk_id, new_content=None, new_metadata=None, new_embedding=None):
-        """更新文本块"""
+        """更新文本块（启用变更日志时异步应用，本进程的查询立即可见）"""
         try:
-            update_data = {}
-            if new_content is not None:
-                update_data["documents"] = new_content
+            if not self.check_writable():
+                return False
+            if new_content is None and new_metadata is None and new_embedding is None:
+                return False
             if new_metadata is not None:
-                update_data["metadatas"] = new_metadata
+                # 重新计算可过滤字段；只更新元数据时按已存储的正文判断标签
+                content = new_content if new_content is not None else self.stored_document(chunk_id)
+                full_metadata = self.join_metadata(new_metadata)
+                new_metadata = {**new_metadata, **filter_fields(
+                    full_metadata, f"{full_metadata.get('document_title', '')}\n{content}"
+                )}
             if new_embedding is not None:
-                update_data["embeddings"] = new_embedding
-            
-            if update_data:
-                self.collection.update(
-                    ids=[chunk_id],
-                    **update_data
-                )
-                self.client.persist()
-                print(f"Updated chunk: {chunk_id}")
-                return True
-            return False
+                new_embedding = normalize_embeddings(new_embedding)[0]
+            if self.mutations is not None:
+                self.mutations.append([{"op": OP_UPDATE, "id": chunk_id, "document": new_content,
+                                        "metadata": new_metadata, "embedding": new_embedding}])
+            else:
+                self.store.update(chunk_id, document=new_content, metadata=new_metadata, embedding=new_embedding)
+                self.store.flush()
+            print(f"Updated chunk: {chunk_id}")
+            return True
         except Exception as e:
             print(f"Error updating chunk: {e}")
             return False
     
     def delete_chunk(self, chunk_id):
         """删除文本块"""
+        return self.delete_chunks([chunk_id]) > 0
+    
+    def delete_chunks(self, chunk_ids, wait=True):
+        """批量删除文本块，返回接受的删除数（启用变更日志时异步应用，本进程的查询立即可见）"""
         try:
-            self.collection.delete(ids=[chunk_id])
-            self.client.persist()
-            print(f"Deleted chunk: {chunk_id}")
-            return True
+            if not self.check_writable() or not chunk_ids:
+                return 0
+            if self.mutations is not None:
+                self.mutations.append([{"op": OP_DELETE, "id": chunk_id} for chunk_id in chunk_ids], wait=wait)
+            else:
+                self.store.delete(list(chunk_ids))
+                self.store.flush()
+            print(f"Deleted {len(chunk_ids)} chunks")
+            return len(chunk_ids)
         except Exception as e:
             print(f"Error deleting chunk: {e}")
-            return False
+            return 0
+    
+    def apply_mutations(self, mutations):
+        """把合并后的一组变更应用到存储后端（变更日志的后台线程调用），整组只落盘一次
+        
+        应用后墓碑比例超过 COMPACT_RATIO 时清理墓碑（同样在后台线程中执行）。
+        """
+        upserts = [mutation for mutation in mutations if mutation["op"] == OP_UPSERT]
+        updates = [mutation for mutation in mutations if mutation["op"] == OP_UPDATE]
+        deletes = [mutation["id"] for mutation in mutations if mutation["op"] == OP_DELETE]
+        with self.write_lock:
+            if deletes:
+                self.store.delete(deletes)
+                self.sparse_index.remove(deletes)
+            if upserts:
+                self.add_embeddings(
+                    [mutation["id"] for mutation in upserts],
+                    [mutation["embedding"] for mutation in upserts],
+                    [mutation.get("document") for mutation in upserts],
+                    [mutation.get("metadata") for mutation in upserts],
+                    upsert=True,
+                    sparse=[mutation.get("sparse") for mutation in upserts]
+                )
+            for mutation in updates:
+                try:
+                    self.store.update(mutation["id"], document=mutation.get("document"),
+                                      metadata=mutation.get("metadata"), embedding=mutation.get("embedding"))
+                except KeyError:
+                    print(f"文本块 {mutation['id']} 不存在，跳过更新")
+            self.save_sidecars()
+            
+            ratio = self.store.tombstone_ratio()
+            if ratio > self.mutation_config["COMPACT_RATIO"]:
+                print(f"墓碑比例 {ratio:.0%}，开始清理")
+                self.store.compact()
+        print(f"已应用 {len(mutations)} 条变更（写入 {len(upserts)}，更新 {len(updates)}，删除 {len(deletes)}）")
+    
+    def sync_mutations(self, timeout=None):
+        """等待已追加的变更全部应用到存储后端，超时返回False"""
+        if self.mutations is None:
+            return True
+        return self.mutations.sync(timeout)
+    
+    def compact(self):
+        """立即清理墓碑，返回清理的行数"""
+        try:
+            if not self.check_writable():
+                return 0
+            self.sync_mutations()
+            with self.write_lock:
+                return self.store.compact()
+        except Exception as e:
+            print(f"Error compacting collection: {e}")
+            return 0
+    
+    def close(self):
+        """应用剩余的变更并停止变更日志线程；分片模式下停止本机启动的分片进程
+        
+        草稿版本关闭后不发布，下次以可写模式打开时继续使用（需要发布时调用publish）。
+        """
+        if self.mutations is not None:
+            self.mutations.close()
+            self.mutations = None
+        if hasattr(self.store, "close"):
+            self.store.close()
+    
+    def publish(self, timeout=None):
+        """应用剩余的变更、关闭集合并把草稿发布为新版本，运行中的服务在下次检查时切换；返回发布的版本号
+        
+        变更未能在timeout内全部应用时不发布（草稿保留，返回None）。
+        """
+        if not self.draft:
+            print("集合不是草稿版本，无需发布")
+            return None
+        if not self.sync_mutations(timeout):
+            print(f"草稿版本 {self.version} 仍有未应用的变更，暂不发布")
+            return None
+        self.close()
+        # 发布后的版本不再修改
+        self.read_only = True
+        self.draft = False
+        self.snapshot_manager().publish(self.version)
+        return self.version
 
 if __name__ == "__main__":
     # 示例使用
@@ -241,6 +919,6 @@ if __name__ == "__main__":
     results = vector_db.query(sample_query_embedding, top_k=3)
     print(f"查询结果数量: {len(results)}")
     for i, result in enumerate(results):
-        print(f"结果 {i+1}: 相似度={1-result['score']:.4f}")
+        print(f"结果 {i+1}: 相似度={result['score']:.4f}")
         print(f"内容: {result['content'][:100]}...")
         print()
@@ -30,20 +30,75 @@ class SilverGuardAI:
             print("没有处理数据，知识库构建失败")
             return
         
-        # 分块
-        from knowledge_base.chunker import MedicalChunker
-        chunker = MedicalChunker()
-        chunks = []
-        for document in processed_data:
-            document_chunks = chunker.chunk_document(document)
-            chunks.extend(document_chunks)
+        # 嵌入模型决定分块方式：token模式使用模型的分词器，模型无法加载（使用离线备用嵌入器）时按字符分块
+        from knowledge_base.embedder import MedicalEmbedder
+        from knowledge_base.vector_db import VectorDatabase, MODE_REBUILD
+        embedder = MedicalEmbedder()
+        try:
+            use_fallback = embedder.uses_fallback()
+            
+            # 分块
+            from knowledge_base.chunker import MedicalChunker
+            chunker = MedicalChunker(mode="char" if use_fallback else None)
+            chunks = chunker.chunk_multiple_documents(processed_data)
+            
+            print(f"生成了 {len(chunks)} 个文本块")
+            
+            # 去重
+            from knowledge_base.dedup import ChunkDeduplicator
+            deduplicator = ChunkDeduplicator()
+            chunks = deduplicator.deduplicate(chunks)
+            
+            # 向量化并入库：写入新的版本目录，嵌入与写入流水线并行；运行中的服务继续使用当前版本
+            snapshots = VectorDatabase.snapshot_manager()
+            version, directory = snapshots.new_version()
+            print(f"构建知识库版本 {version}: {directory}")
+            vector_db = None
+            try:
+                # 集合按模型实际输出的嵌入维度创建（进程池模式下由工作进程报告）
+                vector_db = VectorDatabase(mode=MODE_REBUILD, persist_directory=directory,
+                                           embedding_dim=embedder.embedding_dimension())
+                # 分块方式决定块ID（备用嵌入器或分词器不可用时按字符分块，可以从schema中看出）
+                vector_db.record_build_info(chunking=chunker.mode)
+                if use_fallback:
+                    # 模型无法加载：备用嵌入器的IDF先对整个语料拟合一次，并在schema中记录，检索时不会与模型向量混用
+                    from knowledge_base.hashing_embedder import HASHING_FALLBACK_MODEL
+                    embedder.fit_fallback([chunk.get('content', '') for chunk in chunks
+                                           if chunk.get('content', '').strip()], directory)
+                    vector_db.record_build_info(model=HASHING_FALLBACK_MODEL)
+                added = vector_db.ingest_chunks(chunks, embedder.embed_chunks)
+                # 只允许跳过ID重复的块；有窗口嵌入或写入失败时不发布不完整的版本
+                expected = len(chunks) - vector_db.last_ingest_stats.get("skipped", 0)
+                if added != expected:
+                    raise RuntimeError(f"入库不完整: {added}/{expected} 个文本块，放弃版本 {version}")
+                
+                # BM25语料与向量库放在同一个版本中（bge-m3模式使用稀疏索引，不需要BM25）
+                if not embedder.sparse_enabled:
+                    from rag_engine.retriever import BM25Corpus
+                    BM25Corpus().add_documents(processed_data).save(directory)
+                
+                total = vector_db.get_collection_stats()
+                if not total:
+                    raise RuntimeError("向量数据库为空")
+            except Exception:
+                snapshots.discard(version)
+                raise
+            finally:
+                # 停止变更日志线程和本机分片进程
+                if vector_db is not None:
+                    vector_db.close()
+        finally:
+            # 释放多进程嵌入池和微批处理线程
+            embedder.close()
         
-        print(f"生成了 {len(chunks)} 个文本块")
-        
-        # 暂时跳过向量数据库构建步骤，因为遇到了 onnxruntime DLL 加载问题
-        # 后续可以使用其他方法来处理向量数据库的问题
-        print("暂时跳过向量数据库构建步骤")
-        print("知识库构建完成（不含向量数据库）")
+        # 原子切换CURRENT指针，Web服务在下次检查时切换到新版本
+        snapshots.publish(version)
+        print(f"知识库构建完成，版本 {version}，向量数据库共 {total} 个文本块")
+    
+    def rollback_knowledge_base(self):
+        """回滚到上一个发布的知识库版本"""
+        from knowledge_base.vector_db import VectorDatabase
+        VectorDatabase.snapshot_manager().rollback()
     
     def run_web_ui(self, host='0.0.0.0', port=5000, debug=False):
         """运行Web界面"""
@@ -58,6 +113,8 @@ class SilverGuardAI:
             self.run_crawler()
         elif mode == "build_kb":
             self.build_knowledge_base()
+        elif mode == "rollback_kb":
+            self.rollback_knowledge_base()
         elif mode == "web":
             host = kwargs.get('host', '0.0.0.0')
             port = kwargs.get('port', 5000)
@@ -73,7 +130,8 @@ class SilverGuardAI:
         print("Usage: python main.py [mode] [options]")
         print("\n模式:")
         print("  crawler     - 运行爬虫模块，采集医疗数据")
-        print("  build_kb    - 构建知识库，处理数据并入库")
+        print("  build_kb    - 构建知识库，处理数据并入库（发布为新版本，运行中的服务自动切换）")
+        print("  rollback_kb - 回滚到上一个知识库版本")
         print("  web         - 运行Web界面，提供健康咨询服务")
         print("\n选项:")
         print("  --host      - Web服务器主机地址 (默认: 0.0.0.0)")
@@ -82,12 +140,13 @@ class SilverGuardAI:
         print("\n示例:")
         print("  python main.py crawler")
         print("  python main.py build_kb")
+        print("  python main.py rollback_kb")
         print("  python main.py web --host 127.0.0.1 --port 8080 --debug")
 
 def main():
     """主函数"""
     parser = argparse.ArgumentParser(description="银龄康护助手 (SilverGuard AI) - 慢性病知识问答版")
-    parser.add_argument('mode', choices=['crawler', 'build_kb', 'web'], help='运行模式')
+    parser.add_argument('mode', choices=['crawler', 'build_kb', 'rollback_kb', 'web'], help='运行模式')
     parser.add_argument('--host', default='0.0.0.0', help='Web服务器主机地址')
     parser.add_argument('--port', type=int, default=5000, help='Web服务器端口')
     parser.add_argument('--debug', action='store_true', help='启用调试模式')
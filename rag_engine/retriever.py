@@ -1,145 +1,437 @@
 # 多路召回模块
 
 import os
+import sys
 import json
+import queue
+import threading
+from array import array
+from itertools import islice
 from rank_bm25 import BM25Okapi
 import jieba
-from knowledge_base.embedder import MedicalEmbedder
+from knowledge_base.model_registry import get_embedder
 from knowledge_base.vector_db import VectorDatabase
+from knowledge_base.chunk_store import DocumentTable
 from config.model_config import RAG_CONFIG, VECTOR_DB_CONFIG
 
+# BM25语料文件（与向量库一起保存在版本快照目录中）
+BM25_CORPUS_FILE = "bm25_corpus.json"
+
+class BM25Corpus:
+    """BM25语料和索引
+
+    语料元数据按列存储：文档ID数组 + 驻留的章节标题，文档级元数据在共享文档表中只存一份。
+    分词结果随语料一起保存，切换版本时不需要重新分词。
+    """
+
+    def __init__(self):
+        self.bm25 = None
+        self.corpus = []
+        self.documents = DocumentTable()
+        self.doc_ids = array('i')
+        self.sections = []
+        self.tokens = []
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def add_documents(self, documents):
+        """从处理后的文档构建语料并分词"""
+        for doc in documents:
+            if doc.get('content'):
+                doc_id = self.documents.add(doc)
+                for section in doc['content']:
+                    content = section.get('content', '')
+                    if content:
+                        self.corpus.append(content)
+                        self.doc_ids.append(doc_id)
+                        self.sections.append(sys.intern(section.get('section', '')))
+                        self.tokens.append(list(jieba.cut(content)))
+        return self
+
+    def build(self):
+        """构建BM25索引（构建后释放分词结果，需要保存时应在构建前调用save）"""
+        if self.corpus:
+            self.bm25 = BM25Okapi(self.tokens)
+            print(f"BM25索引构建完成，包含 {len(self.corpus)} 个文档")
+        self.tokens = []
+        return self
+
+    def get_metadata(self, idx):
+        """拼接语料条目的完整元数据（仅对返回的结果执行）"""
+        metadata = self.documents.get(self.doc_ids[idx])
+        metadata["section_title"] = self.sections[idx]
+        return metadata
+
+    def save(self, directory):
+        """保存语料和分词结果"""
+        path = os.path.join(directory, BM25_CORPUS_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "documents": self.documents.documents,
+                "doc_ids": list(self.doc_ids),
+                "sections": self.sections,
+                "corpus": self.corpus,
+                "tokens": self.tokens
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, directory):
+        """从版本目录加载语料并构建索引，文件不存在时返回None"""
+        path = os.path.join(directory, BM25_CORPUS_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        corpus = cls()
+        for entry in data["documents"]:
+            corpus.documents.add_metadata(entry["key"], entry)
+        corpus.doc_ids = array('i', data["doc_ids"])
+        corpus.sections = [sys.intern(section) for section in data["sections"]]
+        corpus.corpus = data["corpus"]
+        corpus.tokens = data["tokens"]
+        return corpus.build()
+
+    @classmethod
+    def from_processed_data(cls):
+        """从ETL输出的处理后数据构建（没有版本快照的旧布局）"""
+        from config.crawler_config import STORAGE_CONFIG
+        processed_path = os.path.join(STORAGE_CONFIG["DATA_STORE_PATH"], "processed", "medical_data.json")
+        if not os.path.exists(processed_path):
+            print("未找到处理后的数据，BM25索引构建失败")
+            return None
+        with open(processed_path, 'r', encoding='utf-8') as f:
+            documents = json.load(f)
+        return cls().add_documents(documents).build()
+
+class RetrievalSnapshot:
+    """一个知识库版本的检索数据（向量库 + BM25语料），加载后不再修改，切换版本时整体替换"""
+
+    def __init__(self, version=None, directory=None, load_bm25=True, embedding_dim=None):
+        # 嵌入维度与查询嵌入器不一致时集合拒绝打开
+        self.vector_db = VectorDatabase(persist_directory=directory, embedding_dim=embedding_dim)
+        self.version = version if directory is not None else self.vector_db.version
+        self.directory = self.vector_db.persist_directory
+        self.load_bm25 = load_bm25
+        self.corpus = None
+        if load_bm25:
+            try:
+                self.corpus = BM25Corpus.load(self.directory)
+                if self.corpus is None and self.version is None:
+                    self.corpus = BM25Corpus.from_processed_data()
+            except Exception as e:
+                print(f"Error building BM25 index: {e}")
+
+    def close(self):
+        """释放版本占用的资源（分片模式下停止该版本的分片进程）"""
+        self.vector_db.close()
+    
+    def check(self, embedder):
+        """确认嵌入器可以检索该版本（不修改共享的嵌入器），返回该版本的备用嵌入器（模型构建的版本为None）"""
+        if not self.vector_db.ready:
+            return None
+        return embedder.collection_fallback(self.vector_db.schema, self.directory)
+    
+    def bind(self, embedder):
+        """让嵌入器使用与该版本一致的向量空间（模型与备用嵌入器不能混用）"""
+        if self.vector_db.ready:
+            embedder.bind_collection(self.vector_db.schema, self.directory)
+    
+    def validate(self, probe_embedding=None):
+        """检查版本是否可以上线，返回问题描述（没有问题时返回None）"""
+        if not self.vector_db.ready:
+            return "向量库未就绪"
+        if self.vector_db.store.count() == 0:
+            return "向量库为空"
+        if self.load_bm25 and (self.corpus is None or self.corpus.bm25 is None):
+            return "缺少BM25语料"
+        if probe_embedding and not self.vector_db.store.query(probe_embedding, 1):
+            return "探测查询没有结果"
+        return None
+
 class MultiRetriever:
     def __init__(self):
         self.multi_retrieval_enabled = RAG_CONFIG["MULTI_RETRIEVAL"]["ENABLED"]
         self.weights = RAG_CONFIG["MULTI_RETRIEVAL"]["WEIGHTS"]
         self.top_k = VECTOR_DB_CONFIG["TOP_K"]
+        self.batch_config = RAG_CONFIG["BATCH_RETRIEVAL"]
+        self.snapshot_config = VECTOR_DB_CONFIG["SNAPSHOTS"]
         
-        # 初始化嵌入器
-        self.embedder = MedicalEmbedder()
+        # 初始化嵌入器（进程内共享）
+        self.embedder = get_embedder()
         
-        # 初始化向量数据库
-        self.vector_db = VectorDatabase()
+        # bge-m3模式：词法召回使用稀疏词权重倒排索引，与稠密向量来自同一次推理，不再构建BM25
+        self.sparse_enabled = self.embedder.sparse_enabled and self.embedder.model is not None
+        self.embedding_dim = self.embedder.embedding_dimension()
         
-        # 初始化BM25（需要构建索引）
-        self.bm25 = None
-        self.corpus = []
-        self.corpus_metadata = []
-        self.build_bm25_index()
+        # 当前版本的向量库和BM25语料；请求开始时取一次引用，切换版本不影响进行中的请求
+        self.snapshots = VectorDatabase.snapshot_manager()
+        self.snapshot = RetrievalSnapshot(load_bm25=not self.sparse_enabled, embedding_dim=self.embedding_dim)
+        self.snapshot.bind(self.embedder)
+        self.previous_snapshot = None
+        self.failed_version = None
+        self.swap_lock = threading.Lock()
+        
+        # 后台检查新发布的版本
+        self.stop_event = threading.Event()
+        self.watcher = None
+        if self.snapshot_config["WATCH_INTERVAL"] > 0:
+            self.watcher = threading.Thread(target=self.watch, name="snapshot-watcher", daemon=True)
+            self.watcher.start()
     
-    def build_bm25_index(self):
-        """构建BM25索引"""
-        try:
-            # 从向量数据库获取所有文档
-            # 注意：这是一个简化实现，实际应用中可能需要更高效的方式
-            # 这里我们假设已经有一个文档集合
-            
-            # 临时实现：从处理后的数据中加载
-            from config.crawler_config import STORAGE_CONFIG
-            processed_path = os.path.join(STORAGE_CONFIG["DATA_STORE_PATH"], "processed", "medical_data.json")
+    @property
+    def vector_db(self):
+        """当前版本的向量数据库"""
+        return self.snapshot.vector_db
+    
+    @property
+    def version(self):
+        """当前服务的知识库版本（旧的单目录布局为None）"""
+        return self.snapshot.version
+    
+    def watch(self):
+        """定期读取CURRENT指针，发现新版本时在后台加载并切换"""
+        while not self.stop_event.wait(self.snapshot_config["WATCH_INTERVAL"]):
+            try:
+                self.check_for_update()
+            except Exception as e:
+                print(f"Error checking knowledge base version: {e}")
+    
+    def check_for_update(self):
+        """CURRENT指向的版本与当前不同时切换，返回是否发生了切换"""
+        version = self.snapshots.current()
+        if version is None or version == self.snapshot.version or version == self.failed_version:
+            return False
+        return self.swap_to(version)
+    
+    def swap_to(self, version):
+        """加载并验证指定版本，通过后原子替换当前版本；失败时继续使用原版本"""
+        with self.swap_lock:
+            current = self.snapshot
+            print(f"加载知识库版本 {version}（当前 {current.version}）")
+            candidate = None
+            try:
+                candidate = RetrievalSnapshot(version, self.snapshots.path(version), load_bm25=not self.sparse_enabled,
+                                              embedding_dim=self.embedding_dim)
+                # 验证通过之前不修改共享的嵌入器：探测查询用候选版本自己的备用嵌入器（IDF统计）嵌入
+                fallback = candidate.check(self.embedder)
+                probe_query = self.snapshot_config["PROBE_QUERY"]
+                if fallback is not None:
+                    probe_embedding = fallback.embed([probe_query])[0].tolist()
+                else:
+                    probe_embedding = self.embedder.embed_query(probe_query)
+                problem = candidate.validate(probe_embedding)
+                if problem:
+                    raise RuntimeError(problem)
+            except Exception as e:
+                print(f"知识库版本 {version} 未通过检查，继续使用版本 {current.version}: {e}")
+                self.failed_version = version
+                if candidate is not None:
+                    candidate.close()
+                return False
             
-            if os.path.exists(processed_path):
-                with open(processed_path, 'r', encoding='utf-8') as f:
-                    documents = json.load(f)
-                
-                # 构建语料库
-                for doc in documents:
-                    if doc.get('content'):
-                        for section in doc['content']:
-                            content = section.get('content', '')
-                            if content:
-                                self.corpus.append(content)
-                                self.corpus_metadata.append({
-                                    "document_title": doc['metadata'].get('title', ''),
-                                    "section_title": section.get('section', ''),
-                                    "source": doc['source'],
-                                    "source_organization": doc['metadata'].get('source_organization', ''),
-                                    "publication_date": doc['metadata'].get('publication_date', ''),
-                                    "authors": doc['metadata'].get('authors', [])
-                                })
-                
-                # 分词
-                tokenized_corpus = [list(jieba.cut(doc)) for doc in self.corpus]
-                
-                # 构建BM25
-                self.bm25 = BM25Okapi(tokenized_corpus)
-                print(f"BM25索引构建完成，包含 {len(self.corpus)} 个文档")
-            else:
-                print("未找到处理后的数据，BM25索引构建失败")
-        except Exception as e:
-            print(f"Error building BM25 index: {e}")
+            # 只保留上一个版本用于回滚，更早的版本释放资源
+            if self.previous_snapshot is not None:
+                self.previous_snapshot.close()
+            self.previous_snapshot = current
+            candidate.bind(self.embedder)
+            self.snapshot = candidate
+            self.failed_version = None
+            print(f"已切换到知识库版本 {version}")
+            return True
+    
+    def rollback(self):
+        """切回上一个已加载的版本（只影响本进程；全局回滚使用 SnapshotManager.rollback）"""
+        with self.swap_lock:
+            if self.previous_snapshot is None:
+                return False
+            self.snapshot, self.previous_snapshot = self.previous_snapshot, self.snapshot
+            self.snapshot.bind(self.embedder)
+            # 不再自动切回被回滚的版本，直到CURRENT指向其他版本
+            self.failed_version = self.previous_snapshot.version
+            print(f"已回滚到知识库版本 {self.snapshot.version}")
+            return True
+    
+    def close(self):
+        """停止版本检查线程"""
+        self.stop_event.set()
     
-    def retrieve(self, query):
-        """多路召回"""
+    def retrieve(self, query, filters=None):
+        """多路召回；filters为元数据过滤条件（见 VectorDatabase.query），默认使用配置中的条件"""
         results = []
+        # 整个请求使用同一个版本
+        snapshot = self.snapshot
         
         if self.multi_retrieval_enabled:
-            # 向量搜索
-            vector_results = self.vector_search(query)
-            
-            # BM25搜索
-            bm25_results = self.bm25_search(query)
+            if self.sparse_enabled:
+                # 一次推理得到稠密向量和稀疏词权重
+                query_output = self.embedder.embed_query(query, return_sparse=True) or {}
+                vector_results = self.vector_search(query, query_output.get("dense"), filters=filters, snapshot=snapshot)
+                lexical_results = self.sparse_search(query_output.get("sparse"), filters=filters, snapshot=snapshot)
+            else:
+                # 向量搜索
+                vector_results = self.vector_search(query, filters=filters, snapshot=snapshot)
+                
+                # BM25搜索
+                lexical_results = self.bm25_search(query, filters=filters, snapshot=snapshot)
             
             # 融合结果
-            results = self.fuse_results(vector_results, bm25_results)
+            results = self.fuse_results(vector_results, lexical_results)
         else:
             # 仅使用向量搜索
-            results = self.vector_search(query)
+            results = self.vector_search(query, filters=filters, snapshot=snapshot)
         
         return results
     
-    def vector_search(self, query):
-        """向量搜索"""
+    def retrieve_many(self, queries, filters=None, batch_size=None):
+        """批量多路召回（离线评估、缓存预热），返回与输入顺序一致的结果列表"""
+        return [results for _, results in self.retrieve_stream(queries, filters=filters, batch_size=batch_size)]
+    
+    def retrieve_stream(self, queries, filters=None, batch_size=None):
+        """流式批量多路召回，按输入顺序逐个产出 (查询, 结果)
+
+        queries可以是任意可迭代对象（如逐行读取的评估集）。后台线程按批嵌入查询，
+        主线程同时对上一批做一次批量向量检索和逐条词法检索，内存中最多保留 QUEUE_SIZE 批。
+        """
+        batch_size = batch_size or self.batch_config["BATCH_SIZE"]
+        batches = queue.Queue(maxsize=self.batch_config["QUEUE_SIZE"])
+        stop = threading.Event()
+        
+        def produce():
+            try:
+                iterator = iter(queries)
+                while not stop.is_set():
+                    batch = list(islice(iterator, batch_size))
+                    if not batch:
+                        break
+                    batches.put((batch, self.embedder.embed_queries(batch, return_sparse=self.sparse_enabled)))
+            except Exception as e:
+                batches.put(e)
+            finally:
+                batches.put(None)
+        
+        producer = threading.Thread(target=produce, name="retrieve-embedder", daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    print(f"Error embedding queries: {item}")
+                    continue
+                batch, outputs = item
+                yield from self.search_batch(batch, outputs, filters)
+        finally:
+            # 调用方提前停止迭代时，让后台线程尽快退出
+            stop.set()
+            while producer.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+    
+    def search_batch(self, batch, outputs, filters=None):
+        """对一批已嵌入的查询做多路召回，逐个产出 (查询, 结果)"""
+        snapshot = self.snapshot
+        if self.sparse_enabled:
+            dense = [output["dense"] if output else None for output in outputs]
+            sparse = [output["sparse"] if output else None for output in outputs]
+        else:
+            dense = outputs
+            sparse = [None] * len(outputs)
+        
+        # 一次批量向量检索
+        vector_batch = snapshot.vector_db.query_many(dense, top_k=self.top_k, filters=filters)
+        for query, query_weights, results in zip(batch, sparse, vector_batch):
+            vector_results = self.format_vector_results(results)
+            if not self.multi_retrieval_enabled:
+                yield query, vector_results
+                continue
+            if self.sparse_enabled:
+                lexical_results = self.sparse_search(query_weights, filters=filters, snapshot=snapshot)
+            else:
+                lexical_results = self.bm25_search(query, filters=filters, snapshot=snapshot)
+            yield query, self.fuse_results(vector_results, lexical_results)
+    
+    def vector_search(self, query, query_embedding=None, filters=None, snapshot=None):
+        """向量搜索（可以传入已经计算好的查询向量）"""
+        snapshot = snapshot or self.snapshot
         try:
             # 嵌入查询
-            query_embedding = self.embedder.embed_query(query)
+            if query_embedding is None:
+                query_embedding = self.embedder.embed_query(query)
             if not query_embedding:
                 return []
             
             # 查询向量数据库
-            results = self.vector_db.query(query_embedding, top_k=self.top_k)
-            
-            # 格式化结果
-            formatted_results = []
-            for result in results:
-                formatted_results.append({
-                    "id": result["id"],
-                    "content": result["content"],
-                    "score": 1 - result["score"],  # 转换为相似度
-                    "metadata": result["metadata"],
-                    "type": "vector"
-                })
-            
-            return formatted_results
+            results = snapshot.vector_db.query(query_embedding, top_k=self.top_k, filters=filters)
+            return self.format_vector_results(results)
         except Exception as e:
             print(f"Error in vector search: {e}")
             return []
     
-    def bm25_search(self, query):
+    def format_vector_results(self, results):
+        """格式化向量检索结果"""
+        formatted_results = []
+        for result in results:
+            formatted_results.append({
+                "id": result["id"],
+                "content": result["content"],
+                "score": result["score"],  # 余弦相似度（VectorDatabase 已按集合的度量换算）
+                "distance": result["distance"],
+                "metadata": result["metadata"],
+                "type": "vector"
+            })
+        return formatted_results
+    
+    def sparse_search(self, query_weights, filters=None, snapshot=None):
+        """稀疏词权重搜索（bge-m3 lexical weights，替代BM25）"""
+        snapshot = snapshot or self.snapshot
+        try:
+            results = snapshot.vector_db.sparse_query(query_weights, top_k=self.top_k, filters=filters)
+            return [{**result, "type": "sparse"} for result in results]
+        except Exception as e:
+            print(f"Error in sparse search: {e}")
+            return []
+    
+    def bm25_search(self, query, filters=None, snapshot=None):
         """BM25搜索"""
+        snapshot = snapshot or self.snapshot
+        corpus = snapshot.corpus
         try:
-            if not self.bm25 or not self.corpus:
+            if corpus is None or corpus.bm25 is None or not len(corpus):
                 return []
             
             # 分词
             tokenized_query = list(jieba.cut(query))
             
             # 搜索
-            scores = self.bm25.get_scores(tokenized_query)
+            scores = corpus.bm25.get_scores(tokenized_query)
+            
+            if filters is None:
+                filters = snapshot.vector_db.metadata_filters
             
-            # 获取top_k结果
-            top_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:self.top_k]
+            # 按得分从高到低取满top_k个满足过滤条件的结果
+            top_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
             
             # 格式化结果
             formatted_results = []
             for idx in top_indices:
-                if scores[idx] > 0:
-                    formatted_results.append({
-                        "id": f"bm25_{idx}",
-                        "content": self.corpus[idx],
-                        "score": scores[idx],
-                        "metadata": self.corpus_metadata[idx],
-                        "type": "bm25"
-                    })
+                if scores[idx] <= 0 or len(formatted_results) >= self.top_k:
+                    break
+                metadata = corpus.get_metadata(idx)
+                if not snapshot.vector_db.matches_filters(corpus.corpus[idx], metadata, filters):
+                    continue
+                formatted_results.append({
+                    "id": f"bm25_{idx}",
+                    "content": corpus.corpus[idx],
+                    "score": scores[idx],
+                    "metadata": metadata,
+                    "type": "bm25"
+                })
             
             return formatted_results
         except Exception as e:
@@ -147,7 +439,7 @@ class MultiRetriever:
             return []
     
     def fuse_results(self, vector_results, bm25_results):
-        """融合搜索结果"""
+        """融合搜索结果（词法召回为BM25或稀疏词权重结果，权重使用bm25项）"""
         # 结果融合
         fused_results = {}
         
@@ -0,0 +1,6 @@
+# pytest配置：从仓库根目录导入项目模块
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
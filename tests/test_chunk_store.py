@@ -0,0 +1,41 @@
+# 紧凑文本块和共享文档表
+
+from knowledge_base.chunk_store import Chunk, DocumentTable
+
+def make_chunk():
+    table = DocumentTable()
+    doc_id = table.add({"source": "WHO", "filename": "guide.pdf",
+                        "metadata": {"title": "高血压指南", "authors": ["WHO"], "publication_date": "2023"}})
+    return Chunk("c1", "低盐饮食。", doc_id, table, section_title="饮食", chunk_index=0)
+
+def test_metadata_item_assignment_writes_back():
+    chunk = make_chunk()
+    chunk["metadata"]["sources"] = ["WHO", "CDC"]
+    chunk["metadata"]["section_title"] = "治疗"
+    chunk["metadata"].update({"duplicate_ids": ["c2"]})
+
+    metadata = chunk["metadata"]
+    assert metadata["sources"] == ["WHO", "CDC"]
+    assert metadata["duplicate_ids"] == ["c2"]
+    assert chunk.section_title == "治疗"
+    assert chunk.compact_metadata()["sources"] == ["WHO", "CDC"]
+    # 文档级字段仍然只存储在共享文档表中
+    assert chunk.extra == {"sources": ["WHO", "CDC"], "duplicate_ids": ["c2"]}
+
+    del chunk["metadata"]["sources"]
+    assert "sources" not in chunk["metadata"]
+
+def test_document_fields_cannot_be_deleted():
+    chunk = make_chunk()
+    metadata = chunk["metadata"]
+    del metadata["document_title"]
+    assert metadata["document_title"] == "高血压指南"
+    assert chunk["metadata"]["document_title"] == "高血压指南"
+
+def test_document_table_round_trip(tmp_path):
+    chunk = make_chunk()
+    path = str(tmp_path / "documents.json")
+    chunk.table.save(path)
+    table = DocumentTable.load(path)
+    assert table.get(chunk.doc_id) == chunk.table.get(chunk.doc_id)
+    assert table.add({"source": "WHO", "filename": "guide.pdf"}) == chunk.doc_id
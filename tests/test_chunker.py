@@ -0,0 +1,80 @@
+# 文本分块器
+
+import pytest
+from config.model_config import EMBEDDING_CONFIG
+from knowledge_base.chunker import MedicalChunker
+from knowledge_base.token_counter import TokenCounter
+
+class CharTokenizer:
+    """每个字符一个token的分词器"""
+
+    def __call__(self, texts, add_special_tokens=False, return_offsets_mapping=False, **kwargs):
+        if isinstance(texts, str):
+            encoded = {"input_ids": list(range(len(texts)))}
+            if return_offsets_mapping:
+                encoded["offset_mapping"] = [(i, i + 1) for i in range(len(texts))]
+            return encoded
+        return {"input_ids": [list(range(len(text))) for text in texts]}
+
+def make_document(content):
+    return {
+        "source": "WHO",
+        "filename": "guide.pdf",
+        "metadata": {"title": "指南"},
+        "content": [{"section": "注意事项", "content": content}],
+        "tables": []
+    }
+
+@pytest.fixture
+def chunker(monkeypatch):
+    monkeypatch.setitem(EMBEDDING_CONFIG, "CHUNKING", {**EMBEDDING_CONFIG["CHUNKING"], "MODE": "token"})
+    chunker = MedicalChunker(token_counter=TokenCounter(tokenizer=CharTokenizer()))
+    chunker.target_tokens = 40
+    chunker.overlap_tokens = 0
+    return chunker
+
+def test_short_semantic_units_are_packed(chunker):
+    units = [f"{i}、第{i}条注意事项，按时服药。" for i in range(1, 10)]
+    chunks = chunker.chunk_document(make_document("\n\n".join(units)))
+
+    assert len(chunks) < len(units)
+    assert all(len(chunk.content) <= chunker.target_tokens for chunk in chunks)
+    # 每个语义单元完整地出现在一个块中，顺序不变
+    assert "\n".join(chunk.content for chunk in chunks) == "\n".join(units)
+
+def test_long_unit_is_still_split_by_tokens(chunker):
+    long_unit = "1、" + "长期高血压会损害心脑肾等靶器官。" * 6
+    chunks = chunker.chunk_document(make_document(f"{long_unit}\n\n2、定期复查。"))
+
+    assert len(chunks) >= 3
+    assert all(len(chunk.content) <= chunker.target_tokens for chunk in chunks)
+    assert chunks[-1].content.endswith("2、定期复查。")
+
+def test_chunk_ids_are_deterministic(chunker):
+    content = "\n\n".join(f"{i}、第{i}条。" for i in range(1, 6))
+    first = [chunk.id for chunk in chunker.chunk_document(make_document(content))]
+    second = [chunk.id for chunk in chunker.chunk_document(make_document(content))]
+    assert first == second
+    assert len(set(first)) == len(first)
+
+def test_missing_tokenizer_fails_loudly(monkeypatch):
+    def broken(self):
+        raise OSError("tokenizer not found")
+    monkeypatch.setattr(TokenCounter, "load_tokenizer", broken)
+    monkeypatch.setitem(EMBEDDING_CONFIG, "CHUNKING", {**EMBEDDING_CONFIG["CHUNKING"], "MODE": "token"})
+    with pytest.raises(RuntimeError):
+        MedicalChunker()
+
+    monkeypatch.setitem(EMBEDDING_CONFIG, "CHUNKING",
+                        {**EMBEDDING_CONFIG["CHUNKING"], "MODE": "token", "ALLOW_CHAR_FALLBACK": True})
+    assert MedicalChunker().mode == "char"
+
+def test_explicit_char_mode_needs_no_tokenizer(monkeypatch):
+    def broken(self):
+        raise OSError("tokenizer not found")
+    monkeypatch.setattr(TokenCounter, "load_tokenizer", broken)
+    monkeypatch.setitem(EMBEDDING_CONFIG, "CHUNKING", {**EMBEDDING_CONFIG["CHUNKING"], "MODE": "token"})
+    # 离线构建（备用嵌入器）和分块基准显式使用字符模式
+    chunker = MedicalChunker(mode="char")
+    assert chunker.mode == "char"
+    assert chunker.chunk_document(make_document("1、按时服药。\n\n2、定期复查。"))
@@ -0,0 +1,33 @@
+# 文本块去重
+
+from knowledge_base.dedup import ChunkDeduplicator
+
+def make_chunks(contents):
+    return [{"id": str(i), "content": content, "metadata": {"source": f"来源{i}"}}
+            for i, content in enumerate(contents)]
+
+def test_exact_and_near_duplicates_are_merged():
+    deduplicator = ChunkDeduplicator()
+    chunks = make_chunks([
+        "高血压患者应定期监测血压，并记录每日的测量结果，就诊时带给医生参考。",
+        "高血压患者应定期监测血压，并记录每日的测量结果，就诊时带给医生参考。",
+        "高血压患者应定期监测血压，并记录每日的测量结果，就诊时带给医生参考！",
+        "糖尿病患者需要控制碳水化合物的摄入量，并按医嘱使用降糖药物。"
+    ])
+    result = deduplicator.deduplicate(chunks)
+    assert [chunk["id"] for chunk in result] == ["0", "3"]
+    assert result[0]["metadata"]["duplicate_ids"] == ["1", "2"]
+    assert result[0]["metadata"]["sources"] == ["来源0", "来源1", "来源2"]
+
+def test_near_duplicates_after_first_bucket_member_are_compared():
+    deduplicator = ChunkDeduplicator()
+    # 一个band、0行：所有块落入同一个桶，桶中第一个块与其他块都不相似
+    deduplicator.bands, deduplicator.rows = 1, 0
+    chunks = make_chunks([
+        "糖尿病患者需要控制碳水化合物的摄入量，并按医嘱使用降糖药物。",
+        "老年人跌倒后不要急于起身，先检查是否有疼痛或无法活动的部位。",
+        "老年人跌倒后不要急于起身，先检查是否有疼痛或无法活动的部位！"
+    ])
+    result = deduplicator.deduplicate(chunks)
+    assert [chunk["id"] for chunk in result] == ["0", "1"]
+    assert result[1]["metadata"]["duplicate_ids"] == ["2"]
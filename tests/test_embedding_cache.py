@@ -0,0 +1,95 @@
+# 持久化嵌入缓存
+
+import numpy as np
+from knowledge_base.embedding_cache import EmbeddingCache
+
+def vector(value, dim=4):
+    return np.full(dim, value, dtype=np.float32)
+
+def make_cache(tmp_path, max_entries=3):
+    return EmbeddingCache(str(tmp_path), fingerprint="model|v1", dim=4, max_entries=max_entries)
+
+def test_round_trip_survives_reopen(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put_many(["高血压", "糖尿病"], [vector(1), vector(2)])
+    cache.close()
+
+    cache = make_cache(tmp_path)
+    try:
+        hits = cache.get_many(["糖尿病", "冠心病", "高血压"])
+        np.testing.assert_array_equal(hits[0], vector(2))
+        assert hits[1] is None
+        np.testing.assert_array_equal(hits[2], vector(1))
+        # 空白和全角字符规范化后命中同一个键
+        np.testing.assert_array_equal(cache.get_many(["  糖尿病 "])[0], vector(2))
+    finally:
+        cache.close()
+
+def test_eviction_never_takes_a_key_written_in_the_same_batch(tmp_path):
+    cache = make_cache(tmp_path)
+    try:
+        cache.put_many(["a", "b", "c"], [vector(1), vector(2), vector(3)])
+        # a是最久未访问的条目，同时又在本批中被覆盖写入
+        cache.put_many(["a", "d", "e"], [vector(10), vector(4), vector(5)])
+
+        hits = cache.get_many(["a", "b", "c", "d", "e"])
+        np.testing.assert_array_equal(hits[0], vector(10))
+        assert hits[1] is None and hits[2] is None
+        np.testing.assert_array_equal(hits[3], vector(4))
+        np.testing.assert_array_equal(hits[4], vector(5))
+        slots = cache.conn.execute("SELECT slot FROM entries").fetchall()
+        assert len(slots) == len(set(slots)) == 3
+    finally:
+        cache.close()
+
+def test_lru_entry_is_evicted_when_full(tmp_path):
+    cache = make_cache(tmp_path)
+    try:
+        cache.put_many(["a", "b", "c"], [vector(1), vector(2), vector(3)])
+        cache.get_many(["a"])
+        cache.put_many(["d"], [vector(4)])
+        hits = cache.get_many(["a", "b", "d"])
+        assert hits[0] is not None and hits[1] is None and hits[2] is not None
+        assert cache.size() == 3
+    finally:
+        cache.close()
+
+def test_fingerprints_are_isolated(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put_many(["高血压"], [vector(1)])
+    cache.close()
+
+    other = EmbeddingCache(str(tmp_path), fingerprint="model|v2", dim=4, max_entries=3)
+    try:
+        assert other.get_many(["高血压"]) == [None]
+        assert other.directory != cache.directory
+    finally:
+        other.close()
+
+def test_shrinking_capacity_drops_entries_beyond_it(tmp_path):
+    cache = make_cache(tmp_path, max_entries=4)
+    cache.put_many(["a", "b", "c", "d"], [vector(1), vector(2), vector(3), vector(4)])
+    cache.close()
+
+    cache = make_cache(tmp_path, max_entries=2)
+    try:
+        assert cache.size() == 2
+        assert sum(hit is not None for hit in cache.get_many(["a", "b", "c", "d"])) == 2
+        # 剩余槽位仍在容量内，可以继续写入和淘汰
+        cache.put_many(["e", "f"], [vector(5), vector(6)])
+        assert cache.size() == 2
+        np.testing.assert_array_equal(cache.get_many(["f"])[0], vector(6))
+        stats = cache.stats()
+        assert stats["entries"] == 2 and stats["hits"] == 3 and stats["misses"] == 2
+    finally:
+        cache.close()
+
+def test_batch_larger_than_capacity_keeps_what_fits(tmp_path):
+    cache = make_cache(tmp_path, max_entries=2)
+    try:
+        cache.put_many(["a", "b", "c", "a"], [vector(1), vector(2), vector(3), vector(4)])
+        assert cache.size() == 2
+        slots = cache.conn.execute("SELECT slot FROM entries").fetchall()
+        assert len(set(slots)) == 2
+    finally:
+        cache.close()
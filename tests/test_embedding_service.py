@@ -0,0 +1,97 @@
+# 在线查询嵌入的微批处理
+
+import threading
+from concurrent.futures import wait
+import pytest
+from knowledge_base.embedding_service import EmbeddingBatcher, EmbeddingOverloadError
+
+def test_requests_are_batched():
+    batches = []
+    def encode(texts):
+        batches.append(list(texts))
+        return [len(text) for text in texts]
+
+    batcher = EmbeddingBatcher(encode, max_batch_size=8, max_wait_ms=50)
+    try:
+        futures = [batcher.submit("x" * i) for i in range(1, 6)]
+        assert [future.result(timeout=5) for future in futures] == [1, 2, 3, 4, 5]
+    finally:
+        batcher.close()
+    assert sum(len(batch) for batch in batches) == 5
+
+def test_full_queue_fails_fast_with_overload_error():
+    release = threading.Event()
+    def encode(texts):
+        release.wait()
+        return texts
+
+    batcher = EmbeddingBatcher(encode, max_batch_size=1, max_wait_ms=0, max_queue_size=1)
+    try:
+        futures = [batcher.submit(str(i)) for i in range(5)]
+        overloaded = [future for future in futures if future.done() and future.exception() is not None]
+        assert overloaded
+        with pytest.raises(EmbeddingOverloadError):
+            overloaded[0].result()
+        assert batcher.stats()["rejected"] == len(overloaded)
+    finally:
+        release.set()
+        batcher.close()
+
+def test_close_never_strands_submitted_requests():
+    batcher = EmbeddingBatcher(lambda texts: texts, max_batch_size=4, max_wait_ms=1, max_queue_size=10000)
+    futures = []
+    futures_lock = threading.Lock()
+    start = threading.Event()
+
+    def client():
+        start.wait()
+        for i in range(200):
+            future = batcher.submit(str(i))
+            with futures_lock:
+                futures.append(future)
+
+    threads = [threading.Thread(target=client) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    batcher.close()
+    for thread in threads:
+        thread.join()
+
+    # 每个请求要么得到结果，要么以“已关闭”失败，不会一直等待
+    done, not_done = wait(futures, timeout=5)
+    assert not not_done
+
+def test_close_does_not_hang_on_a_full_queue():
+    release = threading.Event()
+    def encode(texts):
+        release.wait()
+        return texts
+
+    batcher = EmbeddingBatcher(encode, max_batch_size=1, max_wait_ms=0, max_queue_size=2)
+    futures = [batcher.submit(str(i)) for i in range(4)]
+    assert batcher.queue.full()
+    # 推理卡住、队列已满时close仍然返回（只等待后台线程有限的时间）
+    closer = threading.Thread(target=batcher.close)
+    closer.start()
+    closer.join(timeout=10)
+    try:
+        assert not closer.is_alive()
+    finally:
+        release.set()
+    batcher.thread.join(timeout=5)
+    assert not batcher.thread.is_alive()
+    done, not_done = wait(futures, timeout=5)
+    assert not not_done
+
+def test_short_encoder_output_fails_every_request():
+    batcher = EmbeddingBatcher(lambda texts: texts[:-1], max_batch_size=4, max_wait_ms=50)
+    try:
+        futures = [batcher.submit(str(i)) for i in range(3)]
+        done, not_done = wait(futures, timeout=5)
+        assert not not_done
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result()
+    finally:
+        batcher.close()
@@ -0,0 +1,116 @@
+# FAISS后端：与暴力余弦检索一致、训练退化、候选行位图、墓碑清理和落盘重开
+
+import numpy as np
+import pytest
+from knowledge_base.metrics import normalize_embeddings
+
+faiss = pytest.importorskip("faiss")
+from knowledge_base.faiss_store import FaissStore
+
+DIM = 32
+SOURCES = ["WHO", "CDC", "NHC"]
+
+def make_rows(n, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = normalize_embeddings(rng.standard_normal((n, DIM)))
+    ids = [f"c{i}" for i in range(n)]
+    documents = [f"文本块{i}" for i in range(n)]
+    metadatas = [{"source": SOURCES[i % len(SOURCES)], "chunk_type": "text"} for i in range(n)]
+    return ids, vectors, documents, metadatas
+
+def brute_force(vectors, query, top_k, allowed=None):
+    """暴力余弦检索，返回 [(行号, 余弦距离)]"""
+    scores = vectors @ query
+    if allowed is not None:
+        scores = np.where(allowed, scores, -np.inf)
+    order = np.argsort(-scores)[:top_k]
+    return [(int(row), 1.0 - float(scores[row])) for row in order if np.isfinite(scores[row])]
+
+def make_store(tmp_path, index_type="flat", read_only=False, **config):
+    return FaissStore(str(tmp_path), "kb", DIM, read_only=read_only, config={"INDEX_TYPE": index_type, **config})
+
+def filled_store(tmp_path, n=300, index_type="flat", **config):
+    ids, vectors, documents, metadatas = make_rows(n)
+    store = make_store(tmp_path, index_type, **config)
+    store.create()
+    store.write(ids, vectors, documents, metadatas)
+    store.flush()
+    return store, (ids, vectors, documents, metadatas)
+
+def assert_matches(hits, expected, ids):
+    assert [hit[0] for hit in hits] == [ids[row] for row, _ in expected]
+    np.testing.assert_allclose([hit[1] for hit in hits], [distance for _, distance in expected], atol=1e-5)
+
+def test_flat_matches_brute_force(tmp_path):
+    store, (ids, vectors, _, _) = filled_store(tmp_path)
+    queries = normalize_embeddings(np.random.default_rng(1).standard_normal((5, DIM)))
+    for query, hits in zip(queries, store.query_many(queries, 10)):
+        assert_matches(hits, brute_force(vectors, query, 10), ids)
+
+@pytest.mark.parametrize("exact_rows", [4096, 0])
+def test_filter_and_tombstones_use_candidate_bitmap(tmp_path, exact_rows):
+    # exact_rows为0时强制走FAISS的IDSelectorBitmap，否则直接精确打分
+    store, (ids, vectors, _, metadatas) = filled_store(tmp_path, EXACT_FILTER_ROWS=exact_rows)
+    store.delete(["c0", "c3", "c6"])
+    allowed = np.array([metadata["source"] == "WHO" for metadata in metadatas])
+    allowed[[0, 3, 6]] = False
+
+    query = vectors[9]
+    hits = store.query(query, 10, where={"source": "WHO"})
+    assert_matches(hits, brute_force(vectors, query, 10, allowed), ids)
+    assert all(hit[3]["source"] == "WHO" for hit in hits)
+
+def test_hnsw_finds_nearest_neighbours(tmp_path):
+    store, (ids, vectors, _, _) = filled_store(tmp_path, index_type="hnsw")
+    hits = store.query_many(vectors[:20], 1)
+    assert [result[0][0] for result in hits] == ids[:20]
+
+def test_ivfpq_with_too_few_points_falls_back_to_flat(tmp_path):
+    store, (ids, vectors, _, _) = filled_store(tmp_path, index_type="ivfpq", IVF_NLIST=16, PQ_M=8, PQ_NBITS=8,
+                                               TRAIN_SIZE=100)
+    assert isinstance(store.index, faiss.IndexIDMap2)
+    query = vectors[5]
+    assert_matches(store.query(query, 5), brute_force(vectors, query, 5), ids)
+
+def test_ivfpq_reduces_nlist_to_the_training_sample(tmp_path):
+    store, (ids, vectors, _, _) = filled_store(tmp_path, n=1000, index_type="ivfpq", IVF_NLIST=64, PQ_M=8,
+                                               PQ_NBITS=4, IVF_NPROBE=64, TRAIN_SIZE=100)
+    # 39×2^4=624 个样本足以训练PQ，但不足以支撑 39×64 个样本的聚类数
+    assert store.index.is_trained
+    assert store.index.nlist == 1000 // 39
+    assert store.index.ntotal == 1000
+    hits = store.query_many(vectors[:20], 5)
+    assert sum(result[0][0] == ids[i] for i, result in enumerate(hits)) >= 18
+
+def test_compact_removes_tombstones_and_survives_reopen(tmp_path):
+    store, (ids, vectors, _, _) = filled_store(tmp_path)
+    store.delete(ids[:100])
+    store.write(["c150"], [vectors[0]], ["覆盖后的正文"], [{"source": "WHO"}], upsert=True)
+    assert store.tombstone_ratio() > 0
+    assert store.compact() == 101
+    assert store.tombstone_ratio() == 0
+    assert store.index.ntotal == 200
+    assert store.count() == 200
+    store.flush()
+    store.rows.close()
+
+    reopened = make_store(tmp_path, read_only=True)
+    reopened.open()
+    assert reopened.count() == 200
+    hits = reopened.query(vectors[0], 3)
+    assert hits[0][0] == "c150" and hits[0][2] == "覆盖后的正文"
+    assert all(hit[0] not in ids[:100] for hit in reopened.query_many(vectors[:100], 5)[0])
+    reopened.rows.close()
+
+def test_save_and_reopen_returns_same_results(tmp_path):
+    store, (ids, vectors, _, _) = filled_store(tmp_path)
+    queries = vectors[:5]
+    before = store.query_many(queries, 8, where={"source": {"$in": ["CDC", "NHC"]}})
+    store.rows.close()
+
+    reopened = make_store(tmp_path, read_only=True)
+    reopened.open()
+    after = reopened.query_many(queries, 8, where={"source": {"$in": ["CDC", "NHC"]}})
+    assert before == after
+    assert reopened.get(["c1"]) == {"c1": ("文本块1", {"source": "CDC", "chunk_type": "text"})}
+    reopened.rows.close()
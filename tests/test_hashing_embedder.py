@@ -0,0 +1,55 @@
+# 离线特征哈希嵌入器：归一化输出、IDF拟合与持久化、检索相关性
+
+import numpy as np
+from knowledge_base.hashing_embedder import HashingEmbedder
+
+CORPUS = [
+    "糖尿病的典型症状是多饮、多尿、多食和体重下降。",
+    "高血压患者需要长期规律服用降压药并监测血压。",
+    "骨质疏松的预防需要补充钙和维生素D，多晒太阳。",
+    "冠心病患者出现胸痛时应立即舌下含服硝酸甘油。",
+    "流感疫苗每年接种一次，老年人和儿童优先。",
+]
+QUERIES = ["糖尿病有哪些症状", "高血压要一直吃降压药吗", "怎样预防骨质疏松", "冠心病胸痛怎么办", "流感疫苗多久接种一次"]
+
+def test_embeddings_are_normalized_and_deterministic():
+    embedder = HashingEmbedder(dim=256).fit(CORPUS, save=False)
+    embeddings = embedder.embed(CORPUS + [""])
+    assert embeddings.dtype == np.float32 and embeddings.shape == (6, 256)
+    np.testing.assert_allclose(np.linalg.norm(embeddings[:5], axis=1), 1.0, rtol=1e-5)
+    # 没有特征的文本为零向量
+    assert not embeddings[5].any()
+    assert embedder.embed([]).shape == (0, 256)
+    # 特征哈希跨进程稳定（不使用带随机盐的 hash()）
+    other = HashingEmbedder(dim=256).fit(CORPUS, save=False)
+    np.testing.assert_array_equal(other.embed(CORPUS), embeddings[:5])
+
+def test_queries_rank_their_own_document_first():
+    embedder = HashingEmbedder(dim=1024).fit(CORPUS, save=False)
+    scores = embedder.embed(QUERIES) @ embedder.embed(CORPUS).T
+    assert list(scores.argmax(axis=1)) == list(range(len(QUERIES)))
+
+def test_fit_replaces_previous_statistics():
+    embedder = HashingEmbedder(dim=256).fit(CORPUS, save=False)
+    embedder.fit(CORPUS[:2], save=False)
+    fresh = HashingEmbedder(dim=256).fit(CORPUS[:2], save=False)
+    assert embedder.doc_count == 2
+    np.testing.assert_array_equal(embedder.doc_freq, fresh.doc_freq)
+    # 分块计数与一次计数结果相同
+    blocked = HashingEmbedder(dim=256).fit(CORPUS, save=False, block_size=2)
+    whole = HashingEmbedder(dim=256).fit(CORPUS, save=False)
+    np.testing.assert_array_equal(blocked.doc_freq, whole.doc_freq)
+
+def test_idf_round_trip_through_idf_path(tmp_path):
+    path = str(tmp_path / "version" / "hashing_idf.npz")
+    builder = HashingEmbedder(dim=256, idf_path=path).fit(CORPUS)
+
+    # 查询进程加载同一份IDF，嵌入与构建时一致
+    loaded = HashingEmbedder(dim=256, idf_path=path)
+    assert loaded.doc_count == len(CORPUS)
+    np.testing.assert_array_equal(loaded.embed(QUERIES), builder.embed(QUERIES))
+    assert not np.array_equal(HashingEmbedder(dim=256).embed(QUERIES), builder.embed(QUERIES))
+
+    # 维度不一致的IDF文件被忽略
+    mismatched = HashingEmbedder(dim=128, idf_path=path)
+    assert mismatched.doc_count == 0
@@ -0,0 +1,56 @@
+# 元数据过滤：运算符语义、日期解析与条件改写
+
+import pytest
+from knowledge_base.metadata_filter import matches_filter, parse_date, normalize_where, filter_fields
+
+def test_parse_partial_dates():
+    assert parse_date("2022年3月") == 20220300
+    assert parse_date("2021-05-01") == 20210501
+    assert parse_date("2021/5/1") == 20210501
+    assert parse_date(2020) == 20200000
+    assert parse_date("2020", upper=True) == 20209999
+    assert parse_date("2022年3月", upper=True) == 20220399
+    assert parse_date("未知") is None
+    assert parse_date(None) is None
+    assert parse_date(True) is None
+
+def test_negative_operators_match_missing_fields():
+    assert matches_filter({}, {"source": {"$ne": "WHO"}})
+    assert matches_filter({}, {"source": {"$nin": ["WHO", "CDC"]}})
+    assert not matches_filter({}, {"source": {"$eq": "WHO"}})
+    assert not matches_filter({}, {"year": {"$gt": 2000}})
+    assert not matches_filter({"source": "WHO"}, {"source": {"$nin": ["WHO"]}})
+
+def test_and_or_combinations():
+    metadata = {"source": "WHO", "chunk_type": "table"}
+    assert matches_filter(metadata, {"$or": [{"source": "CDC"}, {"chunk_type": "table"}]})
+    assert not matches_filter(metadata, {"$and": [{"source": "WHO"}, {"chunk_type": "text"}]})
+    with pytest.raises(ValueError):
+        matches_filter(metadata, {"source": {"$like": "W"}})
+
+@pytest.mark.parametrize("where, dates", [
+    ({"publication_date": {"$gt": "2020"}}, {"2021-01-01": True, "2020-12-31": False, "2020": False}),
+    ({"publication_date": {"$gte": "2020"}}, {"2020": True, "2020-03": True, "2019-12-31": False}),
+    ({"publication_date": {"$lt": "2020-06"}}, {"2020-05-31": True, "2020-06-01": False, "2020": True}),
+    ({"publication_date": "2020"}, {"2020-06-01": True, "2020": True, "2021-01-01": False}),
+    ({"publication_date": {"$ne": "2020"}}, {"2020-06-01": False, "2019": True}),
+    ({"publication_date": {"$in": ["2019", "2021"]}}, {"2019-02": True, "2020-02": False, "2021": True}),
+])
+def test_date_conditions_are_ranges_over_the_stored_integer(where, dates):
+    normalized = normalize_where(where)
+    for date, expected in dates.items():
+        metadata = filter_fields({"publication_date": date})
+        assert matches_filter(metadata, normalized) is expected, (where, date)
+
+def test_tag_conditions_become_boolean_fields():
+    from config.data_sources import MVP_DISEASES
+    first, second = MVP_DISEASES[0], MVP_DISEASES[1]
+    metadata = filter_fields({}, text=f"关于{first}的指南")
+    assert matches_filter(metadata, normalize_where({"disease": first}))
+    assert not matches_filter(metadata, normalize_where({"disease": second}))
+    assert matches_filter(metadata, normalize_where({"disease": {"$in": [first, second]}}))
+    assert not matches_filter(metadata, normalize_where({"disease": {"$nin": [first, second]}}))
+
+def test_normalize_keeps_one_key_per_condition():
+    where = normalize_where({"source": "WHO", "publication_date": {"$gt": "2020"}})
+    assert where == {"$and": [{"source": "WHO"}, {"publication_date_value": {"$gt": 20209999}}]}
@@ -0,0 +1,116 @@
+# 元数据预过滤索引：位图与逐行过滤一致、精确性标记与持久化
+
+import random
+import numpy as np
+import pytest
+from knowledge_base.metadata_filter import matches_filter, normalize_where, filter_fields
+from knowledge_base.metadata_index import MetadataIndex
+
+SOURCES = ["WHO", "CDC", "NHC"]
+DATES = ["2019-05-01", "2020", "2020-03", "2021年7月", None]
+
+def make_metadatas(n, seed=0):
+    rng = random.Random(seed)
+    metadatas = []
+    for _ in range(n):
+        metadata = {"chunk_type": rng.choice(["text", "table"]), "year": rng.choice([2019, 2020, 2021])}
+        source = rng.choice(SOURCES + [None])
+        if source:
+            metadata["source"] = source
+        date = rng.choice(DATES)
+        if date:
+            metadata["publication_date"] = date
+        metadata.update(filter_fields(metadata))
+        metadatas.append(metadata)
+    return metadatas
+
+WHERES = [
+    {"source": "WHO"},
+    {"source": {"$ne": "WHO"}},
+    {"source": {"$in": ["WHO", "CDC"]}},
+    {"source": {"$nin": ["WHO", "CDC"]}},
+    {"source": "FDA"},
+    {"publication_date": {"$gt": "2020"}},
+    {"publication_date": {"$lte": "2020-03"}},
+    {"publication_date": "2020"},
+    {"publication_date": {"$ne": "2020"}},
+    {"publication_date": {"$nin": ["2019", "2021"]}},
+    {"$and": [{"source": "CDC"}, {"chunk_type": "table"}]},
+    {"$or": [{"source": "CDC"}, {"publication_date": {"$gte": "2021"}}]},
+    {"$and": [{"source": {"$ne": "NHC"}}, {"year": {"$gte": 2020}}]},
+    {"$or": [{"source": "CDC"}, {"$and": [{"chunk_type": "text"}, {"year": 2019}]}]},
+]
+
+@pytest.fixture
+def indexed():
+    metadatas = make_metadatas(500)
+    index = MetadataIndex()
+    index.add(list(range(len(metadatas))), metadatas)
+    return index, metadatas
+
+@pytest.mark.parametrize("where", WHERES)
+def test_bitmap_agrees_with_row_filter(indexed, where):
+    index, metadatas = indexed
+    normalized = normalize_where(where)
+    expected = np.array([matches_filter(metadata, normalized) for metadata in metadatas])
+    bitmap, exact = index.evaluate(normalized)
+    assert bitmap is not None
+    # 位图必须包含所有匹配行；精确时与逐行过滤完全一致
+    assert not (expected & ~bitmap).any()
+    if exact:
+        assert (bitmap == expected).all()
+
+def test_missing_fields_match_negative_conditions(indexed):
+    index, metadatas = indexed
+    missing = np.array(["source" not in metadata for metadata in metadatas])
+    assert missing.any()
+    bitmap, exact = index.evaluate({"source": {"$nin": SOURCES}})
+    assert exact and (bitmap == missing).all()
+    # 日期条件是已知日期上的区间，没有日期的文本块不满足
+    undated = np.array(["publication_date" not in metadata for metadata in metadatas])
+    bitmap, exact = index.evaluate(normalize_where({"publication_date": {"$ne": "2020"}}))
+    assert exact and not (bitmap & undated).any()
+
+def test_exactness_of_non_indexed_conditions(indexed):
+    index, _ = indexed
+    assert index.evaluate({"source": "WHO"})[1]
+    # $and 中跳过未建索引的条件，$or 中有一项未建索引时整体无法预过滤
+    bitmap, exact = index.evaluate({"$and": [{"source": "WHO"}, {"year": 2020}]})
+    assert bitmap is not None and not exact
+    assert index.evaluate({"$or": [{"source": "WHO"}, {"year": 2020}]}) == (None, False)
+    assert index.evaluate({"year": {"$gt": 2019}}) == (None, False)
+
+def test_tombstones_and_updates(indexed):
+    index, metadatas = indexed
+    index.mark_deleted([0, 1])
+    assert not index.alive.values[:2].any()
+    index.set(2, {"source": "FDA"})
+    bitmap, _ = index.evaluate({"source": "FDA"})
+    assert list(np.flatnonzero(bitmap)) == [2]
+
+def test_save_and_load_round_trip(tmp_path, indexed):
+    index, metadatas = indexed
+    index.mark_deleted([5])
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+
+    loaded = MetadataIndex()
+    assert loaded.load(path)
+    assert len(loaded) == len(metadatas)
+    assert (loaded.alive.values == index.alive.values).all()
+    for where in WHERES:
+        normalized = normalize_where(where)
+        expected, loaded_result = index.evaluate(normalized), loaded.evaluate(normalized)
+        assert (expected[0] == loaded_result[0]).all() and expected[1] == loaded_result[1]
+    # 新行在加载的词表上继续编码
+    loaded.add([len(metadatas)], [{"source": "WHO"}])
+    assert loaded.evaluate({"source": "WHO"})[0][-1]
+
+def test_load_rejects_missing_or_mismatched_files(tmp_path, indexed):
+    index, _ = indexed
+    path = str(tmp_path / "index.npz")
+    assert not MetadataIndex().load(path)
+    index.save(path)
+    other = MetadataIndex()
+    other.numeric_fields = ["other_value"]
+    assert not other.load(path)
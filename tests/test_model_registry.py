@@ -0,0 +1,94 @@
+# 模型注册表：共享实例、失败条目重置和加载失败后的恢复
+
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from config.model_config import EMBEDDING_CONFIG
+from knowledge_base import model_registry
+from knowledge_base.model_registry import registry, get_embedder, STATE_FAILED, STATE_READY
+from knowledge_base.embedder import MedicalEmbedder
+
+class FakeModel:
+    """固定维度的假嵌入模型"""
+
+    def get_sentence_embedding_dimension(self):
+        return 8
+
+    def encode(self, texts, **kwargs):
+        if isinstance(texts, str):
+            return np.ones(8, dtype=np.float32)
+        return np.ones((len(texts), 8), dtype=np.float32)
+
+@pytest.fixture
+def flaky_model(monkeypatch):
+    """空的注册表 + 第一次加载失败、之后加载成功的嵌入模型"""
+    monkeypatch.setattr(registry, "entries", {})
+    monkeypatch.setitem(EMBEDDING_CONFIG, "CACHE", {**EMBEDDING_CONFIG["CACHE"], "ENABLED": False})
+    monkeypatch.setitem(EMBEDDING_CONFIG, "POOL", {**EMBEDDING_CONFIG["POOL"], "NUM_WORKERS": 0})
+    attempts = []
+    def create_model(self):
+        attempts.append(len(attempts))
+        if len(attempts) == 1:
+            raise OSError("模型下载失败")
+        return FakeModel()
+    monkeypatch.setattr(MedicalEmbedder, "create_model", create_model)
+    yield attempts
+    embedder = registry.peek("embedder")
+    if embedder is not None:
+        embedder.close()
+
+def test_get_loads_once_and_shares_instance():
+    local = model_registry.ModelRegistry()
+    calls = []
+    def loader():
+        calls.append(1)
+        return object()
+    assert local.get("m", loader) is local.get("m", loader)
+    assert len(calls) == 1
+    assert local.state("m") == STATE_READY
+
+def test_reset_failed_only_removes_failed_entries():
+    local = model_registry.ModelRegistry()
+    local.get("ok", object)
+    with pytest.raises(RuntimeError):
+        local.get("bad", lambda: 1 / 0)
+    assert local.state("bad") == STATE_FAILED
+    assert local.reset_failed() == ["bad"]
+    assert local.is_ready("ok")
+    assert local.get("bad", lambda: 2) == 2
+
+def test_shared_embedder_recovers_after_reset(flaky_model, tmp_path):
+    schema = {"model": EMBEDDING_CONFIG["MODEL_NAME"]}
+    embedder = get_embedder()
+    assert embedder.model is None
+    with pytest.raises(RuntimeError):
+        embedder.bind_collection(schema, str(tmp_path))
+    # 失败条目未清除前不重复加载
+    assert embedder.model is None
+    assert flaky_model == [0]
+
+    assert embedder.model_key() in registry.reset_failed()
+    assert get_embedder() is embedder
+    assert embedder.model is not None
+    embedder.bind_collection(schema, str(tmp_path))
+    assert embedder.embedding_dimension() == 8
+    assert embedder.embed_query("糖尿病有什么症状") == [1.0] * 8
+
+def test_web_retriever_recovers_after_failed_load(flaky_model, tmp_path, monkeypatch):
+    # Web界面依赖flask、rank_bm25、openai等，未安装时跳过
+    web_ui = pytest.importorskip("ui.web_ui")
+
+    def load_retriever():
+        # 与MultiRetriever一样：取共享嵌入器并确认查询嵌入与集合一致
+        embedder = get_embedder()
+        embedder.bind_collection({"model": EMBEDDING_CONFIG["MODEL_NAME"]}, str(tmp_path))
+        return SimpleNamespace(embedder=embedder)
+    monkeypatch.setattr(web_ui, "MultiRetriever", load_retriever)
+    ui = SimpleNamespace(warmup_retry=0)
+
+    with pytest.raises(RuntimeError):
+        web_ui.WebUI.get_retriever(ui)
+    # 失败后在后台重新加载检索器
+    retriever = web_ui.WebUI.get_retriever(ui, timeout=5)
+    assert retriever.embedder.model is not None
+    assert registry.is_ready("retriever")
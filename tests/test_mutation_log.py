@@ -0,0 +1,145 @@
+# 变更日志：重放、合并、读己之写叠加和失败隔离
+
+import threading
+import numpy as np
+import pytest
+from config.model_config import VECTOR_DB_CONFIG, EMBEDDING_CONFIG
+from knowledge_base.mutation_log import (
+    MutationLog, OP_UPSERT, OP_UPDATE, OP_DELETE, coalesce, encode_mutation, decode_mutation
+)
+
+def test_replay_ignores_torn_last_line(tmp_path):
+    path = str(tmp_path / "mutations.log")
+    complete = [
+        {"op": OP_DELETE, "id": "a"},
+        {"op": OP_UPDATE, "id": "b", "document": "新正文"}
+    ]
+    torn = encode_mutation({"op": OP_DELETE, "id": "c"})
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("".join(encode_mutation(mutation) + "\n" for mutation in complete))
+        f.write(torn[:len(torn) // 2])
+
+    # 应用一直失败：重放的变更和之后追加的变更都留在日志中
+    def apply(mutations):
+        raise RuntimeError("存储后端不可用")
+
+    log = MutationLog(path, apply, apply_delay_ms=0, retry_seconds=0.01, max_attempts=1000)
+    try:
+        assert set(log.pending_mutations()) == {"a", "b"}
+        log.append([{"op": OP_DELETE, "id": "d"}])
+    finally:
+        log.close()
+
+    # 残行被截掉，追加的变更没有接在残行后面
+    applied = []
+    log = MutationLog(path, applied.extend, apply_delay_ms=0)
+    try:
+        assert log.sync(timeout=5)
+    finally:
+        log.close()
+    assert sorted(mutation["id"] for mutation in applied) == ["a", "b", "d"]
+    assert log.pending_mutations() == {}
+    with open(path, 'r', encoding='utf-8') as f:
+        assert f.read() == ""
+
+def test_update_after_delete_is_dropped():
+    final = coalesce([
+        {"op": OP_DELETE, "id": "a", "seq": 0},
+        {"op": OP_UPDATE, "id": "a", "document": "复活", "seq": 1}
+    ])
+    assert final["a"]["op"] == OP_DELETE
+    assert "document" not in final["a"]
+
+def test_updates_merge_fields_and_upsert_replaces():
+    final = coalesce([
+        {"op": OP_UPDATE, "id": "a", "document": "正文", "seq": 0},
+        {"op": OP_UPDATE, "id": "a", "metadata": {"section": "症状"}, "seq": 1},
+        {"op": OP_DELETE, "id": "b", "seq": 2},
+        {"op": OP_UPSERT, "id": "b", "document": "重新写入", "embedding": [1.0, 0.0], "seq": 3}
+    ])
+    assert final["a"]["op"] == OP_UPDATE
+    assert final["a"]["document"] == "正文"
+    assert final["a"]["metadata"] == {"section": "症状"}
+    assert final["a"]["seq"] == 1
+    assert final["b"]["op"] == OP_UPSERT
+    assert final["b"]["document"] == "重新写入"
+
+def test_encode_round_trip():
+    mutation = {"op": OP_UPSERT, "id": "a", "document": "正文", "embedding": [0.5, -0.25],
+                "sparse": {3: 0.5, 7: 1.25}, "seq": 9}
+    decoded = decode_mutation(encode_mutation(mutation))
+    assert "seq" not in decoded
+    assert decoded["embedding"] == [0.5, -0.25]
+    assert decoded["sparse"] == {3: 0.5, 7: 1.25}
+
+def test_failing_batch_is_quarantined(tmp_path):
+    path = str(tmp_path / "mutations.log")
+
+    def apply(mutations):
+        raise RuntimeError("存储后端不可用")
+
+    log = MutationLog(path, apply, apply_delay_ms=0, retry_seconds=0, max_attempts=2)
+    try:
+        log.append([{"op": OP_DELETE, "id": "a"}, {"op": OP_UPDATE, "id": "b", "document": "x"}])
+        assert log.sync(timeout=5)
+        assert log.pending_mutations() == {}
+    finally:
+        log.close()
+
+    with open(log.quarantine_path, 'r', encoding='utf-8') as f:
+        quarantined = [decode_mutation(line) for line in f]
+    assert [mutation["id"] for mutation in quarantined] == ["a", "b"]
+    with open(path, 'r', encoding='utf-8') as f:
+        assert f.read() == ""
+
+@pytest.fixture
+def vector_db(tmp_path, monkeypatch):
+    """NumPy后端、启用变更日志的可写集合"""
+    from knowledge_base.vector_db import VectorDatabase, MODE_REBUILD
+    monkeypatch.setitem(VECTOR_DB_CONFIG, "DB_TYPE", "numpy")
+    monkeypatch.setitem(VECTOR_DB_CONFIG, "SIMILARITY_THRESHOLD", -1.0)
+    monkeypatch.setitem(VECTOR_DB_CONFIG, "MUTATION_LOG", {**VECTOR_DB_CONFIG["MUTATION_LOG"], "ENABLED": True})
+    db = VectorDatabase(mode=MODE_REBUILD, persist_directory=str(tmp_path))
+    yield db
+    db.close()
+
+def test_overlay_ranking_matches_applied_ranking(vector_db):
+    rng = np.random.default_rng(0)
+    dim = EMBEDDING_CONFIG["EMBEDDING_DIM"]
+    chunks = [{"id": f"c{i}", "content": f"文本块{i}", "embedding": rng.standard_normal(dim).tolist()}
+              for i in range(40)]
+    vector_db.add_chunks(chunks)
+    queries = [rng.standard_normal(dim).tolist() for _ in range(5)]
+    # 让部分变更直接命中查询，排序中混合存储结果和叠加结果
+    new_chunks = [{"id": f"n{i}", "content": f"新文本块{i}",
+                   "embedding": (np.asarray(queries[i]) + rng.standard_normal(dim)).tolist()}
+                  for i in range(3)]
+
+    # 挡住应用线程，让变更停留在读己之写视图中
+    release = threading.Event()
+    apply = vector_db.mutations.apply
+    def gated_apply(mutations):
+        release.wait()
+        apply(mutations)
+    vector_db.mutations.apply = gated_apply
+
+    vector_db.upsert_chunks(new_chunks)
+    vector_db.delete_chunks(["c1", "c2", "c3"])
+    vector_db.update_chunk("c4", new_embedding=queries[3])
+    vector_db.update_chunk("c5", new_content="改写后的正文")
+    vector_db.delete_chunks(["c6"])
+    vector_db.update_chunk("c6", new_content="删除后的更新不生效")
+    assert vector_db.mutations.pending_mutations()
+
+    overlay = vector_db.query_many(queries, top_k=8)
+    release.set()
+    assert vector_db.sync_mutations(timeout=10)
+    assert vector_db.mutations.pending_mutations() == {}
+    applied = vector_db.query_many(queries, top_k=8)
+
+    for before, after in zip(overlay, applied):
+        assert [hit["id"] for hit in before] == [hit["id"] for hit in after]
+        assert [hit["content"] for hit in before] == [hit["content"] for hit in after]
+        np.testing.assert_allclose([hit["distance"] for hit in before], [hit["distance"] for hit in after], atol=1e-5)
+    assert all(hit["id"] not in ("c1", "c2", "c3", "c6") for hits in applied for hit in hits)
+    assert applied[3][0]["id"] == "c4"
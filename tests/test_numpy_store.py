@@ -0,0 +1,177 @@
+# NumPy后端：与暴力余弦检索一致、int8量化重新打分、落盘重开与中断恢复
+
+import os
+import numpy as np
+import pytest
+from knowledge_base import numpy_store
+from knowledge_base.metrics import normalize_embeddings
+from knowledge_base.numpy_store import NumpyStore
+
+DIM = 32
+SOURCES = ["WHO", "CDC", "NHC"]
+
+def make_rows(n, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = normalize_embeddings(rng.standard_normal((n, DIM)))
+    ids = [f"c{i}" for i in range(n)]
+    documents = [f"文本块{i}" for i in range(n)]
+    metadatas = [{"source": SOURCES[i % len(SOURCES)]} for i in range(n)]
+    return ids, vectors, documents, metadatas
+
+def brute_force(vectors, query, top_k, allowed=None):
+    """暴力余弦检索（向量按float16存储），返回 [(行号, 余弦距离)]"""
+    scores = vectors.astype(np.float16).astype(np.float32) @ query
+    if allowed is not None:
+        scores = np.where(allowed, scores, -np.inf)
+    order = np.argsort(-scores)[:top_k]
+    return [(int(row), 1.0 - float(scores[row])) for row in order if np.isfinite(scores[row])]
+
+def make_store(tmp_path, read_only=False, **config):
+    return NumpyStore(str(tmp_path), "kb", DIM, read_only=read_only, config={"BLOCK_ROWS": 64, **config})
+
+def filled_store(tmp_path, n=300, **config):
+    ids, vectors, documents, metadatas = make_rows(n)
+    store = make_store(tmp_path, **config)
+    store.create()
+    store.write(ids, vectors, documents, metadatas)
+    store.flush()
+    return store, (ids, vectors, documents, metadatas)
+
+def assert_matches(hits, expected, ids):
+    assert [hit[0] for hit in hits] == [ids[row] for row, _ in expected]
+    np.testing.assert_allclose([hit[1] for hit in hits], [distance for _, distance in expected], atol=1e-5)
+
+def test_matches_brute_force_across_blocks_and_pending_rows(tmp_path):
+    store, (ids, vectors, documents, metadatas) = filled_store(tmp_path)
+    extra_ids, extra_vectors, extra_documents, extra_metadatas = make_rows(50, seed=2)
+    extra_ids = [f"n{i}" for i in range(50)]
+    store.write(extra_ids, extra_vectors, extra_documents, extra_metadatas)
+    all_ids, all_vectors = ids + extra_ids, np.vstack([vectors, extra_vectors])
+
+    queries = normalize_embeddings(np.random.default_rng(1).standard_normal((5, DIM)))
+    for query, hits in zip(queries, store.query_many(queries, 10)):
+        assert_matches(hits, brute_force(all_vectors, query, 10), all_ids)
+
+def test_filter_and_tombstones(tmp_path):
+    store, (ids, vectors, _, metadatas) = filled_store(tmp_path)
+    store.delete(["c0", "c3"])
+    allowed = np.array([metadata["source"] == "WHO" for metadata in metadatas])
+    allowed[[0, 3]] = False
+    query = vectors[0]
+    assert_matches(store.query(query, 10, where={"source": "WHO"}), brute_force(vectors, query, 10, allowed), ids)
+    assert store.count() == 298
+
+def test_save_and_reopen_returns_same_results(tmp_path):
+    store, (_, vectors, _, _) = filled_store(tmp_path)
+    before = store.query_many(vectors[:5], 8, where={"source": {"$ne": "WHO"}})
+    store.rows.close()
+
+    reopened = make_store(tmp_path, read_only=True)
+    reopened.open()
+    assert reopened.query_many(vectors[:5], 8, where={"source": {"$ne": "WHO"}}) == before
+    assert reopened.count() == 300
+    reopened.rows.close()
+
+def test_compact_renumbers_rows(tmp_path):
+    store, (ids, vectors, _, _) = filled_store(tmp_path)
+    store.delete(ids[::2])
+    assert store.compact() == 150
+    assert store.rows.next_row == len(store.matrix) == 150
+    assert_matches(store.query(vectors[1], 5), [(row, distance) for row, distance in
+                                                brute_force(vectors[1::2], vectors[1], 5)], ids[1::2])
+
+def test_open_truncates_rows_written_after_the_last_commit(tmp_path):
+    store, (ids, vectors, _, _) = filled_store(tmp_path, n=100)
+    store.rows.close()
+    # 模拟落盘写入矩阵后、提交映射表前中断：矩阵比映射表多出若干行
+    matrix = np.load(store.matrix_path)
+    np.save(store.matrix_path, np.vstack([matrix, matrix[:7]]))
+
+    reopened = make_store(tmp_path)
+    reopened.open()
+    assert len(reopened.matrix) == 100
+    assert reopened.query(vectors[42], 1)[0][0] == "c42"
+    reopened.rows.close()
+
+def test_open_finishes_an_interrupted_compaction(tmp_path, monkeypatch):
+    store, (ids, vectors, _, _) = filled_store(tmp_path, n=100)
+    store.delete(ids[:40])
+    replace = os.replace
+
+    def crash_before_swap(src, dst):
+        if src == store.compact_path:
+            raise OSError("simulated crash")
+        replace(src, dst)
+
+    # 映射表已提交、矩阵尚未替换时中断
+    monkeypatch.setattr(numpy_store.os, "replace", crash_before_swap)
+    with pytest.raises(OSError):
+        store.compact()
+    monkeypatch.undo()
+    store.rows.close()
+    assert os.path.exists(store.compact_path)
+
+    reopened = make_store(tmp_path)
+    reopened.open()
+    assert not os.path.exists(store.compact_path)
+    assert len(reopened.matrix) == reopened.rows.next_row == 60
+    assert_matches(reopened.query(vectors[50], 5), brute_force(vectors[40:], vectors[50], 5), ids[40:])
+    reopened.rows.close()
+
+def test_open_discards_a_stale_compaction_file(tmp_path):
+    store, (_, vectors, _, _) = filled_store(tmp_path, n=100)
+    store.rows.close()
+    # 映射表提交之前中断：临时矩阵的行数与映射表不一致，丢弃
+    np.save(store.compact_path, np.zeros((30, DIM), dtype=np.float16))
+
+    reopened = make_store(tmp_path)
+    reopened.open()
+    assert not os.path.exists(store.compact_path)
+    assert len(reopened.matrix) == 100
+    assert reopened.query(vectors[7], 1)[0][0] == "c7"
+    reopened.rows.close()
+
+def test_int8_rescoring_returns_exact_distances(tmp_path):
+    store, (ids, vectors, _, _) = filled_store(tmp_path, n=2000, QUANTIZATION="int8", RESCORE_FACTOR=4)
+    assert store.codes is not None and store.codes.dtype == np.int8
+    queries = normalize_embeddings(np.random.default_rng(3).standard_normal((20, DIM)))
+    recall = []
+    for query, hits in zip(queries, store.query_many(queries, 10)):
+        expected = brute_force(vectors, query, 10)
+        recall.append(len({hit[0] for hit in hits} & {ids[row] for row, _ in expected}) / 10)
+        # 候选经float16精确重新打分，返回的距离与不量化时一致
+        exact = 1.0 - vectors.astype(np.float16).astype(np.float32) @ query
+        np.testing.assert_allclose([hit[1] for hit in hits], exact[[int(hit[0][1:]) for hit in hits]], atol=1e-5)
+    assert np.mean(recall) >= 0.95
+
+def test_int8_with_full_rescoring_matches_brute_force(tmp_path):
+    store, (ids, vectors, _, _) = filled_store(tmp_path, QUANTIZATION="int8", RESCORE_FACTOR=30)
+    # 尚未落盘的新增行不在int8矩阵中，按float16打分
+    extra_ids, extra_vectors, extra_documents, extra_metadatas = make_rows(20, seed=4)
+    extra_ids = [f"n{i}" for i in range(20)]
+    store.write(extra_ids, extra_vectors, extra_documents, extra_metadatas)
+    all_ids, all_vectors = ids + extra_ids, np.vstack([vectors, extra_vectors])
+    for query in normalize_embeddings(np.random.default_rng(5).standard_normal((5, DIM))):
+        assert_matches(store.query(query, 10), brute_force(all_vectors, query, 10), all_ids)
+
+def test_int8_codes_follow_flush_compact_and_reopen(tmp_path):
+    store, (ids, vectors, _, _) = filled_store(tmp_path, QUANTIZATION="int8", RESCORE_FACTOR=30)
+    store.delete(ids[:100])
+    store.compact()
+    assert len(store.codes) == len(store.matrix) == 200
+    before = store.query_many(vectors[100:105], 5)
+    store.rows.close()
+
+    reopened = make_store(tmp_path, read_only=True, QUANTIZATION="int8", RESCORE_FACTOR=30)
+    reopened.open()
+    assert reopened.codes is not None
+    assert reopened.query_many(vectors[100:105], 5) == before
+    reopened.rows.close()
+
+    # int8矩阵过期时只读打开不使用量化，结果仍然精确
+    np.save(store.codes_path, np.zeros((10, DIM), dtype=np.int8))
+    stale = make_store(tmp_path, read_only=True, QUANTIZATION="int8")
+    stale.open()
+    assert stale.codes is None
+    assert stale.query_many(vectors[100:105], 5) == before
+    stale.rows.close()
@@ -0,0 +1,75 @@
+# 查询嵌入缓存：LRU淘汰、内存上限、TTL过期与查询规范化
+
+import pytest
+from knowledge_base import query_cache
+from knowledge_base.query_cache import QueryEmbeddingCache
+
+class FakeClock:
+    """可手动推进的 time.monotonic"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(query_cache, "time", clock)
+    return clock
+
+def test_normalized_queries_share_an_entry():
+    cache = QueryEmbeddingCache(max_entries=10)
+    cache.put("糖尿病　有什么症状？", [1.0, 2.0])
+    assert cache.get("  糖尿病 有什么症状? ") == [1.0, 2.0]
+    assert cache.get("糖尿病") is None
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["hit_rate"] == 0.5
+
+def test_least_recently_used_entry_is_evicted():
+    cache = QueryEmbeddingCache(max_entries=2)
+    cache.put("a", [1.0])
+    cache.put("b", [2.0])
+    assert cache.get("a") == [1.0]
+    cache.put("c", [3.0])
+    assert cache.get("b") is None
+    assert cache.get("a") == [1.0] and cache.get("c") == [3.0]
+    assert cache.stats()["evictions"] == 1
+
+def test_byte_limit_counts_float32_vectors():
+    cache = QueryEmbeddingCache(max_entries=100, max_bytes=3 * 4 * 4)
+    for i in range(5):
+        cache.put(f"q{i}", [float(i)] * 4)
+    stats = cache.stats()
+    assert stats["entries"] == 3 and stats["bytes"] == 48 and stats["evictions"] == 2
+    # 覆盖写入不重复计算内存
+    cache.put("q4", [9.0] * 4)
+    assert cache.stats()["bytes"] == 48
+    # 单个条目超过上限时不缓存
+    cache.put("huge", [0.0] * 16)
+    assert cache.get("huge") is None and cache.stats()["bytes"] == 0
+
+def test_entries_expire_after_ttl(clock):
+    cache = QueryEmbeddingCache(ttl_seconds=60)
+    cache.put("高血压", [1.0])
+    clock.now += 59
+    assert cache.get("高血压") == [1.0]
+    clock.now += 2
+    assert cache.get("高血压") is None
+    stats = cache.stats()
+    assert stats["expirations"] == 1 and stats["entries"] == 0 and stats["bytes"] == 0
+
+def test_zero_ttl_never_expires(clock):
+    cache = QueryEmbeddingCache(ttl_seconds=0)
+    cache.put("高血压", [1.0])
+    clock.now += 10 ** 9
+    assert cache.get("高血压") == [1.0]
+
+def test_returned_embedding_is_a_copy():
+    cache = QueryEmbeddingCache()
+    cache.put("q", [1.0, 2.0])
+    cache.get("q").append(3.0)
+    assert cache.get("q") == [1.0, 2.0]
+    cache.clear()
+    assert cache.stats()["entries"] == 0 and cache.get("q") is None
@@ -0,0 +1,91 @@
+# 多路召回：知识库版本的热切换
+
+import os
+import threading
+import pytest
+from config.model_config import VECTOR_DB_CONFIG, EMBEDDING_CONFIG
+from knowledge_base.embedder import MedicalEmbedder
+from knowledge_base.hashing_embedder import HASHING_FALLBACK_MODEL, HASHING_IDF_FILE
+from knowledge_base.vector_db import VectorDatabase, MODE_REBUILD
+
+# 检索模块依赖rank_bm25，未安装时跳过
+retriever = pytest.importorskip("rag_engine.retriever")
+
+TEXTS = ["高血压的症状：头晕、头痛。", "糖尿病的治疗：二甲双胍。", "冠心病的饮食：低脂饮食。"]
+
+@pytest.fixture
+def offline_embedder(monkeypatch):
+    """模型无法加载、使用离线备用嵌入器的嵌入器"""
+    from knowledge_base.model_registry import registry
+    monkeypatch.setattr(registry, "entries", {})
+    monkeypatch.setitem(EMBEDDING_CONFIG, "CACHE", {**EMBEDDING_CONFIG["CACHE"], "ENABLED": False})
+    monkeypatch.setitem(EMBEDDING_CONFIG, "POOL", {**EMBEDDING_CONFIG["POOL"], "NUM_WORKERS": 0})
+    def create_model(self):
+        raise OSError("离线")
+    monkeypatch.setattr(MedicalEmbedder, "create_model", create_model)
+    embedder = MedicalEmbedder()
+    yield embedder
+    embedder.close()
+
+def build_version(manager, embedder, texts):
+    """用备用嵌入器构建一个版本（texts为空时只写入IDF，集合为空）"""
+    version, directory = manager.new_version()
+    db = VectorDatabase(mode=MODE_REBUILD, persist_directory=directory,
+                        embedding_dim=EMBEDDING_CONFIG["EMBEDDING_DIM"])
+    embedder.fit_fallback(texts or ["占位"], directory)
+    db.record_build_info(model=HASHING_FALLBACK_MODEL)
+    if texts:
+        db.ingest_chunks([{"id": f"c{i}", "content": text} for i, text in enumerate(texts)], embedder.embed_chunks)
+    db.close()
+    manager.publish(version)
+    return version
+
+def test_failed_swap_leaves_embedder_on_current_version(tmp_path, monkeypatch, offline_embedder):
+    monkeypatch.setitem(VECTOR_DB_CONFIG, "DB_TYPE", "numpy")
+    monkeypatch.setitem(VECTOR_DB_CONFIG, "PERSIST_DIRECTORY", str(tmp_path))
+    monkeypatch.setitem(VECTOR_DB_CONFIG, "MUTATION_LOG", {**VECTOR_DB_CONFIG["MUTATION_LOG"], "ENABLED": False})
+    manager = VectorDatabase.snapshot_manager()
+    current = build_version(manager, offline_embedder, TEXTS)
+
+    multi = object.__new__(retriever.MultiRetriever)
+    multi.embedder = offline_embedder
+    multi.sparse_enabled = True
+    multi.embedding_dim = EMBEDDING_CONFIG["EMBEDDING_DIM"]
+    multi.snapshot_config = VECTOR_DB_CONFIG["SNAPSHOTS"]
+    multi.snapshots = manager
+    multi.snapshot = retriever.RetrievalSnapshot(current, manager.path(current), load_bm25=False,
+                                                 embedding_dim=multi.embedding_dim)
+    multi.snapshot.bind(offline_embedder)
+    multi.previous_snapshot = None
+    multi.failed_version = None
+    multi.swap_lock = threading.Lock()
+    current_idf = os.path.join(manager.path(current), HASHING_IDF_FILE)
+    assert offline_embedder.fallback.idf_path == current_idf
+
+    # 检查候选版本期间，并发请求使用的共享嵌入器仍然是当前版本的IDF
+    seen = []
+    validate = retriever.RetrievalSnapshot.validate
+    def recording_validate(snapshot, probe_embedding=None):
+        seen.append(offline_embedder.fallback.idf_path)
+        return validate(snapshot, probe_embedding)
+    monkeypatch.setattr(retriever.RetrievalSnapshot, "validate", recording_validate)
+
+    # 空版本未通过检查：共享嵌入器仍然使用当前版本的IDF
+    empty = build_version(manager, offline_embedder, [])
+    offline_embedder.bind_collection({"model": HASHING_FALLBACK_MODEL}, manager.path(current))
+    assert not multi.swap_to(empty)
+    assert multi.version == current
+    assert offline_embedder.fallback.idf_path == current_idf
+    assert seen == [current_idf]
+
+    # 通过检查的版本切换后才绑定新版本的IDF
+    newer = build_version(manager, offline_embedder, TEXTS + ["骨质疏松的预防：补钙。"])
+    offline_embedder.bind_collection({"model": HASHING_FALLBACK_MODEL}, manager.path(current))
+    assert multi.swap_to(newer)
+    assert multi.version == newer
+    assert offline_embedder.fallback.idf_path == os.path.join(manager.path(newer), HASHING_IDF_FILE)
+
+    assert multi.rollback()
+    assert offline_embedder.fallback.idf_path == current_idf
+    multi.snapshot.close()
+    multi.previous_snapshot.close()
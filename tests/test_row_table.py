@@ -0,0 +1,60 @@
+# 行号映射表：批内重复ID、覆盖写入墓碑、压缩重新编号与元数据索引持久化
+
+from knowledge_base.row_table import RowTable
+
+def make_table(tmp_path, read_only=False):
+    table = RowTable(str(tmp_path / "rows.sqlite"), read_only)
+    table.connect()
+    return table
+
+def test_duplicate_ids_in_a_batch_keep_the_last(tmp_path):
+    table = make_table(tmp_path)
+    rows, keep, replaced = table.insert(["a", "b", "a"], ["旧", "乙", "新"], [{"n": 1}, {"n": 2}, {"n": 3}])
+    assert rows == [0, 1] and keep == [1, 2] and replaced == []
+    assert table.get(["a"]) == {"a": ("新", {"n": 3})}
+
+def test_existing_ids_are_skipped_or_tombstoned_on_upsert(tmp_path):
+    table = make_table(tmp_path)
+    table.insert(["a", "b"], ["甲", "乙"], [{"source": "WHO"}, {"source": "CDC"}])
+
+    rows, keep, _ = table.insert(["a"], ["甲2"], [{"source": "WHO"}])
+    assert rows == [] and keep == []
+    assert table.get(["a"])["a"][0] == "甲"
+
+    rows, keep, replaced = table.insert(["a"], ["甲3"], [{"source": "NHC"}], upsert=True)
+    assert rows == [2] and replaced == [0]
+    assert table.get(["a"])["a"] == ("甲3", {"source": "NHC"})
+    assert table.count() == 2 and table.deleted == 1
+    assert table.tombstone_rows() == [0]
+    assert list(table.index.alive.values) == [False, True, True]
+
+def test_compact_renumber_keeps_order(tmp_path):
+    table = make_table(tmp_path)
+    table.insert(list("abcde"), list("甲乙丙丁戊"), [{"source": "WHO"}] * 5)
+    table.delete(["a", "c"])
+    assert table.compact(renumber=True) == [1, 3, 4]
+    assert table.next_row == 3 and table.deleted == 0
+    assert {row: doc_id for row, (doc_id, _, _) in table.fetch_rows([0, 1, 2]).items()} == {0: "b", 1: "d", 2: "e"}
+    assert table.index.alive.values.all()
+
+def test_compact_in_place_keeps_row_numbers(tmp_path):
+    table = make_table(tmp_path)
+    table.insert(list("abc"), list("甲乙丙"), [{}] * 3)
+    table.delete(["b"])
+    assert table.compact() == [0, 2]
+    assert table.next_row == 3 and table.tombstone_rows() == []
+    assert sorted(table.fetch_rows([0, 1, 2])) == [0, 2]
+
+def test_index_persists_with_the_table(tmp_path):
+    table = make_table(tmp_path)
+    table.insert(["a", "b", "c"], ["甲", "乙", "丙"], [{"source": "WHO"}, {"source": "CDC"}, {"source": "WHO"}])
+    table.delete(["c"])
+    table.commit()
+    table.close()
+
+    reopened = make_table(tmp_path, read_only=True)
+    bitmap, exact = reopened.index.evaluate({"source": "WHO"})
+    assert exact
+    assert list(bitmap & reopened.index.alive.values) == [True, False, False]
+    assert reopened.count() == 2
+    reopened.close()
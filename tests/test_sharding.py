@@ -0,0 +1,124 @@
+# 分片向量库：全局top-k合并、查询截止时间与按来源机构路由
+
+import time
+import threading
+import numpy as np
+import pytest
+from knowledge_base.metrics import normalize_embeddings
+from knowledge_base.numpy_store import NumpyStore
+from knowledge_base.sharding import ShardServer, ShardedStore, AUTHKEY_ENV, PARTITION_FIELD
+
+DIM = 16
+AUTHKEY = "test-shard-secret"
+ORGANIZATIONS = ["WHO", "中国CDC", "国家卫健委", "梅奥诊所", "NIH"]
+
+class SlowStore:
+    """查询前等待一段时间的存储后端（模拟无响应的分片）"""
+
+    def __init__(self, store, delay):
+        self.store = store
+        self.delay = delay
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def query_many(self, *args, **kwargs):
+        time.sleep(self.delay)
+        return self.store.query_many(*args, **kwargs)
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    """在本进程的线程中启动分片服务，返回创建协调端的函数和各分片的存储后端"""
+    monkeypatch.setenv(AUTHKEY_ENV, AUTHKEY)
+    coordinators = []
+
+    def start(num_shards=3, slow_shard=None, **config):
+        stores, addresses = [], []
+        for shard in range(num_shards):
+            store = NumpyStore(str(tmp_path / f"shard-{shard}"), "kb", DIM)
+            store.create()
+            stores.append(store)
+            server = ShardServer(SlowStore(store, 1.0) if shard == slow_shard else store, AUTHKEY.encode("utf-8"))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            addresses.append(f"{server.address[0]}:{server.address[1]}")
+        coordinator = ShardedStore(str(tmp_path), "kb", DIM, db_type="numpy",
+                                   config={"ADDRESSES": addresses, **config})
+        coordinators.append(coordinator)
+        return coordinator, stores
+
+    yield start
+    for coordinator in coordinators:
+        coordinator.close()
+
+def make_rows(n, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = normalize_embeddings(rng.standard_normal((n, DIM)))
+    ids = [f"c{i}" for i in range(n)]
+    documents = [f"文本块{i}" for i in range(n)]
+    metadatas = [{PARTITION_FIELD: ORGANIZATIONS[i % len(ORGANIZATIONS)]} for i in range(n)]
+    return ids, vectors, documents, metadatas
+
+def brute_force_ids(vectors, ids, query, top_k, allowed=None):
+    scores = vectors.astype(np.float16).astype(np.float32) @ query
+    if allowed is not None:
+        scores = np.where(allowed, scores, -np.inf)
+    return [ids[row] for row in np.argsort(-scores)[:top_k] if np.isfinite(scores[row])]
+
+def test_merges_shard_results_into_global_top_k(shards):
+    coordinator, stores = shards()
+    ids, vectors, documents, metadatas = make_rows(300)
+    coordinator.write(ids, vectors, documents, metadatas)
+    assert all(store.count() > 0 for store in stores)
+    assert coordinator.count() == 300
+
+    queries = normalize_embeddings(np.random.default_rng(1).standard_normal((5, DIM)))
+    for query, hits in zip(queries, coordinator.query_many(queries, 10)):
+        assert [hit[0] for hit in hits] == brute_force_ids(vectors, ids, query, 10)
+        assert [hit[1] for hit in hits] == sorted(hit[1] for hit in hits)
+    assert coordinator.last_missing_shards == []
+
+    # 按ID读写只访问持有该ID的分片
+    assert coordinator.get(["c7"]) == {"c7": ("文本块7", metadatas[7])}
+    coordinator.delete(["c7"])
+    assert coordinator.existing_ids(["c7", "c8"]) == {"c8"}
+    with pytest.raises(KeyError):
+        coordinator.update("c7", document="已删除")
+
+def test_slow_shard_is_skipped_at_the_deadline(shards):
+    coordinator, stores = shards(slow_shard=0, QUERY_DEADLINE_MS=100)
+    ids, vectors, documents, metadatas = make_rows(300)
+    coordinator.write(ids, vectors, documents, metadatas)
+    on_fast_shards = np.array([coordinator.shard_of(doc_id) != 0 for doc_id in ids])
+
+    started = time.monotonic()
+    hits = coordinator.query(vectors[0], 10)
+    assert time.monotonic() - started < 0.8
+    assert coordinator.last_missing_shards == [0]
+    # 返回其余分片的合并结果
+    assert [hit[0] for hit in hits] == brute_force_ids(vectors, ids, vectors[0], 10, on_fast_shards)
+
+def test_source_partition_routes_filtered_queries_to_one_shard(shards):
+    coordinator, stores = shards(PARTITION="source")
+    ids, vectors, documents, metadatas = make_rows(300)
+    coordinator.write(ids, vectors, documents, metadatas)
+
+    # 同一机构的文本块都在同一个分片
+    for organization in ORGANIZATIONS:
+        shard = coordinator.shard_of(None, {PARTITION_FIELD: organization})
+        rows = [i for i, metadata in enumerate(metadatas) if metadata[PARTITION_FIELD] == organization]
+        assert set(stores[shard].get([ids[i] for i in rows])) == {ids[i] for i in rows}
+
+    where = {PARTITION_FIELD: "WHO"}
+    assert coordinator.shards_for_where(where) == [coordinator.shard_of(None, where)]
+    assert coordinator.shards_for_where({"$and": [where, {"chunk_type": "text"}]}) == coordinator.shards_for_where(where)
+    assert coordinator.shards_for_where({PARTITION_FIELD: {"$in": ["WHO", "NIH"]}}) == [0, 1, 2]
+
+    allowed = np.array([metadata[PARTITION_FIELD] == "WHO" for metadata in metadatas])
+    hits = coordinator.query(vectors[3], 10, where=where)
+    assert [hit[0] for hit in hits] == brute_force_ids(vectors, ids, vectors[3], 10, allowed)
+
+    # 按来源分区时按ID的操作发往所有分片，由持有该块的分片执行
+    coordinator.update("c3", document="更新后的正文")
+    assert coordinator.get(["c3"])["c3"][0] == "更新后的正文"
+    coordinator.delete(["c3"])
+    assert coordinator.count() == 299
@@ -0,0 +1,152 @@
+# 知识库版本快照：发布、回滚、清理和增量写入的草稿版本
+
+import os
+import shutil
+import pytest
+from config.model_config import VECTOR_DB_CONFIG
+from knowledge_base.snapshots import SnapshotManager, DRAFT_FILE, version_key
+
+def write_version(manager, content):
+    version, directory = manager.new_version()
+    with open(os.path.join(directory, "data.txt"), 'w', encoding='utf-8') as f:
+        f.write(content)
+    return version
+
+def read_version(manager, version):
+    with open(os.path.join(manager.path(version), "data.txt"), 'r', encoding='utf-8') as f:
+        return f.read()
+
+def test_resolve_without_published_version_uses_root(tmp_path):
+    manager = SnapshotManager(str(tmp_path))
+    assert manager.resolve() == (None, str(tmp_path))
+    with pytest.raises(FileNotFoundError):
+        manager.publish("missing")
+    with pytest.raises(FileNotFoundError):
+        manager.fork()
+
+def test_publish_switches_current_and_prunes_oldest(tmp_path):
+    manager = SnapshotManager(str(tmp_path), keep_versions=2)
+    published = []
+    for i in range(4):
+        version = write_version(manager, f"v{i}")
+        manager.publish(version)
+        published.append(version)
+        assert manager.resolve() == (version, manager.path(version))
+
+    assert manager.load_history() == published
+    assert manager.versions() == published[2:]
+
+def test_prune_keeps_builds_in_progress_and_drafts(tmp_path):
+    manager = SnapshotManager(str(tmp_path), keep_versions=1)
+    failed = write_version(manager, "构建失败")
+    base = write_version(manager, "v1")
+    manager.publish(base)
+    draft, _ = manager.fork()
+    building = write_version(manager, "构建中")
+
+    manager.prune()
+    # 比当前版本更早的未发布目录是失败的构建，删除；更新的是正在进行的构建，保留
+    assert failed not in manager.versions()
+    assert {base, draft, building} <= set(manager.versions())
+
+def test_rollback_walks_back_through_existing_versions(tmp_path):
+    manager = SnapshotManager(str(tmp_path), keep_versions=5)
+    v1, v2, v3 = (write_version(manager, f"v{i}") for i in range(1, 4))
+    for version in (v1, v2, v3):
+        manager.publish(version)
+
+    assert manager.rollback() == v2
+    assert manager.load_history() == [v1, v2]
+    # 已被删除的版本不能回滚
+    shutil.rmtree(manager.path(v1))
+    assert manager.rollback() is None
+    assert manager.current() == v2
+
+    # 重新发布的版本移到发布顺序末尾
+    manager.publish(v3)
+    assert manager.load_history() == [v1, v2, v3]
+    manager.publish(v2)
+    assert manager.load_history() == [v1, v3, v2]
+    assert manager.rollback() == v3 and read_version(manager, v3) == "v3"
+
+def test_new_versions_sort_after_pruned_ones(tmp_path):
+    manager = SnapshotManager(str(tmp_path), keep_versions=1)
+    created = []
+    for i in range(12):
+        version = write_version(manager, f"v{i}")
+        manager.publish(version)
+        created.append(version)
+    # 同一秒内创建的版本也按创建顺序排列，被清理的版本号不会被复用
+    assert len(set(created)) == len(created)
+    assert sorted(created, key=version_key) == created
+    assert manager.versions() == created[-1:]
+    assert version_key("20240101-120000-10") > version_key("20240101-120000-9") > version_key("20240101-120000")
+
+def test_fork_copies_current_and_leaves_it_untouched(tmp_path):
+    manager = SnapshotManager(str(tmp_path))
+    base = write_version(manager, "v1")
+    manager.publish(base)
+
+    draft, directory = manager.fork()
+    assert draft != base and manager.draft_base(draft) == base
+    with open(os.path.join(directory, "data.txt"), 'w', encoding='utf-8') as f:
+        f.write("v1+变更")
+    assert read_version(manager, base) == "v1"
+    # 草稿未发布时继续使用同一个草稿
+    assert manager.fork()[0] == draft
+
+    manager.publish(draft)
+    assert manager.current() == draft
+    assert manager.draft_base(draft) is None
+    assert manager.rollback() == base
+    assert read_version(manager, base) == "v1"
+
+def test_stale_draft_log_is_carried_to_new_base(tmp_path):
+    manager = SnapshotManager(str(tmp_path), keep_versions=1)
+    base = write_version(manager, "v1")
+    manager.publish(base)
+    draft, directory = manager.fork(carry_files=("mutations.log",))
+    with open(os.path.join(directory, "mutations.log"), 'w', encoding='utf-8') as f:
+        f.write("pending\n")
+
+    # 草稿期间发布了新构建：草稿不被清理，下次fork时把未应用的变更转移到新草稿
+    rebuilt = write_version(manager, "v2")
+    manager.publish(rebuilt)
+    assert draft in manager.versions()
+
+    new_draft, new_directory = manager.fork(carry_files=("mutations.log",))
+    assert manager.draft_base(new_draft) == rebuilt
+    assert read_version(manager, new_draft) == "v2"
+    with open(os.path.join(new_directory, "mutations.log"), 'r', encoding='utf-8') as f:
+        assert f.read() == "pending\n"
+    assert draft not in manager.versions()
+
+def test_append_mode_writes_to_a_draft(tmp_path, monkeypatch):
+    from knowledge_base.vector_db import VectorDatabase, MODE_APPEND, MODE_REBUILD
+    monkeypatch.setitem(VECTOR_DB_CONFIG, "DB_TYPE", "numpy")
+    monkeypatch.setitem(VECTOR_DB_CONFIG, "PERSIST_DIRECTORY", str(tmp_path))
+    monkeypatch.setitem(VECTOR_DB_CONFIG, "MUTATION_LOG", {**VECTOR_DB_CONFIG["MUTATION_LOG"], "ENABLED": True})
+    manager = VectorDatabase.snapshot_manager()
+    base, directory = manager.new_version()
+    db = VectorDatabase(mode=MODE_REBUILD, persist_directory=directory, embedding_dim=4)
+    db.add_chunks([{"id": f"c{i}", "content": f"文本块{i}", "embedding": [1.0, float(i), 0.0, 0.0]}
+                   for i in range(3)])
+    db.close()
+    manager.publish(base)
+
+    db = VectorDatabase(mode=MODE_APPEND, embedding_dim=4)
+    assert db.draft and db.version != base
+    db.delete_chunks(["c0"])
+    assert db.publish(timeout=10) == db.version
+    published = db.version
+
+    # 已发布的基础版本没有被修改
+    old = VectorDatabase(persist_directory=manager.path(base), embedding_dim=4)
+    new = VectorDatabase(embedding_dim=4)
+    try:
+        assert old.get_collection_stats() == 3
+        assert new.version == published
+        assert new.get_collection_stats() == 2
+    finally:
+        old.close()
+        new.close()
@@ -0,0 +1,97 @@
+# 稀疏词权重倒排索引：与暴力点积一致、删除与覆盖、墓碑清理和保存加载
+
+import numpy as np
+from knowledge_base.sparse_index import SparseInvertedIndex
+
+VOCAB = 200
+
+def make_docs(n, seed=0):
+    rng = np.random.default_rng(seed)
+    docs = {}
+    for i in range(n):
+        tokens = rng.choice(VOCAB, size=rng.integers(3, 12), replace=False)
+        docs[f"d{i}"] = {int(token): float(weight) for token, weight in zip(tokens, rng.uniform(0.05, 1, len(tokens)))}
+    return docs
+
+def brute_force(docs, query, top_k):
+    scores = {doc_id: sum(np.float32(weight) * query.get(token, 0) for token, weight in weights.items())
+              for doc_id, weights in docs.items()}
+    ranked = sorted((item for item in scores.items() if item[1] > 0), key=lambda item: -item[1])
+    return ranked[:top_k]
+
+def assert_matches(results, expected):
+    assert [doc_id for doc_id, _ in results] == [doc_id for doc_id, _ in expected]
+    np.testing.assert_allclose([score for _, score in results], [score for _, score in expected], rtol=1e-5)
+
+def make_index(docs):
+    index = SparseInvertedIndex()
+    assert index.add_many(list(docs), list(docs.values())) == len(docs)
+    return index
+
+QUERIES = [{1: 0.5, 7: 0.3, 42: 0.9}, {3: 1.0}, {int(token): 0.2 for token in range(0, VOCAB, 5)}]
+
+def test_search_matches_brute_force():
+    docs = make_docs(300)
+    index = make_index(docs)
+    for query in QUERIES:
+        assert_matches(index.search(query, top_k=10), brute_force(docs, query, 10))
+    assert index.search({}, top_k=10) == []
+    assert index.search({VOCAB + 1: 1.0}, top_k=10) == []
+
+def test_remove_and_replace():
+    docs = make_docs(100)
+    index = make_index(docs)
+    query = QUERIES[2]
+    index.search(query)
+
+    # 已存在的ID默认跳过，replace时覆盖旧的词权重
+    assert not index.add("d0", {999: 1.0})
+    assert index.add("d0", {999: 1.0}, replace=True)
+    docs["d0"] = {999: 1.0}
+    assert index.search({999: 1.0}) == [("d0", 1.0)]
+
+    assert index.remove(["d1", "d2", "missing"]) == 2
+    del docs["d1"], docs["d2"]
+    assert len(index) == 98
+    assert_matches(index.search(query, top_k=20), brute_force(docs, query, 20))
+
+    # 删除后可以重新添加
+    assert index.add("d1", {999: 2.0})
+    assert [doc_id for doc_id, _ in index.search({999: 1.0})] == ["d1", "d0"]
+
+def test_compact_keeps_results():
+    docs = make_docs(100)
+    index = make_index(docs)
+    index.remove([f"d{i}" for i in range(0, 100, 3)])
+    docs = {doc_id: weights for doc_id, weights in docs.items() if int(doc_id[1:]) % 3}
+    before = [index.search(query, top_k=15) for query in QUERIES]
+
+    assert index.compact() == 34
+    assert index.compact() == 0
+    assert len(index.ids) == len(index) == len(docs)
+    for query, results in zip(QUERIES, before):
+        assert index.search(query, top_k=15) == results
+        assert_matches(results, brute_force(docs, query, 15))
+
+def test_save_and_load_round_trip(tmp_path):
+    docs = make_docs(100)
+    index = make_index(docs)
+    index.remove(["d5"])
+    del docs["d5"]
+    path = str(tmp_path / "sparse" / "index.npz")
+    index.save(path)
+
+    loaded = SparseInvertedIndex.load(path)
+    assert len(loaded) == 99 and loaded.deleted == set()
+    for query in QUERIES:
+        assert loaded.search(query, top_k=10) == index.search(query, top_k=10)
+        assert_matches(loaded.search(query, top_k=10), brute_force(docs, query, 10))
+    # 加载后仍可继续追加
+    assert loaded.add("new", {3: 5.0})
+    assert loaded.search({3: 1.0})[0] == ("new", 5.0)
+
+def test_load_missing_or_empty_index(tmp_path):
+    path = str(tmp_path / "index.npz")
+    assert len(SparseInvertedIndex.load(path)) == 0
+    SparseInvertedIndex().save(path)
+    assert SparseInvertedIndex.load(path).search({1: 1.0}) == []
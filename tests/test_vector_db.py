@@ -0,0 +1,35 @@
+# 向量数据库：相似度阈值
+
+import numpy as np
+import pytest
+from config.model_config import VECTOR_DB_CONFIG
+from knowledge_base.vector_db import VectorDatabase, MODE_REBUILD
+from knowledge_base.hashing_embedder import HashingEmbedder, HASHING_FALLBACK_MODEL
+
+@pytest.fixture
+def numpy_db(tmp_path, monkeypatch):
+    monkeypatch.setitem(VECTOR_DB_CONFIG, "DB_TYPE", "numpy")
+    monkeypatch.setitem(VECTOR_DB_CONFIG, "MUTATION_LOG", {**VECTOR_DB_CONFIG["MUTATION_LOG"], "ENABLED": False})
+    db = VectorDatabase(mode=MODE_REBUILD, persist_directory=str(tmp_path), embedding_dim=256)
+    yield db
+    db.close()
+
+def test_threshold_follows_collection_model(numpy_db):
+    assert numpy_db.similarity_threshold == VECTOR_DB_CONFIG["SIMILARITY_THRESHOLD"]
+    numpy_db.record_build_info(model=HASHING_FALLBACK_MODEL)
+    assert numpy_db.similarity_threshold == VECTOR_DB_CONFIG["SIMILARITY_THRESHOLDS"][HASHING_FALLBACK_MODEL]
+
+def test_fallback_collection_keeps_matching_hits(numpy_db):
+    texts = ["糖尿病的症状：多饮、多尿、多食和体重下降。",
+             "高血压的治疗：长期规律服用降压药。",
+             "骨质疏松的饮食：多摄入奶制品和豆制品。"]
+    embedder = HashingEmbedder(dim=256).fit(texts, save=False)
+    numpy_db.record_build_info(model=HASHING_FALLBACK_MODEL)
+    numpy_db.add_chunks([{"id": f"c{i}", "content": text, "embedding": embedding.tolist()}
+                         for i, (text, embedding) in enumerate(zip(texts, embedder.embed(texts)))])
+
+    query = embedder.embed(["糖尿病有什么症状"])[0]
+    hits = numpy_db.query(query.tolist(), top_k=3)
+    assert hits and hits[0]["id"] == "c0"
+    # 备用嵌入器的相似度远低于模型尺度的默认阈值
+    assert hits[0]["score"] < VECTOR_DB_CONFIG["SIMILARITY_THRESHOLD"]
@@ -6,7 +6,8 @@ from flask_cors import CORS
 from rag_engine.intent_recognizer import IntentRecognizer
 from rag_engine.retriever import MultiRetriever
 from rag_engine.generator import AnswerGenerator
-from config.model_config import SAFETY_CONFIG
+from knowledge_base.model_registry import registry, STATE_READY
+from config.model_config import SAFETY_CONFIG, RAG_CONFIG
 
 class WebUI:
     def __init__(self):
@@ -27,12 +28,31 @@ class WebUI:
         
         # 初始化模块
         self.intent_recognizer = IntentRecognizer()
-        self.retriever = MultiRetriever()
         self.generator = AnswerGenerator()
         
+        # 检索器需要加载嵌入模型和构建BM25索引，启用预热时在后台加载，端口可以立即提供服务
+        warmup_config = RAG_CONFIG.get("WARMUP", {})
+        self.warmup_wait = warmup_config.get("WAIT_SECONDS", 10)
+        self.warmup_retry = warmup_config.get("RETRY_SECONDS", 30)
+        if warmup_config.get("ENABLED", False):
+            registry.warm("retriever", MultiRetriever)
+        else:
+            self.get_retriever()
+        
         # 免责声明
         self.disclaimer = SAFETY_CONFIG["DISCLAIMER"]
     
+    def get_retriever(self, timeout=None):
+        """获取共享的检索器，尚未就绪时最多等待timeout秒（超时抛出TimeoutError，加载失败抛出RuntimeError）"""
+        try:
+            return registry.get("retriever", MultiRetriever, timeout=timeout)
+        except RuntimeError:
+            # 加载失败（如知识库尚未发布、模型暂时无法下载）：距上次失败超过重试间隔后
+            # 清除失败条目（包括检索器依赖的嵌入器和模型）并在后台重新加载
+            if registry.reset_failed(older_than=self.warmup_retry):
+                registry.warm("retriever", MultiRetriever)
+            raise
+    
     def handle_chat(self, query):
         """处理闲聊"""
         chat_responses = {
@@ -84,8 +104,24 @@ class WebUI:
                     })
                 else:
                     # 医疗咨询
+                    try:
+                        retriever = self.get_retriever(timeout=self.warmup_wait)
+                    except TimeoutError:
+                        return jsonify({
+                            'status': 'error',
+                            'message': '知识库正在加载，请稍后重试',
+                            'intent': intent_result['intent']
+                        })
+                    except RuntimeError as e:
+                        print(f"检索器加载失败: {e}")
+                        return jsonify({
+                            'status': 'error',
+                            'message': '知识库暂时不可用，正在重试加载，请稍后重试',
+                            'intent': intent_result['intent']
+                        })
+                    
                     # 检索相关信息
-                    retrieved_results = self.retriever.retrieve(query)
+                    retrieved_results = retriever.retrieve(query)
                     
                     # 生成回答
                     answer_result = self.generator.generate(query, retrieved_results)
@@ -104,7 +140,26 @@ class WebUI:
                     'status': 'error',
                     'message': '处理请求时发生错误，请稍后重试'
                 })
-    
+
+        @self.app.route('/api/stats', methods=['GET'])
+        def stats():
+            retriever = registry.peek("retriever")
+            return jsonify({
+                'status': 'success',
+                'embedding': retriever.embedder.get_stats() if retriever is not None else {},
+                'knowledge_base_version': retriever.version if retriever is not None else None
+            })
+        
+        @self.app.route('/api/health', methods=['GET'])
+        def health():
+            # 检索器就绪前返回503，滚动重启时负载均衡器据此判断是否切流量
+            state = registry.state("retriever")
+            return jsonify({
+                'status': state,
+                'ready': state == STATE_READY,
+                'models': registry.status()
+            }), 200 if state == STATE_READY else 503
+
     def run(self, host='0.0.0.0', port=5000, debug=False):
         """运行Web服务器"""
         self.app.run(host=host, port=port, debug=debug)